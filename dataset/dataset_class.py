@@ -5,22 +5,61 @@ import torch
 from torch.utils.data import Dataset
 import face_alignment
 
+from .packed import PackedShard, find_shards
+from .video_sampler import VideoSampler
 from .video_extraction_conversion import *
 
 
+def scale_landmarks(landmark, height, width, frame_shape):
+    """Landmarks of a height x width frame, in the frame_shape x frame_shape resized frame"""
+    landmark = landmark.copy()
+    if (height, width) != (frame_shape, frame_shape):
+        landmark /= [width / frame_shape, height / frame_shape]
+    return landmark
+
+
+def make_frame_mark(frames, landmarks, frame_shape, K, lmarks=None):
+    """K,2,3,S,S uint8 frames and landmark images, plus the index of a random one of the K as the target.
+
+    lmarks are precomputed landmark images at frame_shape, drawn here when not given.
+    """
+    cur_frames = []
+    cur_landmarks = []
+    for frame, landmark in zip(frames, landmarks):
+        cur_landmarks.append(scale_landmarks(landmark, frame.shape[0], frame.shape[1], frame_shape))
+        if frame.shape[:2] != (frame_shape, frame_shape):
+            frame = cv2.resize(frame, (frame_shape, frame_shape), interpolation=cv2.INTER_AREA)
+        cur_frames.append(frame)
+    if lmarks is None:
+        lmarks = rasterize_landmarks(cur_landmarks, (frame_shape, frame_shape), DRAW_STYLE)
+
+    # uint8 to keep DataLoader transfers small, the conversion to float is done on the device
+    frame_mark = np.stack((np.stack(cur_frames), lmarks), axis=1)  # K,2,224,224,3
+    frame_mark = torch.from_numpy(frame_mark).permute([0, 1, 4, 2, 3]).contiguous()  # K,2,3,224,224
+
+    # the target frame and landmark image are picked from frame_mark on the device, not copied here
+    g_idx = np.random.randint(low=0, high=K)
+    return frame_mark, g_idx
+
+
 class VidDataSet(Dataset):
-    def __init__(self, K, path_to_mp4, device, path_to_wi, size=256):
+    def __init__(self, K, path_to_mp4, device, path_to_wi, size=256, keyframe_cache=None, detect_landmarks=True):
         self.K = K
         self.size = size
         self.path_to_Wi = path_to_wi
         self.path_to_mp4 = path_to_mp4
         self.device = device
-        self.face_aligner = face_alignment.FaceAlignment(
-            face_alignment.LandmarksType._2D,
-            flip_input=False,
-            device=device
-        )
+        # without landmarks, samples are the K raw frames for a LandmarkService (see dataset/landmark_service.py)
+        self.detect_landmarks = detect_landmarks
+        self.face_aligner = None
+        if detect_landmarks:
+            self.face_aligner = face_alignment.FaceAlignment(
+                face_alignment.LandmarksType._2D,
+                flip_input=False,
+                device=device
+            )
         self.video_paths = glob.glob(os.path.join(path_to_mp4, '*/*/*.mp4'))
+        self.sampler = VideoSampler(cache_dir=keyframe_cache)
         self.W_i = None
         if self.path_to_Wi is not None:
             if self.W_i is None:
@@ -38,114 +77,211 @@ class VidDataSet(Dataset):
     def __len__(self):
         return len(self.video_paths)
 
+    @property
+    def video_keys(self):
+        # names of the videos in vid_idx order, W_i columns follow them across runs
+        return [os.path.relpath(path, self.path_to_mp4) for path in self.video_paths]
+
     def __getitem__(self, idx):
         vid_idx = idx
+        if not self.detect_landmarks:
+            return self.get_frames(vid_idx)
+
         path = self.video_paths[vid_idx]
         ok = False
         while not ok:
             try:
-                frame_mark = select_frames(path, self.K)
+                frame_mark = select_frames(path, self.K, self.sampler)
                 frame_mark = generate_landmarks(frame_mark, self.face_aligner, size=self.size)
                 ok = True
             except Exception:
                 vid_idx = torch.randint(low=0, high=len(self.video_paths), size=(1,))[0].item()
                 path = self.video_paths[vid_idx]
-        frame_mark = torch.from_numpy(np.array(frame_mark)).type(dtype=torch.float)  # K,2,224,224,3
-        frame_mark = frame_mark.permute([0, 1, 4, 2, 3]) / 255.  # K,2,3,224,224
+        frame_mark = torch.from_numpy(np.array(frame_mark, dtype=np.uint8))  # K,2,224,224,3
+        frame_mark = frame_mark.permute([0, 1, 4, 2, 3]).contiguous()  # K,2,3,224,224
 
-        g_idx = torch.randint(low=0, high=self.K, size=(1, 1))
-        x = frame_mark[g_idx, 0].squeeze()
-        g_y = frame_mark[g_idx, 1].squeeze()
+        g_idx = torch.randint(low=0, high=self.K, size=(1,)).item()
 
-        return frame_mark, x, g_y, vid_idx, self.W_i[:, vid_idx].unsqueeze(1)
+        return frame_mark, g_idx, vid_idx, self.w_i(vid_idx)
+
+    def get_frames(self, vid_idx):
+        frames = []
+        while len(frames) < self.K:
+            try:
+                frames = select_frames(self.video_paths[vid_idx], self.K, self.sampler)
+            except Exception:
+                frames = []
+            if len(frames) < self.K:
+                vid_idx = torch.randint(low=0, high=len(self.video_paths), size=(1,))[0].item()
+        return frames, vid_idx, self.w_i(vid_idx)
+
+    def w_i(self, vid_idx):
+        # without path_to_wi W_i lives in a WiTable (training/wi_table.py), not in the samples
+        if self.W_i is None:
+            return torch.Tensor([])
+        return self.W_i[:, vid_idx].unsqueeze(1)
 
     def save_w_i(self):
+        if self.W_i is None:
+            return
         torch.save({'W_i': self.W_i}, self.path_to_Wi + '/W_' + str(len(self)) + '.tar')
 
 
 class PreprocessDataset(Dataset):
-    def __init__(self, K, path_to_preprocess, path_to_Wi, frame_shape=224):
+    INDEX = 'dataset_index.npz'
+    LANDMARKS = 'dataset_landmarks.npy'
+    RASTERS = 'dataset_rasters_{}.npy'
+
+    def __init__(self, K, path_to_preprocess, path_to_Wi, frame_shape=224, rebuild_index=False, use_rasters=True):
         self.K = K
         self.path_to_preprocess = path_to_preprocess
         self.path_to_Wi = path_to_Wi
         self.frame_shape = frame_shape
 
-        self.video_dirs = glob.glob(os.path.join(path_to_preprocess, '*/*'))
-        # self.W_i = None
-        # if self.path_to_Wi is not None:
-        #     if self.W_i is None:
-        #         try:
-        #             Load
-                    # W_i = torch.load(self.path_to_Wi + '/W_' + str(len(self.video_dirs)) + '.tar',
-                    #                  map_location='cpu')['W_i'].requires_grad_(False)
-                    # self.W_i = W_i
-                # except:
-                #     print("error loading: ", self.path_to_Wi + '/W_' + str(len(self.video_dirs)) + '.tar')
-                #     print("Initializing: ", self.path_to_Wi + '/W_' + str(len(self.video_dirs)) + '.tar')
-                #     import sys
-                #     sys.stdout.flush()
-                #     w_i = torch.rand(512, len(self))
-                #     torch.save({'W_i': w_i}, self.path_to_Wi + '/W_' + str(len(self)) + '.tar')
-                #     self.W_i = w_i
+        index_path = os.path.join(path_to_preprocess, self.INDEX)
+        landmarks_path = os.path.join(path_to_preprocess, self.LANDMARKS)
+        if rebuild_index or not os.path.exists(index_path) or not os.path.exists(landmarks_path):
+            self.build_index(path_to_preprocess, index_path, landmarks_path)
+        index = np.load(index_path)
+        self.video_dirs = index['video_dirs']
+        self.counts = index['counts']
+        self.offsets = index['offsets']
+        self.frame_names = index['frame_names']
+        self.landmarks_path = landmarks_path
+        # landmark images rendered by dataset/render_rasters.py, drawn on the fly if missing
+        self.rasters_path = os.path.join(path_to_preprocess, self.RASTERS.format(frame_shape))
+        if not use_rasters or not os.path.exists(self.rasters_path):
+            self.rasters_path = None
+        elif len(np.load(self.rasters_path, mmap_mode='r')) != len(self.frame_names):
+            print(f'Ignoring {self.rasters_path}, it does not match {index_path}')
+            self.rasters_path = None
+        # opened lazily, in each DataLoader worker
+        self.landmarks = None
+        self.rasters = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(landmarks=None, rasters=None)
+        return state
+
+    @staticmethod
+    def build_index(path_to_preprocess, index_path, landmarks_path):
+        """Scan the video dirs once: frame names and landmark offset of each valid video, all landmarks in one array"""
+        print(f'Indexing {path_to_preprocess}...')
+        video_dirs, counts, frame_names, landmarks = [], [], [], []
+        skipped = 0
+        for video_dir in sorted(glob.glob(os.path.join(path_to_preprocess, '*/*'))):
+            lm_path = os.path.join(video_dir, 'landmarks.npy')
+            if not os.path.isdir(video_dir) or not os.path.exists(lm_path):
+                skipped += 1
+                continue
+            names = sorted(name for name in os.listdir(video_dir) if name.endswith('.jpg'))
+            all_landmarks = np.load(lm_path)
+            if len(names) == 0 or len(all_landmarks) != len(names):
+                skipped += 1
+                continue
+            video_dirs.append(os.path.relpath(video_dir, path_to_preprocess))
+            counts.append(len(names))
+            frame_names.extend(names)
+            landmarks.append(all_landmarks.astype(np.float32))
+        if not video_dirs:
+            raise ValueError(f'No valid video dirs in {path_to_preprocess}')
+
+        counts = np.array(counts, dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        # written to temporary files first, a concurrent run never sees a partial index
+        with open(landmarks_path + '.tmp', 'wb') as f:
+            np.save(f, np.concatenate(landmarks))
+        with open(index_path + '.tmp', 'wb') as f:
+            np.savez(f, video_dirs=np.array(video_dirs), counts=counts, offsets=offsets,
+                     frame_names=np.array(frame_names))
+        os.replace(landmarks_path + '.tmp', landmarks_path)
+        os.replace(index_path + '.tmp', index_path)
+        # rasters are aligned with the old index rows
+        for path in glob.glob(os.path.join(path_to_preprocess, PreprocessDataset.RASTERS.format('*'))):
+            os.remove(path)
+        print(f'Indexed {len(video_dirs)} videos, {len(frame_names)} frames, skipped {skipped} invalid dirs')
 
     def __len__(self):
         return len(self.video_dirs)
 
+    @property
+    def video_keys(self):
+        return [str(video_dir) for video_dir in self.video_dirs]
+
     def __getitem__(self, idx):
         vid_idx = idx
-        video_dir = self.video_dirs[vid_idx]
-        lm_path = os.path.join(video_dir, 'landmarks.npy')
-        jpg_paths = sorted(glob.glob(os.path.join(video_dir, '*.jpg')))
-        if os.path.exists(lm_path):
-            all_landmarks = np.load(lm_path)
+        if self.landmarks is None:
+            self.landmarks = np.load(self.landmarks_path, mmap_mode='r')
+            if self.rasters_path is not None:
+                self.rasters = np.load(self.rasters_path, mmap_mode='r')
 
-        while not os.path.exists(lm_path) or len(all_landmarks) != len(jpg_paths):
-            vid_idx = vid_idx // 2
-            video_dir = self.video_dirs[vid_idx]
-            lm_path = os.path.join(video_dir, 'landmarks.npy')
-            if not os.path.exists(lm_path):
-                continue
-            jpg_paths = glob.glob(os.path.join(video_dir, '*.jpg'))
-            all_landmarks = np.load(lm_path)
-            if len(all_landmarks) != len(jpg_paths):
-                continue
+        # Select K frames
+        video_dir = os.path.join(self.path_to_preprocess, self.video_dirs[vid_idx])
+        frame_ids = self.offsets[vid_idx] + np.random.randint(0, self.counts[vid_idx], size=(self.K,))
+        paths = [os.path.join(video_dir, name) for name in self.frame_names[frame_ids]]
+        landmarks = self.landmarks[frame_ids]
+
+        lmarks = self.rasters[frame_ids] if self.rasters is not None else None
 
-        # Select K paths
-        random_indices = np.random.randint(0, len(jpg_paths), size=(self.K,))
-        paths = np.array(jpg_paths)[random_indices]
-        landmarks = all_landmarks[random_indices]
-
-        frame_mark = []
-        for i, path in enumerate(paths):
-            frame = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
-            cur_landmark = landmarks[i].copy()
-            if frame.shape[:2] != (self.frame_shape, self.frame_shape):
-                x_factor, y_factor = frame.shape[1] / self.frame_shape, frame.shape[0] / self.frame_shape
-                frame = cv2.resize(frame, (self.frame_shape, self.frame_shape), interpolation=cv2.INTER_AREA)
-                cur_landmark /= [x_factor, y_factor]
-            lmark = draw_landmark(cur_landmark, size=frame.shape)
-            # cv2.imshow('img', lmark)
-            # cv2.waitKey(0)
-            # exit()
-            frame_mark.append((frame, lmark))
-
-        frame_mark = torch.from_numpy(np.array(frame_mark)).type(dtype=torch.float)  # K,2,224,224,3
-        frame_mark = frame_mark.permute([0, 1, 4, 2, 3]) / 255.  # K,2,3,224,224
-        frame_mark = frame_mark.requires_grad_(False)
-
-        g_idx = np.random.randint(low=0, high=self.K, size=(1, 1))
-        x = frame_mark[g_idx, 0].squeeze()
-        g_y = frame_mark[g_idx, 1].squeeze()
+        frames = [cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB) for path in paths]
+        frame_mark, g_idx = make_frame_mark(frames, landmarks, self.frame_shape, self.K, lmarks)
 
         # w_i = self.W_i[:, vid_idx].unsqueeze(1)
         # w_i = w_i.detach()
-        return frame_mark, x, g_y, vid_idx, torch.Tensor([])
+        return frame_mark, g_idx, vid_idx, torch.Tensor([])
 
     def save_w_i(self):
         # torch.save({'W_i': self.W_i}, self.path_to_Wi + '/W_' + str(len(self)) + '.tar')
         pass
 
 
+class PackedDataset(Dataset):
+    """PreprocessDataset over packed shards (see dataset/packed.py): a sample is K memory mapped reads"""
+    def __init__(self, K, path_to_packed, path_to_Wi, frame_shape=224, use_rasters=True):
+        self.K = K
+        self.path_to_packed = path_to_packed
+        self.path_to_Wi = path_to_Wi
+        self.frame_shape = frame_shape
+        self.use_rasters = use_rasters
+
+        self.shards = [PackedShard(shard_dir) for shard_dir in find_shards(path_to_packed)]
+        # (shard, video row) of each non empty video
+        self.videos = [
+            (shard_i, video_i)
+            for shard_i, shard in enumerate(self.shards)
+            for video_i in np.flatnonzero(shard.videos[:, 1] > 0)
+        ]
+
+    def __len__(self):
+        return len(self.videos)
+
+    @property
+    def video_keys(self):
+        return [self.shards[shard_i].names[video_i] for shard_i, video_i in self.videos]
+
+    def __getitem__(self, idx):
+        vid_idx = idx
+        shard_i, video_i = self.videos[vid_idx]
+        shard = self.shards[shard_i]
+        start, count = shard.videos[video_i]
+
+        frame_ids = start + np.random.randint(0, count, size=(self.K,))
+        frames = []
+        landmarks = []
+        for frame_idx in frame_ids:
+            frame, landmark = shard.read_frame(frame_idx)
+            frames.append(frame)
+            landmarks.append(landmark)
+        lmarks = shard.read_rasters(frame_ids, self.frame_shape) if self.use_rasters else None
+        frame_mark, g_idx = make_frame_mark(frames, landmarks, self.frame_shape, self.K, lmarks)
+
+        return frame_mark, g_idx, vid_idx, torch.Tensor([])
+
+    def save_w_i(self):
+        pass
+
+
 class FineTuningImagesDataset(Dataset):
     def __init__(self, path_to_images, device):
         self.path_to_images = path_to_images
@@ -0,0 +1,145 @@
+import threading
+
+import numpy as np
+import torch
+from face_alignment.utils import crop, get_preds_fromhm
+
+
+def landmarks_box(landmarks, margin=0.05, top_margin=0.2):
+    """Face box [x1, y1, x2, y2] around 68 landmarks, grown to look like a detector box (forehead included)"""
+    minx, miny = np.min(landmarks, axis=0)
+    maxx, maxy = np.max(landmarks, axis=0)
+    w, h = maxx - minx, maxy - miny
+    return np.array([minx - w * margin, miny - h * top_margin, maxx + w * margin, maxy + h * margin])
+
+
+def box_iou(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    return inter / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter)
+
+
+def detect_face(face_aligner, image):
+    """Box of the first face found by the FaceAlignment detector in an RGB image, None if there is no face"""
+    detected_faces = face_aligner.face_detector.detect_from_image(image[..., ::-1].copy())
+    if len(detected_faces) == 0:
+        return None
+    return detected_faces[0]
+
+
+def get_landmarks_batch(face_aligner, images, boxes):
+    """Landmarks (68, 2) of one face box per RGB image, with a single forward of the landmark network.
+
+    Same crop and heatmap decoding as FaceAlignment.get_landmarks, for all images at once.
+    """
+    if len(images) == 0:
+        return []
+
+    centers, scales, inputs = [], [], []
+    for image, d in zip(images, boxes):
+        center = torch.FloatTensor([d[2] - (d[2] - d[0]) / 2.0, d[3] - (d[3] - d[1]) / 2.0])
+        center[1] = center[1] - (d[3] - d[1]) * 0.12
+        scale = (d[2] - d[0] + d[3] - d[1]) / face_aligner.face_detector.reference_scale
+        centers.append(center)
+        scales.append(scale)
+        inputs.append(crop(image, center, scale).transpose((2, 0, 1)))
+
+    inp = torch.from_numpy(np.stack(inputs)).float().to(face_aligner.device).div_(255.0)
+    with torch.no_grad():
+        out = face_aligner.face_alignment_net(inp)[-1].detach().cpu()
+
+    landmarks = []
+    for j in range(len(images)):
+        _, pts_img = get_preds_fromhm(out[j:j + 1], centers[j], scales[j])
+        landmarks.append(pts_img.view(68, 2).numpy())
+    return landmarks
+
+
+class LandmarkTracker(object):
+    """Drop-in replacement of FaceAlignment.get_landmarks for consecutive frames of a video.
+
+    The face box derived from the previous frame's landmarks is used as the detection,
+    so the face detector only runs every detect_interval frames, or when tracking is lost:
+    no landmarks, or new landmarks whose box overlaps the tracked box with an IoU below min_iou.
+    Only the first face is tracked. detect_interval=1 runs the detector on every frame.
+    State is kept per stream (e.g. the video path), call reset(stream) when a video ends.
+    """
+    def __init__(self, face_aligner, detect_interval=10, min_iou=0.5, margin=0.05, top_margin=0.2):
+        self.face_aligner = face_aligner
+        self.detect_interval = detect_interval
+        self.min_iou = min_iou
+        self.margin = margin
+        self.top_margin = top_margin
+        self.lock = threading.Lock()
+        self.states = {}
+        self.frames = 0
+        self.detections = 0
+
+    def reset(self, stream=None):
+        with self.lock:
+            self.states.pop(stream, None)
+
+    def tracked_box(self, stream):
+        """Box to use instead of a detection for the next frame of stream, None if the detector must run"""
+        with self.lock:
+            self.frames += 1
+            state = self.states.get(stream)
+            if state is None:
+                return None
+            state[1] += 1
+            if self.detect_interval <= 1 or state[1] >= self.detect_interval:
+                return None
+            return state[0]
+
+    def detect(self, image):
+        with self.lock:
+            self.detections += 1
+        return detect_face(self.face_aligner, image)
+
+    def update(self, stream, landmarks, detected):
+        with self.lock:
+            if landmarks is None:
+                self.states.pop(stream, None)
+            elif detected or stream not in self.states:
+                self.states[stream] = [landmarks_box(landmarks, self.margin, self.top_margin), 0]
+            else:
+                self.states[stream][0] = landmarks_box(landmarks, self.margin, self.top_margin)
+
+    def get_landmarks_batch(self, images, streams):
+        """Landmarks for a batch of frames from one or several streams.
+
+        Returns, per frame, a one element list with the (68, 2) landmarks like FaceAlignment.get_landmarks, or None.
+        """
+        boxes = []
+        tracked = []
+        for image, stream in zip(images, streams):
+            box = self.tracked_box(stream)
+            tracked.append(box is not None)
+            if box is None:
+                box = self.detect(image)
+            boxes.append(box)
+
+        valid = [j for j, box in enumerate(boxes) if box is not None]
+        landmarks = [None] * len(images)
+        for j, lm in zip(valid, get_landmarks_batch(self.face_aligner, [images[j] for j in valid],
+                                                    [boxes[j] for j in valid])):
+            landmarks[j] = lm
+
+        results = []
+        for j, stream in enumerate(streams):
+            lm = landmarks[j]
+            detected = not tracked[j]
+            if tracked[j] and box_iou(landmarks_box(lm, self.margin, self.top_margin), boxes[j]) < self.min_iou:
+                # tracking lost, fall back to a full detection for this frame
+                box = self.detect(images[j])
+                lm = get_landmarks_batch(self.face_aligner, [images[j]], [box])[0] if box is not None else None
+                detected = True
+            self.update(stream, lm, detected)
+            results.append(None if lm is None else [lm])
+        return results
+
+    def get_landmarks(self, image, stream=None):
+        return self.get_landmarks_batch([image], [stream])[0]
@@ -0,0 +1,64 @@
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+# segments are (rgb color, landmark indices), drawn as open polylines
+LandmarkStyle = namedtuple('LandmarkStyle', ['groups', 'thickness', 'shift'])
+
+
+def make_style(segments, thickness, shift=0):
+    # group segments by color so that each color is a single cv2.polylines call
+    groups = {}
+    for color, indices in segments:
+        groups.setdefault(color, []).append(np.array(indices))
+    return LandmarkStyle(list(groups.items()), thickness, shift)
+
+
+# layout of draw_landmark, used for the preprocessed training data
+DRAW_STYLE = make_style([
+    ((0, 128, 0), range(0, 17)),  # chin
+    ((220, 148, 0), range(17, 22)),  # left brow
+    ((220, 148, 0), range(22, 27)),  # right brow
+    ((165, 0, 0), list(range(36, 42)) + [36]),  # left eye
+    ((165, 0, 0), list(range(42, 48)) + [42]),  # right eye
+    ((0, 0, 165), list(range(27, 31)) + [33]),  # nose
+    ((0, 0, 165), range(31, 36)),  # nostrils
+    ((128, 0, 128), list(range(48, 60)) + [48]),  # mouth
+], thickness=2)
+
+# layout of the former matplotlib figures, used for finetuning and inference
+FIGURE_STYLE = make_style([
+    ((0, 128, 0), range(0, 17)),  # chin, green
+    ((255, 165, 0), range(17, 22)),  # left eyebrow, orange
+    ((255, 165, 0), range(22, 27)),  # right eyebrow, orange
+    ((0, 0, 255), range(27, 31)),  # nose, blue
+    ((0, 0, 255), range(31, 36)),  # nostrils, blue
+    ((255, 0, 0), range(36, 42)),  # left eye, red
+    ((255, 0, 0), range(42, 48)),  # right eye, red
+    ((128, 0, 128), range(48, 60)),  # outer lip, purple
+    ((255, 192, 203), range(60, 68)),  # inner lip, pink
+], thickness=2, shift=4)
+
+
+def rasterize_landmarks(landmarks, size, style=FIGURE_STYLE, canvas=None):
+    """Draw a batch of (N, 68, 2) landmarks, returns (N, H, W, 3) uint8 RGB images.
+
+    size is (H, W) or (H, W, 3). Lines are drawn on a white background unless
+    a (N, H, W, 3) uint8 canvas is given, which is drawn on in place.
+    """
+    landmarks = np.asarray(landmarks, dtype=np.float64)
+    if canvas is None:
+        canvas = np.full((len(landmarks), size[0], size[1], 3), 255, dtype=np.uint8)
+
+    # fixed point coordinates, truncated like np.int32 for shift=0
+    points = (landmarks * (1 << style.shift)).astype(np.int32)
+    for n in range(len(points)):
+        for color, segments in style.groups:
+            cv2.polylines(
+                canvas[n],
+                [points[n, indices] for indices in segments], False,
+                color, thickness=style.thickness, lineType=cv2.LINE_AA, shift=style.shift
+            )
+
+    return canvas
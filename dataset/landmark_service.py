@@ -0,0 +1,116 @@
+"""Landmark stage for training on raw videos.
+
+DataLoader workers only decode and sample frames (VidDataSet with detect_landmarks=False),
+a single thread runs the face alignment model on whole batches and builds the training samples.
+"""
+import queue
+import threading
+
+import face_alignment
+import numpy as np
+import torch
+
+from dataset.face_landmarks import detect_face, get_landmarks_batch
+from dataset.landmark_rasterizer import rasterize_landmarks, DRAW_STYLE
+from dataset.video_extraction_conversion import crop_to_landmarks
+
+STOP = None
+
+
+def collate_raw(batch):
+    # frames have the size of their video, they are kept as lists
+    frames, vid_idx, w_i = zip(*batch)
+    return list(frames), torch.tensor(vid_idx), torch.stack(w_i)
+
+
+class LandmarkService(object):
+    """Iterates over (f_lm, g_idx, vid_idx, W_i) batches like a DataLoader over the preprocessed datasets.
+
+    Samples with a frame without face are dropped and the batch is completed with the next ones,
+    so an epoch can have fewer batches than len(); each epoch reports how many were dropped.
+    """
+    def __init__(self, data_loader, device, batch_size, size=256, chunk=64, queue_size=4):
+        self.data_loader = data_loader
+        self.batch_size = batch_size
+        self.size = size
+        self.chunk = chunk
+        self.queue_size = queue_size
+        self.pin_memory = torch.cuda.is_available()
+        self.face_aligner = face_alignment.FaceAlignment(
+            face_alignment.LandmarksType._2D,
+            flip_input=False,
+            device=device
+        )
+        self.dropped = 0
+
+    def __len__(self):
+        """Batches of the inner loader, an upper bound: dropped samples make an epoch shorter"""
+        return len(self.data_loader)
+
+    def landmarks(self, frames):
+        """Landmarks of the first face of each frame, None without face"""
+        boxes = [detect_face(self.face_aligner, frame) for frame in frames]
+        valid = [j for j, box in enumerate(boxes) if box is not None]
+        landmarks = [None] * len(frames)
+        # bounded forwards of the landmark network
+        for start in range(0, len(valid), self.chunk):
+            ids = valid[start:start + self.chunk]
+            for j, lm in zip(ids, get_landmarks_batch(self.face_aligner, [frames[j] for j in ids],
+                                                      [boxes[j] for j in ids])):
+                landmarks[j] = lm
+        return landmarks
+
+    def make_sample(self, frames, landmarks):
+        cropped = [crop_to_landmarks(frame, lm, self.size) for frame, lm in zip(frames, landmarks)]
+        lmarks = rasterize_landmarks([lm for _, lm in cropped], (self.size, self.size), DRAW_STYLE)
+        frame_mark = np.stack((np.stack([frame for frame, _ in cropped]), lmarks), axis=1)  # K,2,256,256,3
+        return torch.from_numpy(frame_mark).permute([0, 1, 4, 2, 3])  # K,2,3,256,256
+
+    def make_batch(self, samples):
+        f_lm = torch.stack([sample[0] for sample in samples])
+        g_idx = torch.from_numpy(np.random.randint(low=0, high=f_lm.shape[1], size=(len(samples),)))
+        vid_idx = torch.stack([sample[1] for sample in samples])
+        w_i = torch.stack([sample[2] for sample in samples])
+        if self.pin_memory:
+            f_lm = f_lm.pin_memory()
+        return f_lm, g_idx, vid_idx, w_i
+
+    def run(self, out_q):
+        try:
+            samples = []
+            self.dropped = total = batches = 0
+            for frames, vid_idx, w_i in self.data_loader:
+                total += len(frames)
+                flat = [frame for sample_frames in frames for frame in sample_frames]
+                landmarks = self.landmarks(flat)
+                start = 0
+                for n, sample_frames in enumerate(frames):
+                    sample_landmarks = landmarks[start:start + len(sample_frames)]
+                    start += len(sample_frames)
+                    if any(lm is None for lm in sample_landmarks):
+                        self.dropped += 1
+                        continue
+                    samples.append((self.make_sample(sample_frames, sample_landmarks), vid_idx[n], w_i[n]))
+
+                while len(samples) >= self.batch_size:
+                    out_q.put(self.make_batch(samples[:self.batch_size]))
+                    samples = samples[self.batch_size:]
+                    batches += 1
+            print(f'Landmark service: {self.dropped} of {total} samples dropped without a face, '
+                  f'{batches} of at most {len(self)} batches')
+            out_q.put(STOP)
+        except Exception as e:
+            out_q.put(e)
+
+    def __iter__(self):
+        out_q = queue.Queue(maxsize=self.queue_size)
+        thread = threading.Thread(target=self.run, args=(out_q,), daemon=True)
+        thread.start()
+        while True:
+            item = out_q.get()
+            if item is STOP:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        thread.join()
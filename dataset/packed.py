@@ -0,0 +1,207 @@
+"""Packed shards: frames and landmarks of many videos in a few large append-only files.
+
+A shard directory holds:
+- frames.bin: JPEG encoded frames, back to back
+- frames_index.bin: int64 rows (offset, length, height, width) of each frame in frames.bin
+- landmarks.bin: float32 (68, 2) landmarks of each frame, in the same order
+- videos.bin: int64 rows (first frame, frame count) of each video
+- videos.txt: name of each video, one per line
+- rasters_<S>.bin: optional uint8 (S, S, 3) landmark images of each frame, see dataset/render_rasters.py
+
+videos.bin is written last, so a video only exists once all of its frames are on disk,
+and a writer reopening a shard drops whatever an interrupted run left after the last video.
+"""
+import argparse
+import glob
+import os
+
+import cv2
+import numpy as np
+
+FRAMES = 'frames.bin'
+FRAMES_INDEX = 'frames_index.bin'
+LANDMARKS = 'landmarks.bin'
+VIDEOS = 'videos.bin'
+VIDEO_NAMES = 'videos.txt'
+RASTERS = 'rasters_{}.bin'
+
+INDEX_COLS = 4
+LANDMARK_SHAPE = (68, 2)
+
+
+def encode_frame(rgb, quality=95):
+    """(jpeg bytes, height, width) of an RGB frame"""
+    ok, blob = cv2.imencode('.jpg', cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError('Can not encode frame')
+    return blob.tobytes(), rgb.shape[0], rgb.shape[1]
+
+
+def decode_frame(blob):
+    return cv2.cvtColor(cv2.imdecode(np.asarray(blob), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+
+def read_rows(path, cols, dtype=np.int64):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros((0, cols), dtype=dtype)
+    return np.fromfile(path, dtype=dtype).reshape(-1, cols)
+
+
+class PackedShardWriter(object):
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        os.makedirs(shard_dir, exist_ok=True)
+        self.recover()
+        self.files = {
+            name: open(os.path.join(shard_dir, name), 'ab')
+            for name in (FRAMES, FRAMES_INDEX, LANDMARKS, VIDEOS)
+        }
+        self.names = open(os.path.join(shard_dir, VIDEO_NAMES), 'a')
+
+    def path(self, name):
+        return os.path.join(self.shard_dir, name)
+
+    def recover(self):
+        """Truncate the data of an interrupted write, past the last complete video"""
+        videos = read_rows(self.path(VIDEOS), 2)
+        num_frames = int(videos[-1].sum()) if len(videos) else 0
+        index = read_rows(self.path(FRAMES_INDEX), INDEX_COLS)
+        frames_size = int(index[num_frames - 1, 0] + index[num_frames - 1, 1]) if num_frames else 0
+
+        names = []
+        if os.path.exists(self.path(VIDEO_NAMES)):
+            with open(self.path(VIDEO_NAMES)) as f:
+                names = f.read().splitlines()[:len(videos)]
+        with open(self.path(VIDEO_NAMES), 'w') as f:
+            f.writelines(name + '\n' for name in names)
+
+        landmark_size = int(np.prod(LANDMARK_SHAPE)) * 4
+        for name, size in ((FRAMES, frames_size), (FRAMES_INDEX, num_frames * INDEX_COLS * 8),
+                           (LANDMARKS, num_frames * landmark_size), (VIDEOS, len(videos) * 2 * 8)):
+            with open(self.path(name), 'ab') as f:
+                f.truncate(size)
+
+        self.num_frames = num_frames
+        self.frames_size = frames_size
+
+    def add_video(self, name, frames, landmarks):
+        """Append a video. frames are encode_frame tuples, landmarks is (N, 68, 2)"""
+        if len(frames) != len(landmarks):
+            raise ValueError(f'{name}: {len(frames)} frames but {len(landmarks)} landmarks')
+
+        index = np.zeros((len(frames), INDEX_COLS), dtype=np.int64)
+        for i, (blob, h, w) in enumerate(frames):
+            index[i] = self.frames_size, len(blob), h, w
+            self.files[FRAMES].write(blob)
+            self.frames_size += len(blob)
+        self.files[FRAMES_INDEX].write(index.tobytes())
+        self.files[LANDMARKS].write(np.asarray(landmarks, dtype=np.float32).tobytes())
+        for key in (FRAMES, FRAMES_INDEX, LANDMARKS):
+            self.files[key].flush()
+
+        self.names.write(name + '\n')
+        self.names.flush()
+        self.files[VIDEOS].write(np.array([self.num_frames, len(frames)], dtype=np.int64).tobytes())
+        self.files[VIDEOS].flush()
+        self.num_frames += len(frames)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.names.close()
+
+
+class PackedShard(object):
+    """Read side of a shard. Memory maps are opened lazily, so a shard can be sent to DataLoader workers."""
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.videos = read_rows(os.path.join(shard_dir, VIDEOS), 2)
+        with open(os.path.join(shard_dir, VIDEO_NAMES)) as f:
+            self.names = f.read().splitlines()[:len(self.videos)]
+        self.frames = None
+        self.index = None
+        self.landmarks = None
+        self.rasters = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(frames=None, index=None, landmarks=None, rasters={})
+        return state
+
+    @property
+    def num_frames(self):
+        return int(self.videos[-1].sum()) if len(self.videos) else 0
+
+    def open(self):
+        if self.frames is not None:
+            return
+        num_frames = self.num_frames
+        self.index = np.memmap(os.path.join(self.shard_dir, FRAMES_INDEX), dtype=np.int64, mode='r',
+                               shape=(num_frames, INDEX_COLS))
+        self.landmarks = np.memmap(os.path.join(self.shard_dir, LANDMARKS), dtype=np.float32, mode='r',
+                                   shape=(num_frames,) + LANDMARK_SHAPE)
+        frames_size = int(self.index[-1, 0] + self.index[-1, 1]) if num_frames else 0
+        self.frames = np.memmap(os.path.join(self.shard_dir, FRAMES), dtype=np.uint8, mode='r',
+                                shape=(frames_size,))
+
+    def __len__(self):
+        return len(self.videos)
+
+    def read_frame(self, frame_idx):
+        """RGB frame and its landmarks, by shard frame index"""
+        self.open()
+        offset, length = self.index[frame_idx, :2]
+        return decode_frame(self.frames[offset:offset + length]), np.array(self.landmarks[frame_idx])
+
+    def open_rasters(self, size):
+        """(N, size, size, 3) memory map of the rendered landmark images, N may be less than the frames"""
+        if size not in self.rasters:
+            path = os.path.join(self.shard_dir, RASTERS.format(size))
+            count = os.path.getsize(path) // (size * size * 3) if os.path.exists(path) else 0
+            self.rasters[size] = np.memmap(path, dtype=np.uint8, mode='r', shape=(count, size, size, 3)) \
+                if count else np.zeros((0, size, size, 3), dtype=np.uint8)
+        return self.rasters[size]
+
+    def read_rasters(self, frame_ids, size):
+        """Landmark images of frame_ids, None unless all of them are rendered"""
+        rasters = self.open_rasters(size)
+        if np.max(frame_ids) >= len(rasters):
+            return None
+        return rasters[frame_ids]
+
+
+def find_shards(path_to_packed):
+    return sorted(glob.glob(os.path.join(path_to_packed, 'shard-*')))
+
+
+def convert(path_to_preprocess, shard_dir):
+    """Pack a preprocess.py output directory (person/video/00000.jpg + landmarks.npy)"""
+    writer = PackedShardWriter(shard_dir)
+    done = set(PackedShard(shard_dir).names)
+    for video_dir in sorted(glob.glob(os.path.join(path_to_preprocess, '*/*'))):
+        name = os.path.relpath(video_dir, path_to_preprocess)
+        lm_path = os.path.join(video_dir, 'landmarks.npy')
+        if name in done or not os.path.exists(lm_path):
+            continue
+        landmarks = np.load(lm_path)
+        jpg_paths = sorted(glob.glob(os.path.join(video_dir, '*.jpg')))
+        if len(jpg_paths) != len(landmarks) or len(jpg_paths) == 0:
+            print(f'Skip incomplete {video_dir}')
+            continue
+        frames = []
+        for path in jpg_paths:
+            with open(path, 'rb') as f:
+                blob = f.read()
+            h, w = cv2.imdecode(np.frombuffer(blob, np.uint8), cv2.IMREAD_UNCHANGED).shape[:2]
+            frames.append((blob, h, w))
+        writer.add_video(name, frames, landmarks)
+        print(f'Packed {name}: {len(frames)} frames')
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert preprocessed video dirs to a packed shard')
+    parser.add_argument('--input', help='preprocess.py output directory')
+    parser.add_argument('--output', help='shard directory, e.g. <packed dir>/shard-0')
+    args = parser.parse_args()
+    convert(args.input, args.output)
@@ -1,32 +1,43 @@
 import argparse
 import glob
+import multiprocessing as mp
 import queue
 import os
 import sys
 import threading
 import time
+import zlib
 
 import cv2
 import face_alignment
 import numpy as np
 import torch
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--data-dir')
-parser.add_argument('--output')
-parser.add_argument('--threads', type=int, default=1)
-parser.add_argument('--reverse', action='store_true')
-parser.add_argument('--start-percent', type=float, default=0.0)
-parser.add_argument('--split-each-video', action='store_true')
-
-args = parser.parse_args()
-
-path_to_mp4 = args.data_dir
-device = torch.device('cuda:0')
-saves_dir = args.output
-
-if not os.path.isdir(saves_dir):
-    os.mkdir(saves_dir)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset.face_landmarks import LandmarkTracker
+from dataset.packed import PackedShardWriter, encode_frame
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir')
+    parser.add_argument('--output')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--reverse', action='store_true')
+    parser.add_argument('--start-percent', type=float, default=0.0)
+    parser.add_argument('--split-each-video', action='store_true')
+    parser.add_argument('--detect-interval', type=int, default=1,
+                        help='run the face detector every N frames and track the face in between')
+    parser.add_argument('--batch-size', type=int, default=16, help='max frames per landmark network forward')
+    parser.add_argument('--max-wait', type=float, default=0.05,
+                        help='max seconds to wait for a landmark batch to fill up')
+    parser.add_argument('--shard', default='0/1',
+                        help='i/N: process only the i-th of N deterministic shards of the video dirs')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='worker processes, each with its own decoder and landmark model')
+    parser.add_argument('--packed', action='store_true',
+                        help='write packed shards to <output>/packed instead of a jpg file per frame')
+
+    return parser.parse_args()
 
 
 def print_fun(s):
@@ -34,46 +45,40 @@ def print_fun(s):
     sys.stdout.flush()
 
 
-def generate_landmarks(frame, face_aligner):
-    input = frame
-    preds = face_aligner.get_landmarks(input)[0]
-
-    return preds
-
-
-def process_images(video_dir, lm_queue: queue.Queue, out_dir, split_video=False):
-    videos = sorted([os.path.join(video_dir, v) for v in os.listdir(video_dir)])
-
-    # First check
+def is_processed(video_dir, out_dir):
+    # Slow check of outputs written without a manifest
     new_video_dir = get_new_video_dir(os.path.join(video_dir, 'dummy'), out_dir, create=False)
     if os.path.exists(os.path.join(new_video_dir, 'landmarks.npy')):
         jpgs = glob.glob(new_video_dir + '/*.jpg')
         lm = np.load(new_video_dir + '/landmarks.npy')
-        if len(lm) == len(jpgs):
-            print_fun(f'Skip already processed {video_dir}...')
-            return
-        else:
-            print_fun(f'Re-process {video_dir}...')
+        return len(lm) == len(jpgs)
+    return False
+
+
+def process_images(video_dir, lm_queue, out_dir, split_video=False, done_key=None):
+    videos = sorted([os.path.join(video_dir, v) for v in os.listdir(video_dir)])
+    if not videos:
+        return
 
     for video_i, video_path in enumerate(videos):
         print_fun(f'Process {video_path}...')
         cap = cv2.VideoCapture(video_path)
-        frame_id = 0
-        frame_num = cap.get(cv2.CAP_PROP_FRAME_COUNT)
 
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
+        # one frame ahead, CAP_PROP_FRAME_COUNT is only an estimate and the last frame must be flagged
+        ret, frame = cap.read()
+        while ret:
             rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame_id += 1
+            ret, frame = cap.read()
 
+            file_last = not ret
             if split_video:
-                last = frame_id == frame_num
+                last = file_last
             else:
-                last = frame_id == frame_num and video_i == len(videos) - 1
+                last = file_last and video_i == len(videos) - 1
+            # the manifest key goes with the very last frame of the dir
+            dir_done = done_key if file_last and video_i == len(videos) - 1 else None
 
-            lm_queue.put((rgb, video_path, last))
+            lm_queue.put((rgb, video_path, last, file_last, dir_done))
 
         cap.release()
 
@@ -90,82 +95,171 @@ def get_new_video_dir(video_path, output_dir, split_video=False, create=True):
     return new_dir
 
 
+class Manifest(object):
+    """Append-only log of the source video dirs whose output is complete.
+
+    Each process appends to its own file in manifest_dir, all of them are read on startup
+    so that a restarted run skips finished dirs without listing their outputs.
+    """
+    def __init__(self, manifest_dir, name):
+        os.makedirs(manifest_dir, exist_ok=True)
+        self.path = os.path.join(manifest_dir, f'{name}.log')
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, 'rb+') as f:
+                data = f.read()
+                if data and not data.endswith(b'\n'):
+                    # drop a line torn by a crash, the next key would continue it
+                    f.truncate(data.rfind(b'\n') + 1)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    @staticmethod
+    def load(manifest_dir):
+        done = set()
+        if not os.path.isdir(manifest_dir):
+            return done
+        for name in os.listdir(manifest_dir):
+            with open(os.path.join(manifest_dir, name)) as f:
+                # keys end with a newline once they are on disk, a line without one was torn by a crash
+                done.update(f.read().split('\n')[:-1])
+        return done
+
+    def add(self, key):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(key + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+
 class LandmarksQueue(object):
-    def __init__(self, q: queue.Queue, root_dir, threads=1, split_video=False):
-        self.landmarks = []
-        self.q = q
+    """Landmarks of queued frames in threads, then frames and landmarks saved by one more thread.
+
+    All frames of an output video dir go to the same landmark thread, so they are handled in order
+    and the dir is complete when its last frame is.
+    """
+    def __init__(self, root_dir, threads=1, split_video=False, detect_interval=1,
+                 batch_size=16, max_wait=0.05, device='cuda:0', manifest=None, packer=None, maxsize=300):
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(threads)]
+        self.batch_size = batch_size
+        self.max_wait = max_wait
         self.split_video = split_video
         self.root_dir = root_dir
-        self.save_q = queue.Queue(maxsize=q.maxsize)
-        self.lm = queue.Queue(maxsize=q.maxsize)
-        self.face_aligner = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, device='cuda:0')
+        self.manifest = manifest
+        # PackedShardWriter, encoded frames are kept per video dir until its landmarks come
+        self.packer = packer
+        self.packed_frames = {}
+        # frames and landmarks of a video go through the same queue, so a video is written
+        # completely before it is recorded in the manifest
+        self.save_q = queue.Queue(maxsize=maxsize)
+        self.face_aligner = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, device=device)
+        self.tracker = LandmarkTracker(self.face_aligner, detect_interval=detect_interval)
         # Dry run
         print_fun('Face alignment dry run...')
         self.face_aligner.get_landmarks(np.random.randint(0, 255, size=(256, 256, 3)))
         self.face_aligner.face_alignment_net(
-            torch.from_numpy(np.random.randint(0, 255, size=(1, 3, 256, 256))).float().div(255.).to(torch.device('cuda'))
+            torch.from_numpy(np.random.randint(0, 255, size=(1, 3, 256, 256))).float().div(255.).to(torch.device(device))
         )[-1].detach().cpu()
         print_fun('Done.')
 
-        self.save_frame_id = 0
+        # landmarks and next frame id of each output video dir in progress
+        self.videos = {}
         self.lock = threading.Lock()
         self.num_threads = threads
         self.threads = []
+        self.start = time.time()
+
+    def put(self, item):
+        video_dir = get_new_video_dir(item[1], self.root_dir, self.split_video, create=False)
+        self.queues[zlib.crc32(video_dir.encode()) % self.num_threads].put(item)
 
     def start_process(self):
-        for i in range(self.num_threads):
-            t = threading.Thread(target=self.process_lm, daemon=True)
+        for q in self.queues:
+            t = threading.Thread(target=self.process_lm, args=(q,), daemon=True)
             t.start()
             self.threads.append(t)
         t = threading.Thread(target=self.process_save, daemon=True)
         t.start()
         self.threads.append(t)
-        t = threading.Thread(target=self.save_landmarks, daemon=True)
-        t.start()
-        self.threads.append(t)
 
-    def save_landmarks(self):
-        while True:
-            item = self.lm.get()
-            if isinstance(item, str):
-                if item == 'stop':
-                    break
+    def save_landmarks(self, lmarks, save_path, done_key):
+        if lmarks is not None:
+            print_fun(f'Processed {len(lmarks)} landmarks: {time.time() - self.start} '
+                      f'(face detection on {self.tracker.detections}/{self.tracker.frames} frames)')
+            self.start = time.time()
+
+            if self.packer is not None:
+                video_dir = os.path.dirname(save_path)
+                print_fun(f'pack {video_dir}')
+                self.packer.add_video(
+                    os.path.relpath(video_dir, self.root_dir), self.packed_frames.pop(video_dir), lmarks
+                )
             else:
-                lmarks = item[0]
-                save_path = item[1]
-                print_fun(f'Processed {len(lmarks)} landmarks: {time.time() - self.start}')
-                self.start = time.time()
-
                 print_fun(f'save {save_path}')
                 np.save(save_path, lmarks)
+        if done_key is not None and self.manifest is not None:
+            self.manifest.add(done_key)
+
+    def next_batch(self, q):
+        """Up to batch_size queued frames, waiting at most max_wait after the first one. None on stop."""
+        item = q.get()
+        if isinstance(item, str):
+            return None
+        batch = [item]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = q.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if isinstance(item, str):
+                # handled on the next call, after this batch
+                q.put(item)
+                break
+            batch.append(item)
+        return batch
 
-    def process_lm(self):
+    def process_lm(self, q):
         self.start = time.time()
         while True:
-            item = self.q.get()
-            if isinstance(item, str):
-                if item == 'stop':
-                    break
+            batch = self.next_batch(q)
+            if batch is None:
+                break
+            try:
+                landmarks = self.tracker.get_landmarks_batch(
+                    [item[0] for item in batch], [item[1] for item in batch]
+                )
+            except Exception as e:
+                print_fun(e)
+                landmarks = [None] * len(batch)
+
+            for item, landmark in zip(batch, landmarks):
+                self.emit(item, None if landmark is None else landmark[0])
+                if item[3]:
+                    # end of this video file
+                    self.tracker.reset(item[1])
+
+    def emit(self, item, landmark):
+        frame, video_path, last, done_key = item[0], item[1], item[2], item[4]
+        video_dir = get_new_video_dir(video_path, self.root_dir, self.split_video, create=self.packer is None)
+        with self.lock:
+            video = self.videos.setdefault(video_dir, {'landmarks': [], 'frame_id': 0})
+            if landmark is not None:
+                cropped_frame, recomputed_landmark = self.crop_landmark(frame, landmark)
+                video['landmarks'].append(recomputed_landmark)
+                self.save_q.put(('frame', cropped_frame, video_dir, video['frame_id']))
+                video['frame_id'] += 1
             else:
-                frame = item[0]
-                video_dir = get_new_video_dir(item[1], self.root_dir, self.split_video)
-                last = item[2]
-                try:
-                    landmark = generate_landmarks(frame, self.face_aligner)
-                except Exception as e:
-                    print_fun(e)
-                    continue
-
-                with self.lock:
-                    cropped_frame, recomputed_landmark = self.crop_landmark(frame, landmark)
-                    self.landmarks.append(recomputed_landmark)
-                    self.save_q.put((cropped_frame, video_dir, self.save_frame_id))
-                    self.save_frame_id += 1
-                    if last:
-                        save_path = os.path.join(video_dir, 'landmarks.npy')
-                        self.lm.put((np.stack(self.landmarks).copy(), save_path))
-                        self.landmarks = []
-                        self.save_frame_id = 0
+                print_fun(f'No face in frame of {video_path}')
+            if last:
+                del self.videos[video_dir]
+                lmarks = np.stack(video['landmarks']).copy() if video['landmarks'] else None
+                save_path = os.path.join(video_dir, 'landmarks.npy')
+                self.save_q.put(('landmarks', lmarks, save_path, done_key))
 
     @staticmethod
     def crop_landmark(frame, landmark):
@@ -190,44 +284,119 @@ class LandmarksQueue(object):
             if isinstance(item, str):
                 if item == 'stop':
                     break
+            elif item[0] == 'landmarks':
+                self.save_landmarks(*item[1:])
+            elif self.packer is not None:
+                self.packed_frames.setdefault(item[2], []).append(encode_frame(item[1]))
             else:
-                bgr = cv2.cvtColor(item[0], cv2.COLOR_RGB2BGR)
-                video_dir = item[1]
-                frame_id = item[2]
+                bgr = cv2.cvtColor(item[1], cv2.COLOR_RGB2BGR)
+                video_dir = item[2]
+                frame_id = item[3]
                 cv2.imwrite(os.path.join(video_dir, f'{frame_id:05d}.jpg'), bgr)
 
     def stop(self):
-        for i in range(self.num_threads):
-            self.q.put('stop')
-        while not self.q.empty():
-            time.sleep(0.1)
+        for q in self.queues:
+            q.put('stop')
+        # landmark threads first, they may still feed the save queue
+        for t in self.threads[:self.num_threads]:
+            t.join()
 
+        # no timeout: pending items must reach the disk and the manifest
         self.save_q.put('stop')
-        self.lm.put('stop')
-        for t in self.threads:
-            t.join(10)
-
-
-video_paths = glob.glob(os.path.join(path_to_mp4, '**/*'))
-if args.reverse:
-    video_paths.reverse()
-
-start_index = 0
-if args.start_percent > 0:
-    start_index = int(len(video_paths) * args.start_percent)
-
-lm_queue = queue.Queue(maxsize=300)
-landmarks_queue = LandmarksQueue(lm_queue, args.output, threads=args.threads, split_video=args.split_each_video)
-landmarks_queue.start_process()
-
-print_fun(f'Number of videos: {len(video_paths)}')
-for i, video_dir in enumerate(video_paths):
-    if i < start_index:
-        continue
-    print_fun(f'[{i}/{len(video_paths)}] Process dir {video_dir}')
-    process_images(video_dir, lm_queue, args.output, split_video=args.split_each_video)
-
-print_fun('Done.')
-print_fun('Waiting stop threads...')
-landmarks_queue.stop()
-print_fun('Done.')
+        for t in self.threads[self.num_threads:]:
+            t.join()
+        if self.packer is not None:
+            self.packer.close()
+
+
+def get_shard(video_dirs, shard):
+    """Deterministic i-th of N shards (shard is 'i/N') of the video dirs"""
+    i, n = (int(v) for v in shard.split('/'))
+    if not 0 <= i < n:
+        raise ValueError(f'Invalid shard {shard}, expected i/N with 0 <= i < N')
+    return sorted(video_dirs)[i::n]
+
+
+def run_worker(worker_id, video_dirs, args):
+    """Preprocess video_dirs with one decoder and one landmark model"""
+    if torch.cuda.is_available():
+        device = f'cuda:{worker_id % torch.cuda.device_count()}'
+    else:
+        device = 'cpu'
+    shard_i, shard_n = args.shard.split('/')
+    name = f'shard-{shard_i}-of-{shard_n}-{worker_id}'
+    manifest = Manifest(os.path.join(args.output, 'manifest'), name)
+    # one shard per worker, never appended to by two processes
+    packer = PackedShardWriter(os.path.join(args.output, 'packed', name)) if args.packed else None
+
+    landmarks_queue = LandmarksQueue(
+        args.output, threads=args.threads,
+        split_video=args.split_each_video, detect_interval=args.detect_interval,
+        batch_size=args.batch_size, max_wait=args.max_wait, device=device,
+        manifest=manifest, packer=packer
+    )
+    landmarks_queue.start_process()
+
+    for i, video_dir in enumerate(video_dirs):
+        print_fun(f'[{worker_id}] [{i}/{len(video_dirs)}] Process dir {video_dir}')
+        done_key = os.path.relpath(video_dir, args.data_dir)
+        process_images(video_dir, landmarks_queue, args.output, split_video=args.split_each_video, done_key=done_key)
+
+    print_fun(f'[{worker_id}] Waiting stop threads...')
+    landmarks_queue.stop()
+    print_fun(f'[{worker_id}] Done.')
+
+
+def main():
+    args = parse_args()
+
+    video_paths = get_shard(glob.glob(os.path.join(args.data_dir, '**/*')), args.shard)
+    if args.reverse:
+        video_paths.reverse()
+
+    start_index = 0
+    if args.start_percent > 0:
+        start_index = int(len(video_paths) * args.start_percent)
+    video_paths = video_paths[start_index:]
+
+    manifest_dir = os.path.join(args.output, 'manifest')
+    done = Manifest.load(manifest_dir)
+    # outputs of runs without a manifest are checked once, then recorded in it
+    existing = None
+    todo = []
+    for video_dir in video_paths:
+        key = os.path.relpath(video_dir, args.data_dir)
+        if key in done:
+            continue
+        if is_processed(video_dir, args.output):
+            print_fun(f'Skip already processed {video_dir}...')
+            if existing is None:
+                existing = Manifest(manifest_dir, 'existing')
+            existing.add(key)
+            continue
+        todo.append(video_dir)
+    print_fun(f'Number of videos: {len(video_paths)}, already processed: {len(video_paths) - len(todo)}')
+
+    if args.processes <= 1:
+        run_worker(0, todo, args)
+        return
+
+    # spawn: CUDA can not be used in forked processes
+    ctx = mp.get_context('spawn')
+    workers = [
+        ctx.Process(target=run_worker, args=(p, todo[p::args.processes], args))
+        for p in range(args.processes)
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    failed = [p for p, w in enumerate(workers) if w.exitcode != 0]
+    if failed:
+        print_fun(f'Workers {failed} failed, re-run to resume their dirs')
+        sys.exit(1)
+    print_fun('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Render the landmark images of preprocessed data once, at the training frame shape.
+
+PreprocessDataset and PackedDataset read them instead of drawing K landmark images per sample.
+"""
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset.dataset_class import PreprocessDataset, scale_landmarks
+from dataset.landmark_rasterizer import DRAW_STYLE, rasterize_landmarks
+from dataset.packed import PackedShard, RASTERS, find_shards
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--preprocessed', help='preprocess.py output directory')
+parser.add_argument('--packed', help='directory of packed shards')
+parser.add_argument('--frame-shape', default=256, type=int)
+parser.add_argument('--chunk', default=256, type=int, help='frames rendered per write')
+
+
+def print_fun(s):
+    print(s)
+    sys.stdout.flush()
+
+
+def render(landmarks, sizes, frame_shape):
+    """Landmark images at frame_shape, exactly as the datasets draw them on the fly"""
+    scaled = [scale_landmarks(lm, h, w, frame_shape) for lm, (h, w) in zip(landmarks, sizes)]
+    return rasterize_landmarks(scaled, (frame_shape, frame_shape), DRAW_STYLE)
+
+
+def render_preprocessed(path_to_preprocess, frame_shape, chunk):
+    # builds the index if there is none yet
+    dataset = PreprocessDataset(1, path_to_preprocess, None, frame_shape=frame_shape, use_rasters=False)
+    landmarks = np.load(dataset.landmarks_path, mmap_mode='r')
+    num_frames = len(dataset.frame_names)
+
+    path = os.path.join(path_to_preprocess, PreprocessDataset.RASTERS.format(frame_shape))
+    with open(path + '.tmp', 'wb') as f:
+        rasters = np.lib.format.open_memmap(f.name, mode='w+', dtype=np.uint8,
+                                            shape=(num_frames, frame_shape, frame_shape, 3))
+    for video_dir, start, count in zip(dataset.video_dirs, dataset.offsets, dataset.counts):
+        # frames are only decoded for their size, the index does not keep it
+        sizes = [
+            cv2.imread(os.path.join(path_to_preprocess, video_dir, name)).shape[:2]
+            for name in dataset.frame_names[start:start + count]
+        ]
+        for i in range(0, count, chunk):
+            end = min(i + chunk, count)
+            rasters[start + i:start + end] = render(landmarks[start + i:start + end], sizes[i:end], frame_shape)
+        print_fun(f'Rendered {video_dir}: {count} frames')
+    rasters.flush()
+    del rasters
+    os.replace(path + '.tmp', path)
+
+
+def render_packed(path_to_packed, frame_shape, chunk):
+    for shard_dir in find_shards(path_to_packed):
+        shard = PackedShard(shard_dir)
+        shard.open()
+        path = os.path.join(shard_dir, RASTERS.format(frame_shape))
+        # append only the frames packed since the last run
+        row_size = frame_shape * frame_shape * 3
+        done = os.path.getsize(path) // row_size if os.path.exists(path) else 0
+        with open(path, 'ab') as f:
+            f.truncate(done * row_size)
+            for start in range(done, shard.num_frames, chunk):
+                end = min(start + chunk, shard.num_frames)
+                sizes = shard.index[start:end, 2:4]
+                f.write(render(shard.landmarks[start:end], sizes, frame_shape).tobytes())
+        print_fun(f'Rendered {shard_dir}: {shard.num_frames - done} new frames')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.packed:
+        render_packed(args.packed, args.frame_shape, args.chunk)
+    if args.preprocessed:
+        render_preprocessed(args.preprocessed, args.frame_shape, args.chunk)
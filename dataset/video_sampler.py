@@ -0,0 +1,182 @@
+"""Random access to video frames, planned with a keyframe index.
+
+Seeking (cv2.CAP_PROP_POS_FRAMES) decodes again from the keyframe before the target,
+so for K sorted frames it is often cheaper to keep grabbing forward from the current position.
+The keyframe index comes from the container with PyAV. Reading it demuxes the whole file once
+(packets only, nothing is decoded), so it is kept in memory and in cache_dir when one is given.
+Without PyAV, or when the index can not be read, frames are read forward from the start.
+"""
+import hashlib
+import os
+import random
+import threading
+import time
+
+import cv2
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+def read_keyframes(video_path):
+    """Presentation order indices of the keyframes of the first video stream, from packets only (no decoding)"""
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        pts, keys = [], []
+        for packet in container.demux(stream):
+            if packet.pts is None:
+                continue
+            pts.append(packet.pts)
+            keys.append(packet.is_keyframe)
+    order = np.argsort(pts, kind='stable')
+    return np.flatnonzero(np.array(keys, dtype=bool)[order])
+
+
+class DecodeStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.videos = 0
+        self.frames = 0
+        self.decoded = 0
+        self.seeks = 0
+        self.seconds = 0.0
+
+    def add(self, frames, decoded, seeks, seconds):
+        with self.lock:
+            self.videos += 1
+            self.frames += frames
+            self.decoded += decoded
+            self.seeks += seeks
+            self.seconds += seconds
+
+    def __getstate__(self):
+        # DataLoader workers started with spawn pickle the dataset, and its sampler, but not a lock
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        per_frame = self.seconds / self.frames * 1000 if self.frames else 0.0
+        return (f'{self.videos} videos, {self.frames} frames: {self.decoded} decoded, {self.seeks} seeks, '
+                f'{self.seconds:.1f}s ({per_frame:.1f}ms per frame)')
+
+
+class VideoSampler(object):
+    """Reads sets of frames of a video with as few decoded frames as the keyframe index allows.
+
+    Keyframe indices are cached in memory, and in cache_dir when it is given.
+    seek_cost is the cost of a seek in decoded frames.
+    """
+    def __init__(self, cache_dir=None, seek_cost=2, max_cached=10000):
+        self.cache_dir = cache_dir
+        self.warned = False
+        self.seek_cost = seek_cost
+        self.max_cached = max_cached
+        self.cache = {}
+        self.stats = DecodeStats()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def keyframes(self, video_path):
+        st = os.stat(video_path)
+        key = (video_path, st.st_size, st.st_mtime)
+        keyframes = self.cache.get(key)
+        if keyframes is not None:
+            return keyframes
+
+        cache_path = None
+        if self.cache_dir is not None:
+            name = hashlib.md5(repr(key).encode()).hexdigest()
+            cache_path = os.path.join(self.cache_dir, f'{name}.npy')
+        if cache_path is not None and os.path.exists(cache_path):
+            keyframes = np.load(cache_path)
+        else:
+            keyframes = None
+            if av is None and not self.warned:
+                print('PyAV is not installed, video frames are read without seeking')
+                self.warned = True
+            elif av is not None:
+                try:
+                    keyframes = read_keyframes(video_path)
+                except Exception as e:
+                    print(f'Can not index keyframes of {video_path}: {e}')
+            if keyframes is None or len(keyframes) == 0 or keyframes[0] != 0:
+                # a single keyframe at 0, the plan never seeks
+                keyframes = np.zeros(1, dtype=np.int64)
+            elif cache_path is not None:
+                # only real indices are worth keeping
+                np.save(cache_path, keyframes)
+
+        if len(self.cache) >= self.max_cached:
+            self.cache.clear()
+        self.cache[key] = keyframes
+        return keyframes
+
+    def plan(self, targets, keyframes):
+        """(frame index, seek before reading it) for sorted unique targets, read from frame 0"""
+        plan = []
+        pos = 0
+        for target in targets:
+            keyframe = keyframes[np.searchsorted(keyframes, target, side='right') - 1]
+            # forward decodes target - pos frames, a seek decodes target - keyframe
+            seek = keyframe > pos and target - keyframe + self.seek_cost < target - pos
+            plan.append((target, seek))
+            pos = target + 1
+        return plan
+
+    def read(self, video_path, frame_ids):
+        """RGB frames at frame_ids, in sorted order. Stops at the first frame that can not be read."""
+        return self.read_capture(cv2.VideoCapture(video_path), video_path, frame_ids, time.time())
+
+    def sample(self, video_path, K):
+        """K random frames (with repetition), sorted like select_frames"""
+        start = time.time()
+        cap = cv2.VideoCapture(video_path)
+        n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        frame_ids = [random.randint(0, n_frames - 1) for _ in range(K)]
+        return self.read_capture(cap, video_path, frame_ids, start)
+
+    def read_capture(self, cap, video_path, frame_ids, start):
+        targets = np.unique(frame_ids)
+        keyframes = self.keyframes(video_path)
+
+        frames = {}
+        pos = 0
+        decoded = seeks = 0
+        for target, seek in self.plan(targets, keyframes):
+            if seek:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, int(target))
+                decoded += target - keyframes[np.searchsorted(keyframes, target, side='right') - 1]
+                seeks += 1
+                pos = target
+            ok = True
+            while pos < target and ok:
+                # grab decodes without the conversion to BGR
+                ok = cap.grab()
+                pos += 1
+                decoded += 1
+            ret, frame = cap.read() if ok else (False, None)
+            if not ret:
+                break
+            pos += 1
+            decoded += 1
+            frames[target] = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        cap.release()
+
+        frames_list = []
+        for frame_id in sorted(frame_ids):
+            if frame_id not in frames:
+                break
+            frames_list.append(frames[frame_id])
+        self.stats.add(len(frames_list), int(decoded), seeks, time.time() - start)
+        return frames_list
+
+
+default_sampler = VideoSampler()
@@ -4,6 +4,7 @@ import argparse
 import torch
 
 from dataset.video_extraction_conversion import select_frames, generate_landmarks
+from dataset.video_sampler import default_sampler
 from network.blocks import *
 from network.model import Embedder
 import face_alignment
@@ -40,6 +41,7 @@ def main():
     """Loading Embedder input"""
     print("Select frames...")
     frame_mark_video = select_frames(path_to_video, T)
+    print(f"Decoded {default_sampler.stats}")
     print("Generate landmarks...")
     frame_mark_video = generate_landmarks(frame_mark_video, face_aligner, size=frame_size)
     frame_mark_video = torch.from_numpy(np.array(frame_mark_video)).type(dtype=torch.float)  # T,2,256,256,3
@@ -51,6 +53,8 @@ def main():
 
     """Loading from past checkpoint"""
     checkpoint = torch.load(args.model, map_location=cpu)
+    if checkpoint.get('spectral_norm_baked'):
+        remove_spectral_norms(E)
     E.load_state_dict(checkpoint['E_state_dict'])
 
     """Inference"""
@@ -0,0 +1,44 @@
+"""Export a lean inference checkpoint with spectral norms baked into plain conv weights"""
+import argparse
+
+import torch
+
+from network.blocks import remove_spectral_norms
+from network.model import Embedder, Generator
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='training or finetuned checkpoint')
+    parser.add_argument('--output')
+    parser.add_argument('--frame-size', type=int, default=224)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cpu = torch.device('cpu')
+
+    checkpoint = torch.load(args.model, map_location=cpu)
+    exported = {'spectral_norm_baked': True}
+
+    G = Generator(args.frame_size)
+    G.load_state_dict(checkpoint['G_state_dict'])
+    G.eval()
+    exported['G_state_dict'] = remove_spectral_norms(G).state_dict()
+
+    # finetuned checkpoints have no embedder
+    if 'E_state_dict' in checkpoint:
+        E = Embedder(args.frame_size)
+        E.load_state_dict(checkpoint['E_state_dict'])
+        E.eval()
+        exported['E_state_dict'] = remove_spectral_norms(E).state_dict()
+
+    print('Saving baked model...')
+    torch.save(exported, args.output)
+    print('...Done saving')
+
+
+if __name__ == '__main__':
+    main()
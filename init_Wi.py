@@ -71,9 +71,9 @@ with torch.no_grad():
             i_batch_current = 0
             pbar = tqdm(dataLoader, leave=True, initial=0)
         pbar.set_postfix(epoch=epoch)
-        for i_batch, (f_lm, x, g_y, i, W_i) in enumerate(pbar, start=0):
+        for i_batch, (f_lm, g_idx, i, W_i) in enumerate(pbar, start=0):
             
-            f_lm = f_lm.to(device)
+            f_lm = f_lm.to(device, non_blocking=True).float().div_(255)
             
             #zero the parameter gradients
             
@@ -3,15 +3,32 @@ import torch.nn as nn
 import imp
 import torchvision
 from torchvision.models import vgg19
-from network import model
 from network.model import Cropped_VGG19
 
 
+class VGG19Features(nn.Module):
+    """torchvision VGG19 cut after relu5_1, returns the relu1_1, relu2_1, relu3_1, relu4_1 and relu5_1 maps"""
+    # features indices, the former hook indices 2, 7, 12, 21, 30 also counted features itself as module 0
+    taps = (1, 6, 11, 20, 29)
+
+    def __init__(self, vgg):
+        super(VGG19Features, self).__init__()
+        self.features = vgg.features[:self.taps[-1] + 1]
+
+    def forward(self, x):
+        out = []
+        for i, m in enumerate(self.features):
+            x = m(x)
+            if i in self.taps:
+                out.append(x)
+        return out
+
+
 class LossCnt(nn.Module):
     def __init__(self, VGGFace_body_path, VGGFace_weight_path, device):
         super(LossCnt, self).__init__()
 
-        self.VGG19 = vgg19(pretrained=True)
+        self.VGG19 = VGG19Features(vgg19(pretrained=True))
         self.VGG19.eval()
         self.VGG19.to(device)
 
@@ -23,87 +40,25 @@ class LossCnt(nn.Module):
         self.VGGFace.eval()
         self.VGGFace.to(device)
 
-        self.l1_loss = nn.L1Loss()
-        self.conv_idx_list = [2, 7, 12, 21, 30]  # idxes of conv layers in VGG19 cf.paper
+        # fixed feature extractors, only x_hat needs a gradient
+        self.VGG19.requires_grad_(False)
+        self.VGGFace.requires_grad_(False)
 
-    def forward(self, x, x_hat, vgg19_weight=1.5e-1, vggface_weight=2.5e-2):
-        """Retrieve vggface feature maps"""
-        with torch.no_grad():  # no need for gradient compute
-            vgg_x_features = self.VGGFace(x)  # returns a list of feature maps at desired layers
+        self.l1_loss = nn.L1Loss()
 
+    def feature_loss(self, net, x, x_hat):
+        # x and x_hat in a single forward, the real half is a constant target
+        n = x.shape[0]
         with torch.autograd.enable_grad():
-            vgg_xhat_features = self.VGGFace(x_hat)
-
-        lossface = 0
-        for x_feat, xhat_feat in zip(vgg_x_features, vgg_xhat_features):
-            lossface += self.l1_loss(x_feat, xhat_feat)
-
-        """Retrieve vggface feature maps"""
-
-        # define hook
-        def vgg_x_hook(module, input, output):
-            output.detach_()  # no gradient compute
-            vgg_x_features.append(output)
-
-        def vgg_xhat_hook(module, input, output):
-            vgg_xhat_features.append(output)
-
-        vgg_x_features = []
-        vgg_xhat_features = []
-
-        vgg_x_handles = []
-
-        conv_idx_iter = 0
-
-        # place hooks
-        for i, m in enumerate(self.VGG19.features.modules()):
-            if i == self.conv_idx_list[conv_idx_iter]:
-                if conv_idx_iter < len(self.conv_idx_list) - 1:
-                    conv_idx_iter += 1
-                vgg_x_handles.append(m.register_forward_hook(vgg_x_hook))
-
-        # run model for x
-        with torch.no_grad():
-            self.VGG19(x)
-
-        # retrieve features for x
-        for h in vgg_x_handles:
-            h.remove()
-
-        # retrieve features for x_hat
-        # conv_idx_iter = 0
-        # for i,m in enumerate(self.VGG19.modules()):
-        #    if i <= 30: #30 is last conv layer
-        #        if type(m) is not torch.nn.Sequential and type(m) is not torchvision.models.vgg.VGG:
-        #        #only pass through nn.module layers
-        #            if i == self.conv_idx_list[conv_idx_iter]:
-        #                if conv_idx_iter < len(self.conv_idx_list)-1:
-        #                    conv_idx_iter += 1
-        #                x_hat = m(x_hat)
-        #                vgg_xhat_features.append(x_hat)
-        #                x_hat.detach_() #reset gradient from output of conv layer
-        #            else:
-        #                x_hat = m(x_hat)
-
-        vgg_xhat_handles = []
-        conv_idx_iter = 0
-
-        # place hooks
-        with torch.autograd.enable_grad():
-            for i, m in enumerate(self.VGG19.features.modules()):
-                if i == self.conv_idx_list[conv_idx_iter]:
-                    if conv_idx_iter < len(self.conv_idx_list) - 1:
-                        conv_idx_iter += 1
-                    vgg_xhat_handles.append(m.register_forward_hook(vgg_xhat_hook))
-            self.VGG19(x_hat)
-
-            # retrieve features for x
-            for h in vgg_xhat_handles:
-                h.remove()
+            features = net(torch.cat((x, x_hat)))
+        loss = 0
+        for feat in features:
+            loss += self.l1_loss(feat[:n].detach(), feat[n:])
+        return loss
 
-        loss19 = 0
-        for x_feat, xhat_feat in zip(vgg_x_features, vgg_xhat_features):
-            loss19 += self.l1_loss(x_feat, xhat_feat)
+    def forward(self, x, x_hat, vgg19_weight=1.5e-1, vggface_weight=2.5e-2):
+        lossface = self.feature_loss(self.VGGFace, x, x_hat)
+        loss19 = self.feature_loss(self.VGG19, x, x_hat)
 
         loss = vgg19_weight * loss19 + vggface_weight * lossface
 
@@ -117,11 +72,11 @@ class LossAdv(nn.Module):
         self.FM_weight = FM_weight
 
     def forward(self, r_hat, D_res_list, D_hat_res_list):
-        lossFM = 0
-        for res, res_hat in zip(D_res_list, D_hat_res_list):
-            lossFM += self.l1_loss(res, res_hat)
+        # one mean l1 per feature map, summed as a single tensor
+        lossFM = torch.stack([self.l1_loss(res, res_hat) for res, res_hat in zip(D_res_list, D_hat_res_list)])
+        self.terms = lossFM.detach()
 
-        return -r_hat.mean() + lossFM * self.FM_weight
+        return -r_hat.mean() + lossFM.sum() * self.FM_weight
 
 
 class LossMatch(nn.Module):
@@ -139,14 +94,9 @@ class LossMatch(nn.Module):
         #     loss[b] = loss[b]/e_vectors.shape[1]
         # loss = loss.mean()
 
-        W = W.unsqueeze(-1).expand(model.E_LEN, W.shape[1], e_vectors.shape[1]).transpose(0, 1).transpose(1, 2)
-        # B,8,512
-        W = W.reshape(-1, model.E_LEN)
-        # B*8,512
+        # e_vectors B,K,512,1 against W 512,B broadcast to B,K,512, W is not copied
         e_vectors = e_vectors.squeeze(-1)
-        # B,8,512
-        e_vectors = e_vectors.reshape(-1, model.E_LEN)
-        # B*8,512
+        W = W.t().unsqueeze(1).expand_as(e_vectors)
         return self.l1_loss(e_vectors, W) * self.match_weight
 
 
@@ -168,7 +118,8 @@ class LossG(nn.Module):
         loss_cnt = self.lossCnt(x, x_hat)
         loss_adv = self.lossAdv(r_hat, D_res_list, D_hat_res_list)
         loss_match = self.lossMatch(e_vectors, W, i)
-        # print(loss_cnt.item(), loss_adv.item(), loss_match.item())
+        # detached, read them only when logging to avoid a sync per step
+        self.terms = {'cnt': loss_cnt.detach(), 'adv': loss_adv.detach(), 'match': loss_match.detach()}
         return loss_cnt + loss_adv + loss_match
 
 
@@ -1,5 +1,97 @@
+import contextlib
+import functools
+import threading
+
 import torch
+import torch.utils.checkpoint
 import torch.nn as nn
+from torch.nn.utils.spectral_norm import SpectralNorm, SpectralNormLoadStateDictPreHook
+
+
+def float32(fn):
+    """Run fn on float32 tensors with autocast disabled, for precision sensitive ops under mixed precision"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with torch.autocast(device_type=args[0].device.type, enabled=False):
+            return fn(*(a.float() if torch.is_tensor(a) else a for a in args), **kwargs)
+    return wrapper
+
+
+#u/v of the forward being recomputed by checkpoint(), per autograd thread
+_recompute = threading.local()
+
+
+class SpectralNormFP32(SpectralNorm):
+    #power iteration and sigma in float32 even under autocast
+    def compute_weight(self, module, do_power_iteration):
+        weight = getattr(module, self.name + '_orig')
+        with torch.autocast(device_type=weight.device.type, enabled=False):
+            saved = getattr(_recompute, 'uv', None)
+            if saved is not None and (id(module), self.name) in saved:
+                #same sigma as the checkpointed forward, without another power iteration
+                u, v = saved[(id(module), self.name)]
+                sigma = torch.dot(u, torch.mv(self.reshape_weight_to_matrix(weight), v))
+                return weight / sigma
+            return super(SpectralNormFP32, self).compute_weight(module, do_power_iteration)
+
+
+def checkpoint(block, *args):
+    """block(*args) without keeping its activations, they are recomputed during backward.
+
+    The recompute reuses the u/v vectors of the forward, so the spectral norms see exactly one
+    power iteration per forward and the same weights in both passes.
+    """
+    hooks = [(m, h) for m in block.modules() for h in m._forward_pre_hooks.values()
+             if isinstance(h, SpectralNormFP32)]
+    saved = {}
+
+    @contextlib.contextmanager
+    def forward_context():
+        yield
+        for m, h in hooks:
+            saved[(id(m), h.name)] = (getattr(m, h.name + '_u').clone(), getattr(m, h.name + '_v').clone())
+
+    return torch.utils.checkpoint.checkpoint(
+        block, *args, use_reentrant=False, context_fn=lambda: (forward_context(), _RecomputeContext(saved))
+    )
+
+
+class _RecomputeContext(object):
+    #entered at every recompute, a backward with retain_graph=True and a second one recompute twice
+    def __init__(self, saved):
+        self.saved = saved
+
+    def __enter__(self):
+        _recompute.uv = self.saved
+
+    def __exit__(self, *exc_info):
+        _recompute.uv = None
+
+
+class Checkpointable(object):
+    """Per stage activation checkpointing of the blocks of a model, see set_checkpointing"""
+    CHECKPOINT_STAGES = ()
+
+    def set_checkpointing(self, *stages):
+        unknown = set(stages) - set(self.CHECKPOINT_STAGES)
+        if unknown:
+            raise ValueError('Unknown checkpoint stages %s, expected some of %s' % (sorted(unknown), self.CHECKPOINT_STAGES))
+        self.checkpoint_stages = set(stages)
+
+    def run(self, stage, block, *args):
+        if stage in getattr(self, 'checkpoint_stages', ()) and self.training and torch.is_grad_enabled():
+            return checkpoint(block, *args)
+        return block(*args)
+
+
+def spectral_norm(module, name='weight'):
+    """nn.utils.spectral_norm, with the power iteration kept in float32"""
+    module = nn.utils.spectral_norm(module, name)
+    for hook in module._forward_pre_hooks.values():
+        if isinstance(hook, SpectralNorm) and hook.name == name:
+            hook.__class__ = SpectralNormFP32
+    return module
+
 
 class ResBlockDown(nn.Module):
     def __init__(self, in_channel, out_channel, conv_size=3, padding_size=1):
@@ -10,11 +102,11 @@ class ResBlockDown(nn.Module):
         self.avg_pool2d = nn.AvgPool2d(2)
         
         #left
-        self.conv_l1 = nn.utils.spectral_norm(nn.Conv2d(in_channel, out_channel, 1,))
+        self.conv_l1 = spectral_norm(nn.Conv2d(in_channel, out_channel, 1,))
         
         #right
-        self.conv_r1 = nn.utils.spectral_norm(nn.Conv2d(in_channel, out_channel, conv_size, padding = padding_size))
-        self.conv_r2 = nn.utils.spectral_norm(nn.Conv2d(out_channel, out_channel, conv_size, padding = padding_size))
+        self.conv_r1 = spectral_norm(nn.Conv2d(in_channel, out_channel, conv_size, padding = padding_size))
+        self.conv_r2 = spectral_norm(nn.Conv2d(out_channel, out_channel, conv_size, padding = padding_size))
 
     def forward(self, x):
         res = x
@@ -40,11 +132,11 @@ class SelfAttention(nn.Module):
         super(SelfAttention, self).__init__()
         
         #conv f
-        self.conv_f = nn.utils.spectral_norm(nn.Conv2d(in_channel, in_channel//8, 1))
+        self.conv_f = spectral_norm(nn.Conv2d(in_channel, in_channel//8, 1))
         #conv_g
-        self.conv_g = nn.utils.spectral_norm(nn.Conv2d(in_channel, in_channel//8, 1))
+        self.conv_g = spectral_norm(nn.Conv2d(in_channel, in_channel//8, 1))
         #conv_h
-        self.conv_h = nn.utils.spectral_norm(nn.Conv2d(in_channel, in_channel, 1))
+        self.conv_h = spectral_norm(nn.Conv2d(in_channel, in_channel, 1))
         
         self.softmax = nn.Softmax(-2) #sum in column j = 1
         self.gamma = nn.Parameter(torch.zeros(1))
@@ -60,7 +152,7 @@ class SelfAttention(nn.Module):
         h_projection = h_projection.view(B,-1,H*W) #BxCxN
         
         attention_map = torch.bmm(f_projection, g_projection) #BxNxN
-        attention_map = self.softmax(attention_map) #sum_i_N (A i,j) = 1
+        attention_map = float32(self.softmax)(attention_map) #sum_i_N (A i,j) = 1
         
         #sum_i_N (A i,j) = 1 hence oj = (HxAj) is a weighted sum of input columns
         out = torch.bmm(h_projection, attention_map) #BxCxN
@@ -72,7 +164,19 @@ class SelfAttention(nn.Module):
         
         
         
-def adaIN(feature, mean_style, std_style, eps = 1e-5):
+ADAIN_BACKENDS = ('reference', 'fused')
+adain_backend = 'fused'
+
+
+def set_adain_backend(backend):
+    """Select the adaIN implementation: 'reference' (separate std/mean passes) or 'fused'."""
+    global adain_backend
+    if backend not in ADAIN_BACKENDS:
+        raise ValueError('Unknown adaIN backend %r, expected one of %s' % (backend, ADAIN_BACKENDS))
+    adain_backend = backend
+
+
+def adaIN_reference(feature, mean_style, std_style, eps = 1e-5):
     B,C,H,W = feature.shape
     
     
@@ -87,6 +191,31 @@ def adaIN(feature, mean_style, std_style, eps = 1e-5):
     return adain
 
 
+def adaIN_fused(feature, mean_style, std_style, eps = 1e-5):
+    B,C,H,W = feature.shape
+    
+    feature = feature.view(B,C,-1)
+    
+    #both moments in a single pass, unbiased like torch.std
+    var_feat, mean_feat = torch.var_mean(feature, dim = 2, keepdim = True)
+    
+    #fold normalisation and style into one per-channel affine op: feature*scale + shift
+    scale = std_style / (var_feat.sqrt() + eps)
+    shift = mean_style - mean_feat * scale
+    adain = torch.addcmul(shift, feature, scale)
+    
+    adain = adain.view(B,C,H,W)
+    return adain
+
+
+@float32
+def adaIN(feature, mean_style, std_style, eps = 1e-5):
+    #statistics in float32 under mixed precision
+    if adain_backend == 'fused':
+        return adaIN_fused(feature, mean_style, std_style, eps)
+    return adaIN_reference(feature, mean_style, std_style, eps)
+
+
 class ResBlock(nn.Module):
     def __init__(self, in_channel):
         super(ResBlock, self).__init__()
@@ -97,18 +226,28 @@ class ResBlock(nn.Module):
         self.relu = nn.LeakyReLU(inplace = False)
         
         #left
-        self.conv1 = nn.utils.spectral_norm(nn.Conv2d(in_channel, in_channel, 3, padding = 1))
-        self.conv2 = nn.utils.spectral_norm(nn.Conv2d(in_channel, in_channel, 3, padding = 1))
+        self.conv1 = spectral_norm(nn.Conv2d(in_channel, in_channel, 3, padding = 1))
+        self.conv2 = spectral_norm(nn.Conv2d(in_channel, in_channel, 3, padding = 1))
         
-    def forward(self, x, psi_slice):
+    @staticmethod
+    def split_psi(psi_slice):
         C = psi_slice.shape[1]
+        return (psi_slice[:, 0:C//4, :], psi_slice[:, C//4:C//2, :],
+                psi_slice[:, C//2:3*C//4, :], psi_slice[:, 3*C//4:C, :])
+        
+    def forward(self, x, psi_slice):
+        #psi_slice is either the raw slice of psi or the tuple returned by split_psi
+        if isinstance(psi_slice, tuple):
+            mean1, std1, mean2, std2 = psi_slice
+        else:
+            mean1, std1, mean2, std2 = self.split_psi(psi_slice)
         
         res = x
         
-        out = adaIN(x, psi_slice[:, 0:C//4, :], psi_slice[:, C//4:C//2, :])
+        out = adaIN(x, mean1, std1)
         out = self.relu(out)
         out = self.conv1(out)
-        out = adaIN(out, psi_slice[:, C//2:3*C//4, :], psi_slice[:, 3*C//4:C, :])
+        out = adaIN(out, mean2, std2)
         out = self.relu(out)
         out = self.conv2(out)
         
@@ -126,8 +265,8 @@ class ResBlockD(nn.Module):
         self.relu = nn.LeakyReLU(inplace = False)
         
         #left
-        self.conv1 = nn.utils.spectral_norm(nn.Conv2d(in_channel, in_channel, 3, padding = 1))
-        self.conv2 = nn.utils.spectral_norm(nn.Conv2d(in_channel, in_channel, 3, padding = 1))
+        self.conv1 = spectral_norm(nn.Conv2d(in_channel, in_channel, 3, padding = 1))
+        self.conv2 = spectral_norm(nn.Conv2d(in_channel, in_channel, 3, padding = 1))
         
     def forward(self, x):
         res = x
@@ -155,17 +294,25 @@ class ResBlockUp(nn.Module):
         self.relu = nn.LeakyReLU(inplace = False)
         
         #left
-        self.conv_l1 = nn.utils.spectral_norm(nn.Conv2d(in_channel, out_channel, 1))
+        self.conv_l1 = spectral_norm(nn.Conv2d(in_channel, out_channel, 1))
         
         #right
-        self.conv_r1 = nn.utils.spectral_norm(nn.Conv2d(in_channel, out_channel, conv_size, padding = padding_size))
-        self.conv_r2 = nn.utils.spectral_norm(nn.Conv2d(out_channel, out_channel, conv_size, padding = padding_size))
+        self.conv_r1 = spectral_norm(nn.Conv2d(in_channel, out_channel, conv_size, padding = padding_size))
+        self.conv_r2 = spectral_norm(nn.Conv2d(out_channel, out_channel, conv_size, padding = padding_size))
     
-    def forward(self,x, psi_slice):
+    def split_psi(self, psi_slice):
         mean1 = psi_slice[:, 0:self.in_channel, :]
         std1 = psi_slice[:, self.in_channel:2*self.in_channel, :]
         mean2 = psi_slice[:, 2*self.in_channel:2*self.in_channel + self.out_channel, :]
         std2 = psi_slice[:, 2*self.in_channel + self.out_channel: 2*(self.in_channel+self.out_channel), :]
+        return mean1, std1, mean2, std2
+    
+    def forward(self,x, psi_slice):
+        #psi_slice is either the raw slice of psi or the tuple returned by split_psi
+        if isinstance(psi_slice, tuple):
+            mean1, std1, mean2, std2 = psi_slice
+        else:
+            mean1, std1, mean2, std2 = self.split_psi(psi_slice)
         
         res = x
         
@@ -202,3 +349,21 @@ class Padding(nn.Module):
         else:
             pad_size = 0
         return pad_size
+
+
+def remove_spectral_norms(model):
+    """Bake every spectral norm of model into its plain weight, in place.
+
+    The weight becomes weight_orig / sigma computed from the current u/v vectors,
+    exactly what the module uses in eval mode, and weight_orig/weight_u/weight_v
+    disappear from the state_dict.
+    """
+    for module in model.modules():
+        for hook in list(module._forward_pre_hooks.values()):
+            if isinstance(hook, SpectralNorm):
+                nn.utils.remove_spectral_norm(module, hook.name)
+        #newer torch wraps load hooks, so remove_spectral_norm can leave the one converting weight back to weight_orig
+        for key, hook in list(module._load_state_dict_pre_hooks.items()):
+            if isinstance(getattr(hook, 'hook', hook), SpectralNormLoadStateDictPreHook):
+                del module._load_state_dict_pre_hooks[key]
+    return model
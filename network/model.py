@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .blocks import ResBlockDown, SelfAttention, ResBlock, ResBlockD, ResBlockUp, Padding, adaIN
+from .blocks import ResBlockDown, SelfAttention, ResBlock, ResBlockD, ResBlockUp, Padding, adaIN, Checkpointable
 import math
 import sys
 import os
@@ -12,7 +12,9 @@ E_LEN = 512
 
 
 # components
-class Embedder(nn.Module):
+class Embedder(Checkpointable, nn.Module):
+    CHECKPOINT_STAGES = ('down',)
+
     def __init__(self, in_height):
         super(Embedder, self).__init__()
 
@@ -32,15 +34,15 @@ class Embedder(nn.Module):
     def forward(self, x, y):
         out = torch.cat((x, y), dim=-3)  # out 6*224*224
         out = self.pad(out)  # out 6*256*256
-        out = self.resDown1(out)  # out 64*128*128
-        out = self.resDown2(out)  # out 128*64*64
-        out = self.resDown3(out)  # out 256*32*32
+        out = self.run('down', self.resDown1, out)  # out 64*128*128
+        out = self.run('down', self.resDown2, out)  # out 128*64*64
+        out = self.run('down', self.resDown3, out)  # out 256*32*32
 
-        out = self.self_att(out)  # out 256*32*32
+        out = self.run('down', self.self_att, out)  # out 256*32*32
 
-        out = self.resDown4(out)  # out 512*16*16
-        out = self.resDown5(out)  # out 512*8*8
-        out = self.resDown6(out)  # out 512*4*4
+        out = self.run('down', self.resDown4, out)  # out 512*16*16
+        out = self.run('down', self.resDown5, out)  # out 512*8*8
+        out = self.run('down', self.resDown6, out)  # out 512*4*4
 
         out = self.sum_pooling(out)  # out 512*1*1
         out = self.relu(out)  # out 512*1*1
@@ -48,7 +50,8 @@ class Embedder(nn.Module):
         return out
 
 
-class Generator(nn.Module):
+class Generator(Checkpointable, nn.Module):
+    CHECKPOINT_STAGES = ('down', 'res', 'up')
     P_LEN = 2 * (512 * 2 * 5 + 512 + 256 + 256 + 128 + 128 + 64 + 64 + 32 + 32)
     slice_idx = [0,
                  512 * 4,  # res1
@@ -114,67 +117,95 @@ class Generator(nn.Module):
         self.finetuning = finetuning
         self.psi = nn.Parameter(torch.rand(self.P_LEN, 1))
         self.e_finetuning = e_finetuning
+        self.frozen_styles = None
 
     def finetuning_init(self):
         if self.finetuning:
             self.psi = nn.Parameter(torch.mm(self.p, self.e_finetuning.mean(dim=0)))
+        self.frozen_styles = None
+
+    def split_psi(self, e_psi):
+        """Split psi (B, P_LEN, 1) into the (mean, std) style tensors of every adaIN layer, in forward order."""
+        idx = self.slice_idx
+        blocks = [self.res1, self.res2, self.res3, self.res4, self.res5,
+                  self.resUp1, self.resUp2, self.resUp3, self.resUp4]
+        styles = [block.split_psi(e_psi[:, idx[k]:idx[k + 1], :]) for k, block in enumerate(blocks)]
+        mid = (idx[9] + idx[10]) // 2
+        styles.append((e_psi[:, idx[9]:mid, :], e_psi[:, mid:idx[10], :]))
+        return styles
+
+    def freeze_identity(self, e=None):
+        """Precompute the adaIN styles once for a fixed identity.
+
+        Uses psi in finetuning mode, otherwise P*e for the given embedding e (1, E_LEN, 1).
+        Subsequent forward calls skip the psi projection, the slicing and the NaN check.
+        Call it again after moving the model to another device or changing its weights.
+        """
+        with torch.no_grad():
+            if self.finetuning:
+                e_psi = self.psi.unsqueeze(0)
+            else:
+                e_psi = torch.mm(self.p, e.mean(dim=0)).unsqueeze(0)
+            self.frozen_styles = [
+                tuple(t.contiguous() for t in style) for style in self.split_psi(e_psi)
+            ]
+
+    def unfreeze_identity(self):
+        self.frozen_styles = None
 
     def forward(self, y, e):
-        if math.isnan(self.p[0, 0]):
-            sys.exit()
-
-        if self.finetuning:
-            e_psi = self.psi.unsqueeze(0)
-            e_psi = e_psi.expand(e.shape[0], self.P_LEN, 1)
+        if self.frozen_styles is not None:
+            styles = self.frozen_styles
         else:
-            p = self.p.unsqueeze(0)
-            p = p.expand(e.shape[0], self.P_LEN, E_LEN)
-            e_psi = torch.bmm(p, e)  # B, p_len, 1
+            if math.isnan(self.p[0, 0]):
+                sys.exit()
+
+            if self.finetuning:
+                e_psi = self.psi.unsqueeze(0)
+                e_psi = e_psi.expand(e.shape[0], self.P_LEN, 1)
+            else:
+                p = self.p.unsqueeze(0)
+                p = p.expand(e.shape[0], self.P_LEN, E_LEN)
+                e_psi = torch.bmm(p, e)  # B, p_len, 1
+            styles = self.split_psi(e_psi)
 
         # in 3*224*224 for voxceleb2
         out = self.pad(y)
 
         # Encoding
-        out = self.resDown1(out)
+        out = self.run('down', self.resDown1, out)
         out = self.in1(out)
 
-        out = self.resDown2(out)
+        out = self.run('down', self.resDown2, out)
         out = self.in2(out)
 
-        out = self.resDown3(out)
+        out = self.run('down', self.resDown3, out)
         out = self.in3(out)
 
-        out = self.self_att_Down(out)
+        out = self.run('down', self.self_att_Down, out)
 
-        out = self.resDown4(out)
+        out = self.run('down', self.resDown4, out)
         out = self.in4(out)
 
         # Residual
-        out = self.res1(out, e_psi[:, self.slice_idx[0]:self.slice_idx[1], :])
-        out = self.res2(out, e_psi[:, self.slice_idx[1]:self.slice_idx[2], :])
-        out = self.res3(out, e_psi[:, self.slice_idx[2]:self.slice_idx[3], :])
-        out = self.res4(out, e_psi[:, self.slice_idx[3]:self.slice_idx[4], :])
-        out = self.res5(out, e_psi[:, self.slice_idx[4]:self.slice_idx[5], :])
+        out = self.run('res', self.res1, out, styles[0])
+        out = self.run('res', self.res2, out, styles[1])
+        out = self.run('res', self.res3, out, styles[2])
+        out = self.run('res', self.res4, out, styles[3])
+        out = self.run('res', self.res5, out, styles[4])
 
         # Decoding
-        out = self.resUp1(out, e_psi[:, self.slice_idx[5]:self.slice_idx[6], :])
+        out = self.run('up', self.resUp1, out, styles[5])
 
-        out = self.resUp2(out, e_psi[:, self.slice_idx[6]:self.slice_idx[7], :])
+        out = self.run('up', self.resUp2, out, styles[6])
 
-        out = self.self_att_Up(out)
+        out = self.run('up', self.self_att_Up, out)
 
-        out = self.resUp3(out, e_psi[:, self.slice_idx[7]:self.slice_idx[8], :])
+        out = self.run('up', self.resUp3, out, styles[7])
 
-        out = self.resUp4(out, e_psi[:, self.slice_idx[8]:self.slice_idx[9], :])
+        out = self.run('up', self.resUp4, out, styles[8])
 
-        out = adaIN(out,
-                    e_psi[:,
-                    self.slice_idx[9]:(self.slice_idx[10] + self.slice_idx[9]) // 2,
-                    :],
-                    e_psi[:,
-                    (self.slice_idx[10] + self.slice_idx[9]) // 2:self.slice_idx[10],
-                    :]
-                    )
+        out = adaIN(out, *styles[9])
 
         out = self.relu(out)
 
@@ -196,11 +227,12 @@ class Generator(nn.Module):
 #     def forward(self):
 #         return self.W_i
 
-class Discriminator(nn.Module):
-    def __init__(self, num_videos, path_to_Wi, batch_size, finetuning=False, e_finetuning=None):
+class Discriminator(Checkpointable, nn.Module):
+    CHECKPOINT_STAGES = ('down',)
+
+    def __init__(self, num_videos, path_to_Wi, batch_size, finetuning=False, e_finetuning=None, wi_table=False):
         super(Discriminator, self).__init__()
         self.path_to_Wi = path_to_Wi
-        self.gpu_num = torch.cuda.device_count()
         self.relu = nn.LeakyReLU()
 
         # in 6*224*224
@@ -218,11 +250,12 @@ class Discriminator(nn.Module):
         if not finetuning:
             if not os.path.isdir(self.path_to_Wi):
                 os.mkdir(self.path_to_Wi)
-            if not os.path.isfile(self.path_to_Wi + '/W_' + str(num_videos) + '.tar'):
+            if not wi_table and not os.path.isfile(self.path_to_Wi + '/W_' + str(num_videos) + '.tar'):
                 print('Initializing Discriminator weights...')
                 w_i = torch.rand(512, num_videos)
                 torch.save({'W_i': w_i}, self.path_to_Wi + '/W_' + str(num_videos) + '.tar')
-        self.W_i = nn.Parameter(torch.randn(E_LEN, num_videos))
+        # with wi_table the columns of W_i are kept in training/wi_table.py and given to forward
+        self.W_i = None if wi_table else nn.Parameter(torch.randn(E_LEN, num_videos))
         self.w_0 = nn.Parameter(torch.randn(E_LEN, 1))
         self.b = nn.Parameter(torch.randn(1))
 
@@ -237,24 +270,24 @@ class Discriminator(nn.Module):
     def load_W_i(self, W_i):
         self.W_i.data[:, :W_i.shape[1]] = self.relu(W_i)
 
-    def forward(self, x, y, i):
+    def forward(self, x, y, i, w_i=None):
         out = torch.cat((x, y), dim=-3)  # out B*6*224*224
 
         out = self.pad(out)
 
-        out1 = self.resDown1(out)
+        out1 = self.run('down', self.resDown1, out)
 
-        out2 = self.resDown2(out1)
+        out2 = self.run('down', self.resDown2, out1)
 
-        out3 = self.resDown3(out2)
+        out3 = self.run('down', self.resDown3, out2)
 
-        out = self.self_att(out3)
+        out = self.run('down', self.self_att, out3)
 
-        out4 = self.resDown4(out)
+        out4 = self.run('down', self.resDown4, out)
 
-        out5 = self.resDown5(out4)
+        out5 = self.run('down', self.resDown5, out4)
 
-        out6 = self.resDown6(out5)
+        out6 = self.run('down', self.resDown6, out5)
 
         out7 = self.res(out6)
 
@@ -264,15 +297,14 @@ class Discriminator(nn.Module):
 
         out = out.squeeze(-1)  # out B*512*1
 
-        batch_start_idx = torch.cuda.current_device() * x.shape[0] // self.gpu_num
-        batch_end_idx = (torch.cuda.current_device() + 1) * x.shape[0] // self.gpu_num
-
         if self.finetuning:
             out = torch.bmm(out.transpose(1, 2), (self.w_prime.unsqueeze(0).expand(out.shape[0], 512, 1))) + self.b
         else:
+            if w_i is None:
+                w_i = self.W_i[:, i].transpose(0, 1)  # B*512
             out = torch.bmm(
                 out.transpose(1, 2),
-                (self.W_i[:, i].unsqueeze(-1)).transpose(0, 1) + self.w_0
+                w_i.unsqueeze(-1) + self.w_0
             ) + self.b  # 1x1
 
         return out, [out1, out2, out3, out4, out5, out6, out7]
@@ -0,0 +1,30 @@
+import os
+import sys
+import types
+
+import pytest
+
+# scripts and packages are imported from the repository root, as train.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeFaceAlignment(object):
+    """face_alignment.FaceAlignment without the model: one face box, no landmarks"""
+    def __init__(self, *args, device=None, **kwargs):
+        import torch
+        self.device = device
+        self.face_detector = types.SimpleNamespace(
+            detect_from_image=lambda image: [[10, 10, 50, 50]], reference_scale=195
+        )
+        self.face_alignment_net = lambda x: [torch.zeros(len(x), 68, 64, 64)]
+
+    def get_landmarks(self, image):
+        return None
+
+
+@pytest.fixture
+def fake_face_alignment(monkeypatch):
+    face_alignment = pytest.importorskip('face_alignment')
+    monkeypatch.setattr(face_alignment, 'FaceAlignment', FakeFaceAlignment)
+    monkeypatch.setattr(face_alignment, 'LandmarksType', types.SimpleNamespace(_2D=1), raising=False)
+    return face_alignment
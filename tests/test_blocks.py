@@ -0,0 +1,89 @@
+"""network/blocks.py: activation checkpointing of spectral norm blocks, adaIN backends."""
+import copy
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from network.blocks import Checkpointable, ResBlockDown, SelfAttention, adaIN_fused, adaIN_reference
+
+
+class Net(Checkpointable, torch.nn.Module):
+    CHECKPOINT_STAGES = ('down',)
+
+    def __init__(self):
+        super(Net, self).__init__()
+        self.resDown1 = ResBlockDown(3, 8)
+        self.self_att = SelfAttention(8)
+        self.resDown2 = ResBlockDown(8, 8)
+
+    def forward(self, x):
+        out = self.run('down', self.resDown1, x)
+        out = self.run('down', self.self_att, out)
+        return self.run('down', self.resDown2, out)
+
+
+def nets():
+    torch.manual_seed(0)
+    net = Net()
+    checkpointed = copy.deepcopy(net)
+    checkpointed.set_checkpointing('down')
+    return net, checkpointed
+
+
+def assert_same(net, checkpointed):
+    for (name, p), q in zip(net.named_parameters(), checkpointed.parameters()):
+        assert torch.allclose(p.grad, q.grad, atol=1e-6), name
+    # one power iteration per forward, none in the recompute
+    for (name, b), c in zip(net.named_buffers(), checkpointed.buffers()):
+        assert torch.equal(b, c), name
+
+
+def nets_after(run):
+    net, checkpointed = nets()
+    run(net)
+    run(checkpointed)
+    return net, checkpointed
+
+
+def test_checkpoint_matches():
+    x = torch.randn(2, 3, 16, 16)
+    assert_same(*nets_after(lambda model: model(x).square().sum().backward()))
+
+
+def test_checkpoint_with_forward_before_backward():
+    x, y = torch.randn(2, 3, 16, 16), torch.randn(2, 3, 16, 16)
+
+    # another D forward moves u/v before the backward of the first one
+    def run(model):
+        loss = model(x).square().sum()
+        model(y).sum().backward()
+        loss.backward()
+
+    assert_same(*nets_after(run))
+
+
+def test_checkpoint_backward_twice():
+    x = torch.randn(2, 3, 16, 16)
+
+    # the lossG and lossD backwards of GANStep go through the same forward
+    def run(model):
+        out = model(x)
+        out.square().sum().backward(retain_graph=True)
+        out.abs().sum().backward()
+
+    assert_same(*nets_after(run))
+
+
+def test_adain_fused_matches_reference():
+    torch.manual_seed(0)
+    inputs = [torch.randn(2, 6, 8, 8) * 3 + 1, torch.randn(2, 6, 1), torch.rand(2, 6, 1) + 0.5]
+    grad = torch.randn(2, 6, 8, 8)
+    results = []
+    for adain in (adaIN_reference, adaIN_fused):
+        args = [a.clone().requires_grad_() for a in inputs]
+        out = adain(*args)
+        out.backward(grad)
+        results.append([out] + [a.grad for a in args])
+    for reference, fused in zip(*results):
+        assert torch.allclose(fused, reference, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,23 @@
+"""training/checkpoint.py: versioned files and the latest checkpoint."""
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from training.checkpoint import CheckpointManager
+
+
+def test_keeps_last_versions(tmp_path):
+    path = str(tmp_path / 'model_weights.tar')
+    checkpoints = CheckpointManager(path, keep=2, log=lambda s: None)
+    for step in (10, 20, 30):
+        checkpoints.save({'step': torch.tensor(step)}, step)
+    checkpoints.wait()
+    assert sorted(os.listdir(str(tmp_path))) == ['model_weights-20.tar', 'model_weights-30.tar', 'model_weights.tar']
+    assert torch.load(path)['step'].item() == 30
+
+
+def test_keep_must_be_positive(tmp_path):
+    with pytest.raises(ValueError):
+        CheckpointManager(str(tmp_path / 'model_weights.tar'), keep=0)
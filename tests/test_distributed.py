@@ -0,0 +1,131 @@
+"""GANStep under DistributedDataParallel with gloo: ranks stay identical, and equal one process."""
+import os
+import socket
+
+import pytest
+
+torch = pytest.importorskip('torch')
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from loss.loss_discriminator import LossDSCfake, LossDSCreal
+from network.model import E_LEN
+from training import distributed
+from training.gan_step import GANStep
+from training.wi_table import WiTable
+
+NUM_VIDEOS = 5
+STEPS = 3
+spectral_norm = nn.utils.spectral_norm
+
+pytestmark = pytest.mark.skipif(not dist.is_available(), reason='torch.distributed is not available')
+
+
+# small stand-ins of E, G and D with their signatures, the real ones need gigabytes per rank
+class Embedder(nn.Module):
+    def __init__(self):
+        super(Embedder, self).__init__()
+        self.conv = spectral_norm(nn.Conv2d(6, E_LEN, 3, padding=1))
+
+    def forward(self, x, y):
+        return self.conv(torch.cat((x, y), dim=1)).mean((2, 3)).unsqueeze(-1)
+
+
+class Generator(nn.Module):
+    def __init__(self):
+        super(Generator, self).__init__()
+        self.conv = spectral_norm(nn.Conv2d(3, 3, 3, padding=1))
+        self.p = nn.Parameter(torch.randn(3, E_LEN) / E_LEN)
+
+    def forward(self, y, e):
+        return torch.sigmoid(self.conv(y) * (self.p @ e).unsqueeze(-1))
+
+
+class Discriminator(nn.Module):
+    def __init__(self, wi_table):
+        super(Discriminator, self).__init__()
+        self.conv1 = spectral_norm(nn.Conv2d(6, 8, 3, padding=1))
+        self.conv2 = spectral_norm(nn.Conv2d(8, E_LEN, 3, padding=1))
+        self.W_0 = torch.randn(E_LEN, NUM_VIDEOS)
+        self.W_i = None if wi_table else nn.Parameter(self.W_0.clone())
+
+    def forward(self, x, y, i, w_i=None):
+        out1 = torch.relu(self.conv1(torch.cat((x, y), dim=1)))
+        out2 = torch.relu(self.conv2(out1))
+        if w_i is None:
+            w_i = self.W_i[:, i].transpose(0, 1)
+        return (out2.mean((2, 3)) * w_i).sum(1).view(-1, 1, 1), [out1, out2]
+
+
+class CriterionG(nn.Module):
+    def forward(self, x, x_hat, r_hat, D_res_list, D_hat_res_list, e_vectors, W, i):
+        match = sum((a - b).abs().mean() for a, b in zip(D_res_list, D_hat_res_list))
+        return (x - x_hat).abs().mean() - r_hat.mean() + match + (e_vectors.squeeze(-1) - W.t().unsqueeze(1)).abs().mean()
+
+
+def build(ctx, storage, path_to_Wi):
+    torch.manual_seed(0)
+    G = ctx.wrap(Generator())
+    E = ctx.wrap(Embedder())
+    D = ctx.wrap(Discriminator(storage != 'param'))
+    optimizerG = torch.optim.Adam(list(E.parameters()) + list(G.parameters()), lr=1e-2)
+    optimizerD = torch.optim.Adam(D.parameters(), lr=1e-2)
+    wi_table = None
+    if storage != 'param':
+        wi_table = WiTable(path_to_Wi, NUM_VIDEOS, E_LEN, storage=storage, init=D.module.W_0, lr=1e-2,
+                           rank=ctx.rank, device=ctx.device)
+    step = GANStep(E, G, D, optimizerG, optimizerD, CriterionG(), LossDSCreal(), LossDSCfake(), wi_table=wi_table)
+    return (E, G, D), wi_table, step
+
+
+def batch(rows):
+    torch.manual_seed(1)
+    f_lm = torch.rand(4, 2, 2, 3, 8, 8)
+    i = torch.tensor([1, 3, 1, 4])
+    return f_lm[rows], f_lm[rows][:, 0, 0], f_lm[rows][:, 0, 1], i[rows]
+
+
+def train(ctx, storage, path_to_Wi, rows):
+    nets, wi_table, step = build(ctx, storage, path_to_Wi)
+    for _ in range(STEPS):
+        step(*batch(rows))
+    result = [p.detach().clone() for net in nets for p in net.parameters()]
+    if wi_table is not None:
+        result.append(wi_table.lookup(torch.arange(NUM_VIDEOS)).detach())
+    return result
+
+
+def worker(rank, port, storage, tmp_dir):
+    os.environ.update(RANK=str(rank), WORLD_SIZE='2', LOCAL_RANK=str(rank), MASTER_ADDR='127.0.0.1',
+                      MASTER_PORT=str(port))
+    ctx = distributed.setup(True, 'gloo')
+    try:
+        # each rank trains on its half of the batch
+        result = train(ctx, storage, os.path.join(tmp_dir, 'wi_ddp'), slice(2 * rank, 2 * rank + 2))
+        torch.save(result, os.path.join(tmp_dir, f'rank-{rank}.pt'))
+    finally:
+        ctx.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.parametrize('storage', ['param', 'mmap'])
+def test_ranks_stay_identical(tmp_path, storage):
+    for name in ('wi_ddp', 'wi'):
+        (tmp_path / name).mkdir()
+    mp.spawn(worker, args=(free_port(), storage, str(tmp_path)), nprocs=2)
+    rank0 = torch.load(str(tmp_path / 'rank-0.pt'))
+    rank1 = torch.load(str(tmp_path / 'rank-1.pt'))
+    for a, b in zip(rank0, rank1):
+        assert torch.equal(a, b)
+
+    # DataParallel on the whole batch, DDP averages the gradients of the two halves the same way
+    single = train(distributed.Context(device=torch.device('cpu')), storage, str(tmp_path / 'wi'), slice(0, 4))
+    assert len(single) == len(rank0)
+    for a, b in zip(rank0, single):
+        assert torch.allclose(a, b, atol=1e-4)
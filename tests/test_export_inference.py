@@ -0,0 +1,52 @@
+"""export_inference.py: baked spectral norms give the outputs of the training model."""
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import export_inference
+from network.blocks import SpectralNormFP32, remove_spectral_norms
+from network.model import Embedder, Generator
+
+FRAME_SIZE = 64
+
+
+def power_iterations(model, n=20):
+    """u/v of a trained model: eval mode uses them as they are, fresh ones give a far too small sigma"""
+    with torch.no_grad():
+        for module in model.modules():
+            for hook in module._forward_pre_hooks.values():
+                if isinstance(hook, SpectralNormFP32):
+                    for _ in range(n):
+                        hook.compute_weight(module, do_power_iteration=True)
+
+
+def test_baked_model_matches(tmp_path, monkeypatch):
+    torch.manual_seed(0)
+    E, G = Embedder(FRAME_SIZE).eval(), Generator(FRAME_SIZE).eval()
+    power_iterations(E)
+    power_iterations(G)
+    path = str(tmp_path / 'model_weights.tar')
+    output = str(tmp_path / 'model_weights_baked.tar')
+    torch.save({'E_state_dict': E.state_dict(), 'G_state_dict': G.state_dict()}, path)
+    monkeypatch.setattr(sys, 'argv', ['export_inference.py', '--model', path, '--output', output,
+                                      '--frame-size', str(FRAME_SIZE)])
+    export_inference.main()
+
+    # as the inference scripts load it
+    checkpoint = torch.load(output)
+    assert checkpoint['spectral_norm_baked'] is True
+    assert not [key for key in checkpoint['G_state_dict'] if key.endswith(('_orig', '_u', '_v'))]
+    baked_E, baked_G = Embedder(FRAME_SIZE).eval(), Generator(FRAME_SIZE).eval()
+    if checkpoint.get('spectral_norm_baked'):
+        remove_spectral_norms(baked_E)
+        remove_spectral_norms(baked_G)
+    baked_E.load_state_dict(checkpoint['E_state_dict'])
+    baked_G.load_state_dict(checkpoint['G_state_dict'])
+
+    x, y = torch.randn(1, 3, FRAME_SIZE, FRAME_SIZE), torch.randn(1, 3, FRAME_SIZE, FRAME_SIZE)
+    with torch.no_grad():
+        e, baked_e = E(x, y), baked_E(x, y)
+        assert torch.allclose(baked_e, e, atol=1e-5)
+        assert torch.allclose(baked_G(y, e), G(y, e), atol=1e-5)
@@ -0,0 +1,85 @@
+"""dataset/landmark_rasterizer.py against the drawing code it replaced."""
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+matplotlib = pytest.importorskip('matplotlib')
+matplotlib.use('agg')
+from matplotlib import pyplot as plt
+
+from dataset.landmark_rasterizer import DRAW_STYLE, FIGURE_STYLE, rasterize_landmarks
+
+SIZE = 256
+# mean absolute difference per channel to the matplotlib figure, out of 255; only anti-aliased
+# line edges differ, thicker by a fraction of a pixel in one or the other
+FIGURE_MEAN_TOLERANCE = 2.0
+# share of pixels farther than 64 from the figure
+FIGURE_PIXEL_TOLERANCE = 0.02
+
+
+def faces(n):
+    """n landmark sets of the 68 point layout, at sub-pixel positions"""
+    rng = np.random.RandomState(0)
+    t = np.linspace(0, 1, 68)
+    base = np.stack((60 + 136 * t, 128 + 60 * np.sin(7 * np.pi * t)), axis=1)
+    return [base + rng.uniform(-8, 8, size=(68, 2)) for _ in range(n)]
+
+
+def baseline_draw_landmark(landmark, size):
+    # draw_landmark of dataset/video_extraction_conversion.py before the rasterizer
+    canvas = (np.ones(size) * 255).astype(np.uint8)
+    colors = [(0, 128, 0), (220, 148, 0), (220, 148, 0), (165, 0, 0), (165, 0, 0), (0, 0, 165), (0, 0, 165),
+              (128, 0, 128)]
+    lines = [
+        landmark[0:17], landmark[17:22], landmark[22:27],
+        np.concatenate((landmark[36:42], [landmark[36]])), np.concatenate((landmark[42:48], [landmark[42]])),
+        np.concatenate((landmark[27:31], [landmark[33]])), landmark[31:36],
+        np.concatenate((landmark[48:60], [landmark[48]])),
+    ]
+    for color, line in zip(colors, lines):
+        cv2.polylines(canvas, np.int32([line]), False, color, thickness=2, lineType=cv2.LINE_AA)
+    return canvas
+
+
+def baseline_figure(preds, shape):
+    # matplotlib figure of generate_cropped_landmarks and webcam_demo before the rasterizer
+    dpi = 100
+    fig = plt.figure(figsize=(shape[1] / dpi, shape[0] / dpi), dpi=dpi)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.imshow(np.ones(shape))
+    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+    for sl, color in [(slice(0, 17), 'green'), (slice(17, 22), 'orange'), (slice(22, 27), 'orange'),
+                      (slice(27, 31), 'blue'), (slice(31, 36), 'blue'), (slice(36, 42), 'red'),
+                      (slice(42, 48), 'red'), (slice(48, 60), 'purple'), (slice(60, 68), 'pink')]:
+        ax.plot(preds[sl, 0], preds[sl, 1], marker='', markersize=5, linestyle='-', color=color, lw=2)
+    ax.axis('off')
+    fig.canvas.draw()
+    data = np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+    plt.close(fig)
+    return data
+
+
+def test_draw_style_matches_draw_landmark():
+    landmarks = faces(4)
+    images = rasterize_landmarks(landmarks, (SIZE, SIZE), DRAW_STYLE)
+    for landmark, image in zip(landmarks, images):
+        assert np.array_equal(image, baseline_draw_landmark(landmark, (SIZE, SIZE, 3)))
+
+
+def test_figure_style_close_to_matplotlib():
+    landmarks = faces(4)
+    images = rasterize_landmarks(landmarks, (SIZE, SIZE), FIGURE_STYLE)
+    for landmark, image in zip(landmarks, images):
+        figure = baseline_figure(landmark, (SIZE, SIZE, 3))
+        assert figure.shape == image.shape
+        diff = np.abs(figure.astype(np.int32) - image.astype(np.int32))
+        assert diff.mean() < FIGURE_MEAN_TOLERANCE
+        assert (diff.max(axis=-1) > 64).mean() < FIGURE_PIXEL_TOLERANCE
+
+
+def test_canvas_is_drawn_in_place():
+    landmarks = faces(2)
+    canvas = np.zeros((2, SIZE, SIZE, 3), dtype=np.uint8)
+    out = rasterize_landmarks(landmarks, canvas.shape[1:], DRAW_STYLE, canvas=canvas)
+    assert out is canvas
+    assert canvas.any()
@@ -0,0 +1,38 @@
+"""training/metrics.py: loss means and the log written by the worker."""
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('skimage')
+
+from training.metrics import MetricsLogger
+
+
+class Writer(object):
+    def __init__(self):
+        self.scalars = {}
+        self.images = []
+
+    def add_image(self, tag, image, global_step, dataformats):
+        self.images.append(image)
+
+    def add_scalar(self, tag, value, global_step):
+        self.scalars[tag] = value
+
+    def flush(self):
+        pass
+
+
+def test_log_step():
+    writer, lines = Writer(), []
+    logger = MetricsLogger(writer, log=lines.append)
+    for n in range(4):
+        logger.accumulate(loss_d=torch.tensor(float(n)), loss_g=torch.tensor(1.0), loss_fm=torch.tensor([1.0, 3.0]))
+    x = torch.rand(2, 3, 16, 16)
+    logger.submit(10, 'Step 10', x, x, x)
+    logger.close()
+
+    assert len(lines) == 1 and lines[0].startswith('Step 10')
+    assert writer.scalars['loss_d'] == 1.5
+    assert writer.scalars['loss_fm_1'] == 3.0
+    assert writer.scalars['ssim'] == pytest.approx(1.0)
+    assert writer.images[0].shape == (16, 48, 3)
@@ -0,0 +1,115 @@
+"""dataset/preprocess.py with a fake landmark model: output order, completeness and resume."""
+import argparse
+import glob
+import os
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+torch = pytest.importorskip('torch')
+
+FRAMES = 12
+
+
+def fake_landmarks(face_aligner, images, boxes):
+    # the spread of the landmarks tells the frame number, like the frame brightness
+    landmarks = []
+    for image in images:
+        k = int(round(image.mean() / 8))
+        points = np.zeros((68, 2), dtype=np.float32)
+        points[:, 0] = np.linspace(20, 40 + k, 68)
+        points[:, 1] = np.linspace(20, 40 + k, 68)
+        landmarks.append(points)
+    return landmarks
+
+
+@pytest.fixture
+def preprocess(monkeypatch, fake_face_alignment):
+    from dataset import face_landmarks
+    from dataset import preprocess
+    monkeypatch.setattr(face_landmarks, 'get_landmarks_batch', fake_landmarks)
+    return preprocess
+
+
+def write_video(path, first):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 25, (64, 64))
+    for k in range(first, first + FRAMES):
+        writer.write(np.full((64, 64, 3), 8 * k, dtype=np.uint8))
+    writer.release()
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    root = tmp_path / 'data'
+    for person in range(2):
+        for video in range(3):
+            video_dir = root / f'id{person}' / f'v{video}'
+            video_dir.mkdir(parents=True)
+            # two files in a dir, written to one output dir
+            write_video(str(video_dir / 'a.avi'), 0)
+            write_video(str(video_dir / 'b.avi'), FRAMES)
+    return root
+
+
+def make_args(data_dir, output, **kwargs):
+    args = dict(data_dir=str(data_dir), output=str(output), threads=2, reverse=False, start_percent=0.0,
+                split_each_video=False, detect_interval=1, batch_size=4, max_wait=0.01, shard='0/1',
+                processes=1, packed=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def run(preprocess, monkeypatch, args):
+    monkeypatch.setattr(preprocess, 'parse_args', lambda: args)
+    preprocess.main()
+
+
+def test_threads_keep_video_order(preprocess, monkeypatch, data_dir, tmp_path):
+    output = tmp_path / 'out'
+    run(preprocess, monkeypatch, make_args(data_dir, output, threads=2))
+
+    out_dirs = sorted(glob.glob(str(output / 'id*' / 'v*')))
+    assert len(out_dirs) == 6
+    for out_dir in out_dirs:
+        jpgs = sorted(glob.glob(os.path.join(out_dir, '*.jpg')))
+        landmarks = np.load(os.path.join(out_dir, 'landmarks.npy'))
+        assert len(jpgs) == len(landmarks) == 2 * FRAMES
+        for k, (jpg, lm) in enumerate(zip(jpgs, landmarks)):
+            assert os.path.basename(jpg) == f'{k:05d}.jpg'
+            assert abs(cv2.imread(jpg).mean() / 8 - k) < 0.5
+            assert np.allclose(lm.max(axis=0) - lm.min(axis=0), 20 + k)
+
+    done = preprocess.Manifest.load(str(output / 'manifest'))
+    assert done == {os.path.relpath(d, str(data_dir)) for d in glob.glob(str(data_dir / 'id*' / 'v*'))}
+
+
+def test_resume_skips_existing_outputs(preprocess, monkeypatch, data_dir, tmp_path):
+    output = tmp_path / 'out'
+    run(preprocess, monkeypatch, make_args(data_dir, output))
+    # an output tree of a run without a manifest
+    for path in glob.glob(str(output / 'manifest' / '*')):
+        os.remove(path)
+
+    processed = []
+    monkeypatch.setattr(preprocess, 'process_images', lambda video_dir, *args, **kwargs: processed.append(video_dir))
+    run(preprocess, monkeypatch, make_args(data_dir, output))
+    assert processed == []
+    assert len(preprocess.Manifest.load(str(output / 'manifest'))) == 6
+
+
+def test_manifest_ignores_torn_line(preprocess, tmp_path):
+    manifest = preprocess.Manifest(str(tmp_path), 'shard')
+    manifest.add('id0/v1')
+    manifest.add('id0/v10')
+    with open(manifest.path, 'a') as f:
+        f.write('id0/v1')
+    assert preprocess.Manifest.load(str(tmp_path)) == {'id0/v1', 'id0/v10'}
+    with open(manifest.path, 'a') as f:
+        f.write('2')
+    assert preprocess.Manifest.load(str(tmp_path)) == {'id0/v1', 'id0/v10'}
+
+    # a restart appends on a line of its own, the torn key is not taken as done
+    manifest = preprocess.Manifest(str(tmp_path), 'shard')
+    manifest.add('id0/v3')
+    assert preprocess.Manifest.load(str(tmp_path)) == {'id0/v1', 'id0/v10', 'id0/v3'}
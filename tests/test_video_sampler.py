@@ -0,0 +1,57 @@
+"""dataset/video_sampler.py: frames read by the plan, and a sampler that pickles."""
+import pickle
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+
+from dataset import video_sampler
+from dataset.video_sampler import VideoSampler
+
+FRAMES = 30
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = str(tmp_path / 'video.avi')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 25, (32, 32))
+    for k in range(FRAMES):
+        writer.write(np.full((32, 32, 3), 8 * k, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def frame_number(frame):
+    return int(round(frame.mean() / 8))
+
+
+def test_read_without_keyframe_index(video, monkeypatch, capsys):
+    monkeypatch.setattr(video_sampler, 'av', None)
+    sampler = VideoSampler()
+    frames = sampler.read(video, [20, 3, 3, 11])
+    assert [frame_number(f) for f in frames] == [3, 3, 11, 20]
+    frames = sampler.read(video, [29, 0])
+    assert [frame_number(f) for f in frames] == [0, 29]
+    assert sampler.stats.seeks == 0
+    # the fallback is logged once
+    assert capsys.readouterr().out.count('PyAV') == 1
+
+
+def test_read_stops_at_missing_frame(video, monkeypatch):
+    monkeypatch.setattr(video_sampler, 'av', None)
+    frames = VideoSampler().read(video, [5, FRAMES + 10, 7])
+    assert [frame_number(f) for f in frames] == [5, 7]
+
+
+def test_plan_seeks_past_far_keyframes():
+    plan = VideoSampler(seek_cost=2).plan([3, 120, 130], np.array([0, 100, 200]))
+    assert plan == [(3, False), (120, True), (130, False)]
+
+
+def test_sampler_pickles(video):
+    sampler = VideoSampler()
+    sampler.sample(video, 4)
+    copy = pickle.loads(pickle.dumps(sampler))
+    copy.sample(video, 4)
+    assert copy.stats.videos == 2 and sampler.stats.videos == 1
@@ -0,0 +1,23 @@
+"""webcam_demo/webcam_extraction_conversion.py: the shared LandmarkExtractor cache."""
+import pytest
+
+torch = pytest.importorskip('torch')
+
+
+@pytest.fixture
+def conversion(monkeypatch, fake_face_alignment):
+    from webcam_demo import webcam_extraction_conversion
+    monkeypatch.setattr(webcam_extraction_conversion, '_extractors', {})
+    return webcam_extraction_conversion
+
+
+def test_closed_extractor_is_not_reused(conversion):
+    extractor = conversion.get_landmark_extractor('cpu', 50)
+    assert conversion.get_landmark_extractor('cpu', 50) is extractor
+    assert conversion.get_landmark_extractor('cpu', 20) is not extractor
+
+    with extractor:
+        pass
+    assert extractor.fa is None
+    fresh = conversion.get_landmark_extractor('cpu', 50)
+    assert fresh is not extractor and fresh.fa is not None
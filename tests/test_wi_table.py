@@ -0,0 +1,287 @@
+"""training/wi_table.py: lazy Adam, commits and resume, optimizerD migration."""
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from training import wi_table
+from training.checkpoint import CheckpointManager
+from training.wi_table import WiTable, column_index, drop_param, remap_columns
+
+NUM_VIDEOS = 10
+DIM = 4
+
+
+def grads(n):
+    generator = torch.Generator().manual_seed(n)
+    return torch.randn(3, DIM, generator=generator)
+
+
+@pytest.mark.parametrize('storage', ['cpu', 'mmap'])
+def test_rows_follow_adam(tmp_path, storage):
+    init = torch.randn(DIM, NUM_VIDEOS)
+    table = WiTable(str(tmp_path), NUM_VIDEOS, DIM, storage=storage, init=init, lr=0.1)
+    W_i = torch.nn.Parameter(init.t().clone())
+    optimizer = torch.optim.Adam([W_i], lr=0.1)
+
+    # rows of other videos get no gradient, Adam leaves them where they are like the lazy update
+    i = torch.tensor([1, 5, 1])
+    for n in range(3):
+        assert torch.allclose(table.lookup(i), W_i.detach()[i])
+        table.step(i, grads(n))
+        optimizer.zero_grad()
+        W_i.grad = torch.zeros_like(W_i).index_add_(0, i, grads(n))
+        optimizer.step()
+
+    table.commit(3)
+    table.wait()
+    assert np.allclose(table.base['table'], W_i.detach().numpy(), atol=1e-6)
+    assert table.base['step'].tolist() == [0, 3, 0, 0, 0, 3, 0, 0, 0, 0]
+
+
+def test_nonfinite_step_is_skipped(tmp_path):
+    table = WiTable(str(tmp_path), NUM_VIDEOS, DIM)
+    i = torch.tensor([2, 3, 4])
+    before = table.lookup(i).detach().clone()
+    table.step(i, torch.full((3, DIM), float('inf')))
+    assert torch.equal(table.lookup(i).detach(), before)
+    assert table.skipped.item() == 1
+
+
+def all_rows(table):
+    return table.lookup(torch.arange(NUM_VIDEOS)).detach().clone()
+
+
+def test_resume_from_commit(tmp_path):
+    table = WiTable(str(tmp_path), NUM_VIDEOS, DIM, step=100)
+    i = torch.tensor([0, 7, 8])
+    table.step(i, grads(0))
+    table.commit(200)
+    # rows changed after the commit are not in the files until the next one
+    table.step(torch.tensor([9, 9, 9]), grads(1))
+    table.wait()
+    rows = all_rows(table)
+
+    with pytest.raises(ValueError):
+        WiTable(str(tmp_path), NUM_VIDEOS, DIM, step=300)
+    resumed = WiTable(str(tmp_path), NUM_VIDEOS, DIM, step=200)
+    assert torch.equal(resumed.lookup(i).detach(), rows[i])
+    assert not torch.equal(resumed.lookup(torch.tensor([9])).detach(), rows[[9]])
+
+    # the next commit drops the rows of the first one from the cache, their values are the files
+    table.commit(300)
+    table.wait()
+    assert table.rows.tolist() == [9]
+    assert torch.equal(all_rows(table), rows)
+
+
+def test_rollback_to_kept_commits(tmp_path):
+    table = WiTable(str(tmp_path), NUM_VIDEOS, DIM, keep=2)
+    rows = {0: all_rows(table)}
+    for n, step in enumerate((10, 20, 30)):
+        table.step(torch.tensor([n, n + 1, 5]), grads(n))
+        table.commit(step)
+        table.wait()
+        rows[step] = all_rows(table)
+
+    # two commits can be undone, back to the checkpoint of step 10
+    with pytest.raises(ValueError):
+        WiTable(str(tmp_path), NUM_VIDEOS, DIM, step=0, keep=2)
+    assert torch.equal(all_rows(WiTable(str(tmp_path), NUM_VIDEOS, DIM, step=30, keep=2)), rows[30])
+    assert torch.equal(all_rows(WiTable(str(tmp_path), NUM_VIDEOS, DIM, step=10, keep=2)), rows[10])
+    assert not os.listdir(os.path.join(str(tmp_path), wi_table.UNDO_DIR))
+
+
+def test_interrupted_commit_is_undone(tmp_path, monkeypatch):
+    table = WiTable(str(tmp_path), NUM_VIDEOS, DIM)
+    rows = all_rows(table)
+    table.step(torch.tensor([3, 4, 5]), grads(0))
+
+    # the undo record is written, the rows are half way to the files
+    def stop(rows, values):
+        table.files['table'][rows[:1]] = values['table'][:1]
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(table, 'apply', stop)
+    with pytest.raises(KeyboardInterrupt):
+        table.write(table.rows.copy(), {k: c[:len(table.rows)].numpy() for k, c in table.cache.items()}, 50)
+
+    with pytest.raises(ValueError):
+        WiTable(str(tmp_path), NUM_VIDEOS, DIM, step=50)
+    assert torch.equal(all_rows(WiTable(str(tmp_path), NUM_VIDEOS, DIM, step=0)), rows)
+
+
+def test_cache_evicts_over_budget(tmp_path):
+    init = torch.randn(DIM, NUM_VIDEOS)
+    os.makedirs(str(tmp_path / 'small'))
+    os.makedirs(str(tmp_path / 'full'))
+    small = WiTable(str(tmp_path / 'small'), NUM_VIDEOS, DIM, init=init, cache_rows=4, grow_rows=2)
+    full = WiTable(str(tmp_path / 'full'), NUM_VIDEOS, DIM, init=init)
+    for n in range(8):
+        i = torch.tensor([n, n + 3, n + 6]) % NUM_VIDEOS
+        assert torch.equal(small.lookup(i), full.lookup(i))
+        small.step(i, grads(n))
+        full.step(i, grads(n))
+        assert len(small.rows) <= 4 and len(small.cache['table']) <= 4
+        if n == 3:
+            small.commit(10)
+            full.commit(10)
+            full.wait()
+            rows = all_rows(full)
+    assert torch.equal(all_rows(small), all_rows(full))
+
+    # rows evicted after the commit are in the files, a resume from its checkpoint undoes them
+    small.wait()
+    table = np.load(os.path.join(str(tmp_path / 'small'), wi_table.FILES['table']))
+    assert not np.array_equal(table, rows.numpy())
+    resumed = WiTable(str(tmp_path / 'small'), NUM_VIDEOS, DIM, step=10)
+    assert torch.equal(all_rows(resumed), rows)
+
+
+def train_and_die(path_to_Wi, path_to_chkpt):
+    """Commit and checkpoint step 10, then die after the W_i commit of step 20, before its checkpoint"""
+    table = WiTable(path_to_Wi, NUM_VIDEOS, DIM)
+    checkpoints = CheckpointManager(path_to_chkpt, log=lambda s: None)
+    table.step(torch.tensor([1, 2, 3]), grads(0))
+    table.commit(10)
+    checkpoints.save({'W_i_step': 10}, 10, before_write=table.wait, blocking=True)
+    np.save(os.path.join(path_to_Wi, 'rows-10.npy'), all_rows(table).numpy())
+
+    table.step(torch.tensor([2, 3, 4]), grads(1))
+    table.commit(20)
+
+    def die():
+        table.wait()
+        os._exit(1)
+
+    checkpoints.save({'W_i_step': 20}, 20, before_write=die)
+    checkpoints.wait()
+
+
+def test_killed_between_commit_and_checkpoint(tmp_path):
+    path_to_Wi = str(tmp_path / 'wi')
+    os.makedirs(path_to_Wi)
+    path_to_chkpt = str(tmp_path / 'model_weights.tar')
+    process = multiprocessing.get_context('spawn').Process(target=train_and_die, args=(path_to_Wi, path_to_chkpt))
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+
+    checkpoint = torch.load(path_to_chkpt)
+    assert checkpoint['W_i_step'] == 10
+    with open(os.path.join(path_to_Wi, wi_table.STEP_FILE)) as f:
+        assert int(f.read()) == 20
+    resumed = WiTable(path_to_Wi, NUM_VIDEOS, DIM, step=checkpoint['W_i_step'])
+    assert np.array_equal(all_rows(resumed).numpy(), np.load(os.path.join(path_to_Wi, 'rows-10.npy')))
+
+
+def test_rows_follow_video_keys(tmp_path):
+    keys = [f'id{n}/v0' for n in range(NUM_VIDEOS)]
+    table = WiTable(str(tmp_path), NUM_VIDEOS, DIM, keys=keys)
+    table.step(torch.tensor([0, 1, 2]), grads(0))
+    table.commit(0)
+    table.wait()
+    rows = table.lookup(torch.arange(NUM_VIDEOS)).detach()
+
+    # an index of the same videos and a new one, in another order
+    new_keys = ['id9/v1'] + keys[::-1]
+    resumed = WiTable(str(tmp_path), NUM_VIDEOS + 1, DIM, keys=new_keys)
+    assert torch.equal(resumed.lookup(torch.arange(1, NUM_VIDEOS + 1)).detach(), rows.flip(0))
+    assert resumed.base['step'].tolist() == [0] * 8 + [1, 1, 1]
+    with open(os.path.join(str(tmp_path), wi_table.VIDEOS_FILE)) as f:
+        assert f.read().splitlines() == new_keys
+
+
+def reorder_cut_short(tmp_path, monkeypatch, stop):
+    """Rows of a table with keys, then a start with the reversed keys that stop interrupts"""
+    keys = [f'id{n}/v0' for n in range(NUM_VIDEOS)]
+    rows = all_rows(WiTable(str(tmp_path), NUM_VIDEOS, DIM, keys=keys))
+    with monkeypatch.context() as m:
+        stop(m)
+        with pytest.raises(KeyboardInterrupt):
+            WiTable(str(tmp_path), NUM_VIDEOS, DIM, keys=keys[::-1])
+    return keys, rows
+
+
+def interrupt(*args):
+    raise KeyboardInterrupt
+
+
+def test_reorder_interrupted_between_replaces(tmp_path, monkeypatch):
+    replace = os.replace
+
+    def stop(m):
+        # two of the files of the new order replace the old ones
+        def replace_two(src, dst):
+            if src.endswith(wi_table.REORDER):
+                if replace_two.count == 2:
+                    interrupt()
+                replace_two.count += 1
+            replace(src, dst)
+
+        replace_two.count = 0
+        m.setattr(wi_table.os, 'replace', replace_two)
+
+    keys, rows = reorder_cut_short(tmp_path, monkeypatch, stop)
+    # the start finishes the reorder, the rows are not moved a second time
+    resumed = WiTable(str(tmp_path), NUM_VIDEOS, DIM, keys=keys[::-1])
+    assert torch.equal(all_rows(resumed), rows.flip(0))
+    with open(os.path.join(str(tmp_path), wi_table.VIDEOS_FILE)) as f:
+        assert f.read().splitlines() == keys[::-1]
+    assert not [name for name in os.listdir(str(tmp_path)) if 'reorder' in name]
+
+
+def test_reorder_interrupted_before_replaces(tmp_path, monkeypatch):
+    write_keys = WiTable.write_keys
+
+    def stop(m):
+        # the files of the new order are written, W_i_reorder.txt is not
+        def write_keys_but_marker(self, keys, name=wi_table.VIDEOS_FILE):
+            if name == wi_table.REORDER_FILE:
+                interrupt()
+            write_keys(self, keys, name)
+
+        m.setattr(WiTable, 'write_keys', write_keys_but_marker)
+
+    keys, rows = reorder_cut_short(tmp_path, monkeypatch, stop)
+    assert os.path.exists(os.path.join(str(tmp_path), wi_table.VIDEOS_FILE + wi_table.REORDER))
+    # the new files are dropped, the rows are in the old order
+    resumed = WiTable(str(tmp_path), NUM_VIDEOS, DIM)
+    assert torch.equal(all_rows(resumed), rows)
+    assert not [name for name in os.listdir(str(tmp_path)) if 'reorder' in name]
+
+
+def test_remap_columns():
+    W_i = torch.arange(6.0).view(2, 3)
+    index = column_index(['a', 'b', 'c'], ['c', 'x', 'a'])
+    assert index.tolist() == [2, -1, 0]
+    assert remap_columns(W_i, index).tolist() == [[2.0, 0.0, 0.0], [5.0, 0.0, 3.0]]
+
+
+class D(torch.nn.Module):
+    def __init__(self, wi_table):
+        super(D, self).__init__()
+        self.conv = torch.nn.Linear(DIM, DIM)
+        self.W_i = None if wi_table else torch.nn.Parameter(torch.randn(DIM, NUM_VIDEOS))
+        self.w_0 = torch.nn.Parameter(torch.randn(DIM))
+
+
+def test_drop_param_keeps_other_states():
+    old = D(wi_table=False)
+    optimizer = torch.optim.Adam(old.parameters())
+    sum(p.sum() for p in old.parameters()).backward()
+    optimizer.step()
+
+    new = D(wi_table=True)
+    params = dict(new.named_parameters())
+    names = [name for name in old.state_dict() if name == 'W_i' or name in params]
+    state = drop_param(optimizer.state_dict(), names, 'W_i')
+    new_optimizer = torch.optim.Adam(new.parameters())
+    new_optimizer.load_state_dict(state)
+
+    old_state = dict(zip(dict(old.named_parameters()), optimizer.state.values()))
+    for name, p in new.named_parameters():
+        assert torch.equal(new_optimizer.state[p]['exp_avg'], old_state[name]['exp_avg'])
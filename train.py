@@ -1,39 +1,69 @@
 """Main"""
 import argparse
+import contextlib
+import functools
 import os
 import time
 from datetime import datetime
 
 import matplotlib
 from matplotlib import pyplot as plt
-from skimage import metrics
 import tensorboardX
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 plt.ion()
 
+from dataset.dataset_class import PackedDataset
 from dataset.dataset_class import PreprocessDataset
 from dataset.dataset_class import VidDataSet
+from dataset.landmark_service import LandmarkService, collate_raw
 from dataset.video_extraction_conversion import *
 from loss.loss_discriminator import *
 from loss.loss_generator import *
 from network.model import *
+from training import distributed
+from training.checkpoint import CheckpointManager
+from training.gan_step import GANStep
+from training.metrics import MetricsLogger
+from training.wi_table import WiTable, column_index, drop_param, remap_columns
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-k', default=8, type=int)
 parser.add_argument('--batch-size', default=1, type=int)
 parser.add_argument('--epochs', default=10, type=int)
 parser.add_argument('--preprocessed')
+parser.add_argument('--rebuild-index', action='store_true', help='re-scan the --preprocessed dirs')
+parser.add_argument('--draw-landmarks', action='store_true',
+                    help='draw landmark images on the fly even if dataset/render_rasters.py rendered them')
+parser.add_argument('--packed', help='directory of packed shards, used instead of --preprocessed')
 parser.add_argument('--save-checkpoint', type=int, default=1000)
+parser.add_argument('--keep-checkpoints', type=int, default=3, help='versioned checkpoints to keep, at least 1')
 parser.add_argument('--train-dir', default='train')
 parser.add_argument('--vggface-dir', default='.')
 parser.add_argument('--data-dir', default='../image2image/ds_fa_vox')
 parser.add_argument('--frame-shape', default=256, type=int)
 parser.add_argument('--workers', default=4, type=int)
-parser.add_argument('--fa-device', default='cuda:0')
+parser.add_argument('--fa-device', help='device of the landmark model, default the training device of the rank')
+parser.add_argument('--grad-checkpoint', nargs='*', default=[],
+                    choices=['G.down', 'G.res', 'G.up', 'E.down', 'D.down'],
+                    help='recompute the activations of these stages in backward instead of keeping them')
+parser.add_argument('--amp', action='store_true',
+                    help='mixed precision: float16 autocast with gradient scaling on CUDA, bfloat16 autocast on CPU')
+parser.add_argument('--landmark-service', action='store_true',
+                    help='raw videos: decode in --workers processes, landmarks batched in one --fa-device model')
+parser.add_argument('--d-steps', default=2, type=int, help='D updates per G update')
+parser.add_argument('--distributed', action='store_true',
+                    help='DistributedDataParallel, one process per GPU started by torchrun')
+parser.add_argument('--dist-backend', help='default nccl on CUDA, gloo on CPU')
+parser.add_argument('--wi-storage', default='param', choices=['param', 'cpu', 'mmap'],
+                    help='W_i as a parameter of D, or as rows outside of it in memory or memory mapped in wi_weights')
+parser.add_argument('--wi-cache-rows', default=32768, type=int,
+                    help='W_i rows kept on the training device with --wi-storage cpu or mmap')
+parser.add_argument('--keyframe-cache', help='directory to keep the keyframe index of each raw video')
 
 args = parser.parse_args()
 
@@ -43,10 +73,24 @@ def print_fun(s):
     sys.stdout.flush()
 
 
+def to_device(images):
+    # datasets return uint8 images, normalized once they are on the device
+    return images.to(device, non_blocking=True).float().div_(255)
+
+
+def select_target(f_lm, g_idx):
+    # frame and landmark image to reconstruct, one of the K of each sample
+    target = f_lm[torch.arange(len(f_lm), device=f_lm.device), g_idx.to(f_lm.device)]  # B,2,3,224,224
+    return target[:, 0], target[:, 1]
+
+
 """Create dataset and net"""
 display_training = False
 matplotlib.use('agg')
-device = torch.device("cuda")
+dist_ctx = distributed.setup(args.distributed, args.dist_backend)
+device = dist_ctx.device
+if args.fa_device is None:
+    args.fa_device = str(device)
 cpu = torch.device("cpu")
 batch_size = args.batch_size
 frame_shape = args.frame_shape
@@ -54,35 +98,80 @@ path_to_Wi = os.path.join(args.train_dir, 'wi_weights')
 K = args.k
 if not os.path.exists(path_to_Wi):
     os.makedirs(path_to_Wi)
+# the dense W_i of VidDataSet seeds the W_i parameter of D, a WiTable has its own rows
+dataset_wi = path_to_Wi if args.wi_storage == 'param' else None
 
 
-if args.preprocessed:
-    dataset = PreprocessDataset(K=K, path_to_preprocess=args.preprocessed, path_to_Wi=path_to_Wi, frame_shape=frame_shape)
+if args.packed or args.preprocessed:
+    if args.packed:
+        dataset = PackedDataset(
+            K=K, path_to_packed=args.packed, path_to_Wi=path_to_Wi, frame_shape=frame_shape,
+            use_rasters=not args.draw_landmarks
+        )
+    else:
+        dataset = PreprocessDataset(
+            K=K, path_to_preprocess=args.preprocessed, path_to_Wi=path_to_Wi, frame_shape=frame_shape,
+            rebuild_index=args.rebuild_index, use_rasters=not args.draw_landmarks
+        )
+    sampler = DistributedSampler(dataset) if dist_ctx.distributed else None
     data_loader = DataLoader(
         dataset,
         batch_size=batch_size,
-        shuffle=True,
+        shuffle=sampler is None,
+        sampler=sampler,
         drop_last=True,
         num_workers=args.workers,
+        pin_memory=True,
+    )
+elif args.landmark_service:
+    dataset = VidDataSet(
+        K=K, path_to_mp4=args.data_dir,
+        device=args.fa_device, path_to_wi=dataset_wi, size=frame_shape, keyframe_cache=args.keyframe_cache,
+        detect_landmarks=False
+    )
+    sampler = DistributedSampler(dataset) if dist_ctx.distributed else None
+    data_loader = LandmarkService(
+        DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=sampler is None,
+            sampler=sampler,
+            num_workers=args.workers,
+            collate_fn=collate_raw,
+        ),
+        device=args.fa_device, batch_size=batch_size, size=frame_shape
     )
 else:
     dataset = VidDataSet(
         K=K, path_to_mp4=args.data_dir,
-        device=args.fa_device, path_to_wi=path_to_Wi, size=frame_shape
+        device=args.fa_device, path_to_wi=dataset_wi, size=frame_shape, keyframe_cache=args.keyframe_cache
     )
+    sampler = DistributedSampler(dataset) if dist_ctx.distributed else None
     data_loader = DataLoader(
         dataset,
         batch_size=batch_size,
-        shuffle=True,
+        shuffle=sampler is None,
+        sampler=sampler,
         drop_last=True,
         num_workers=args.workers if 'cuda' not in args.fa_device else 0,
+        pin_memory=True,
     )
 
 path_to_chkpt = os.path.join(args.train_dir, 'model_weights.tar')
+# W_i columns follow the videos by name, vid_idx orders change with the dataset
+video_keys = dataset.video_keys
+
+# psi of G and w_prime of D are only used for finetuning
+G = dist_ctx.wrap(Generator(frame_shape), find_unused_parameters=True)
+E = dist_ctx.wrap(Embedder(frame_shape))
+D = dist_ctx.wrap(
+    Discriminator(dataset.__len__(), path_to_Wi, args.batch_size, wi_table=args.wi_storage != 'param'),
+    find_unused_parameters=True
+)
 
-G = nn.DataParallel(Generator(frame_shape).to(device))
-E = nn.DataParallel(Embedder(frame_shape).to(device))
-D = nn.DataParallel(Discriminator(dataset.__len__(), path_to_Wi, args.batch_size).to(device))
+for net in (G, E, D):
+    prefix = type(net.module).__name__[0] + '.'
+    net.module.set_checkpointing(*[s[len(prefix):] for s in args.grad_checkpoint if s.startswith(prefix)])
 
 G.train()
 E.train()
@@ -98,6 +187,16 @@ optimizerD = optim.Adam(
     lr=2e-4,
     amsgrad=False)
 
+if args.amp:
+    amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    autocast = functools.partial(torch.autocast, device_type=device.type, dtype=amp_dtype)
+    # bfloat16 has the float32 range, gradients only need scaling for float16
+    scalerG = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
+    scalerD = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
+else:
+    autocast = contextlib.nullcontext
+    scalerG = scalerD = None
+
 """Criterion"""
 criterionG = LossG(
     VGGFace_body_path=os.path.join(args.vggface_dir, 'Pytorch_VGGFACE_IR.py'),
@@ -107,6 +206,41 @@ criterionG = LossG(
 criterionDreal = LossDSCreal()
 criterionDfake = LossDSCfake()
 
+checkpoints = CheckpointManager(path_to_chkpt, keep=args.keep_checkpoints, log=print_fun)
+wi_table = None
+
+
+def checkpoint_state(epoch, step):
+    state = {
+        'epoch': epoch,
+        'lossesG': lossesG,
+        'lossesD': lossesD,
+        'E_state_dict': E.module.state_dict(),
+        'G_state_dict': G.module.state_dict(),
+        'D_state_dict': D.module.state_dict(),
+        'num_vid': dataset.__len__(),
+        'i_batch': step,
+        'optimizerG': optimizerG.state_dict(),
+        'optimizerD': optimizerD.state_dict()
+    }
+    if wi_table is not None:
+        # the rows of a WiTable are in its own files, committed as of this step
+        state['W_i_step'] = int(step)
+    if args.wi_storage == 'param':
+        state['video_keys'] = video_keys
+    return state
+
+
+def save(epoch, step):
+    # every rank commits its W_i rows, rank 0 writes the checkpoint once they are on disk
+    if wi_table is not None:
+        wi_table.commit(int(step))
+    if dist_ctx.is_main:
+        before_write = wi_table.wait if wi_table is not None else None
+        checkpoints.save(checkpoint_state(epoch, step), step, before_write=before_write)
+        dataset.save_w_i()
+
+
 """Training init"""
 epochCurrent = epoch = i_batch = 0
 lossesG = []
@@ -115,8 +249,8 @@ i_batch_current = 0
 
 num_epochs = args.epochs
 
-# initiate checkpoint if inexistant
-if not os.path.isfile(path_to_chkpt):
+# initiate checkpoint if inexistant, other ranks load the one of rank 0
+if dist_ctx.is_main and not os.path.isfile(path_to_chkpt):
     def init_weights(m):
         if type(m) == nn.Conv2d:
             torch.nn.init.xavier_uniform(m.weight)
@@ -127,24 +261,34 @@ if not os.path.isfile(path_to_chkpt):
     E.apply(init_weights)
 
     print_fun('Initiating new checkpoint...')
-    torch.save({
-        'epoch': epoch,
-        'lossesG': lossesG,
-        'lossesD': lossesD,
-        'E_state_dict': E.module.state_dict(),
-        'G_state_dict': G.module.state_dict(),
-        'D_state_dict': D.module.state_dict(),
-        'num_vid': dataset.__len__(),
-        'i_batch': i_batch,
-        'optimizerG': optimizerG.state_dict(),
-        'optimizerD': optimizerD.state_dict()
-    }, path_to_chkpt)
+    checkpoints.save(checkpoint_state(epoch, i_batch), i_batch, blocking=True)
     print_fun('...Done')
+dist_ctx.barrier()
 
 """Loading from past checkpoint"""
 checkpoint = torch.load(path_to_chkpt, map_location=cpu)
 E.module.load_state_dict(checkpoint['E_state_dict'])
 G.module.load_state_dict(checkpoint['G_state_dict'], strict=False)
+W_i = None
+if 'W_i' in checkpoint['D_state_dict']:
+    D_params = dict(D.module.named_parameters())
+    # ids of optimizerD follow the parameters of the D it was saved with, W_i among them
+    D_names = [name for name in checkpoint['D_state_dict'] if name == 'W_i' or name in D_params]
+    if 'video_keys' not in checkpoint:
+        print_fun('Checkpoint has no video list, its W_i columns are taken in the order of the dataset')
+    elif checkpoint['video_keys'] != video_keys:
+        index = column_index(checkpoint['video_keys'], video_keys)
+        print_fun(f'W_i columns moved to the new video list: {int((index >= 0).sum())} kept, '
+                  f'{int((index < 0).sum())} new')
+        checkpoint['D_state_dict']['W_i'] = remap_columns(checkpoint['D_state_dict']['W_i'], index, torch.randn)
+        W_i_state = checkpoint['optimizerD']['state'].get(D_names.index('W_i'), {})
+        for key in ('exp_avg', 'exp_avg_sq', 'max_exp_avg_sq'):
+            if key in W_i_state:
+                W_i_state[key] = remap_columns(W_i_state[key], index)
+    # a W_i parameter of an earlier checkpoint seeds the table
+    if args.wi_storage != 'param':
+        checkpoint['optimizerD'] = drop_param(checkpoint['optimizerD'], D_names, 'W_i')
+        W_i = checkpoint['D_state_dict'].pop('W_i')
 D.module.load_state_dict(checkpoint['D_state_dict'])
 epochCurrent = checkpoint['epoch']
 lossesG = checkpoint['lossesG']
@@ -154,6 +298,19 @@ optimizerG.load_state_dict(checkpoint['optimizerG'])
 optimizerD.load_state_dict(checkpoint['optimizerD'])
 prev_step = checkpoint['i_batch']
 
+if args.wi_storage != 'param':
+    # rows written after this checkpoint are rolled back
+    wi_table = WiTable(
+        path_to_Wi, dataset.__len__(), E_LEN, storage=args.wi_storage, init=W_i,
+        step=checkpoint.get('W_i_step', int(prev_step)), lr=optimizerD.param_groups[0]['lr'], rank=dist_ctx.rank,
+        device=device, keys=video_keys, keep=args.keep_checkpoints, cache_rows=args.wi_cache_rows
+    )
+
+gan_step = GANStep(
+    E, G, D, optimizerG, optimizerD, criterionG, criterionDreal, criterionDfake,
+    d_steps=args.d_steps, autocast=autocast, scalerG=scalerG, scalerD=scalerD, wi_table=wi_table
+)
+
 G.train()
 E.train()
 D.train()
@@ -161,8 +318,11 @@ D.train()
 """Training"""
 batch_start = datetime.now()
 
-writer = tensorboardX.SummaryWriter(args.train_dir)
-num_batches = len(dataset) / args.batch_size
+# checkpoints and logs are written by rank 0 only
+if dist_ctx.is_main:
+    writer = tensorboardX.SummaryWriter(args.train_dir)
+    metrics_logger = MetricsLogger(writer, log=print_fun)
+num_batches = len(sampler if sampler is not None else dataset) / args.batch_size
 log_step = int(round(0.005 * num_batches + 20))
 log_epoch = 1
 if num_batches <= 10:
@@ -181,76 +341,17 @@ for epoch in range(0, num_epochs):
     #     continue
     # Reset random generator
     np.random.seed(int(time.time()))
-    for i_batch, (f_lm, x, g_y, i, W_i) in enumerate(data_loader):
+    if sampler is not None:
+        sampler.set_epoch(epoch)
+    for i_batch, (f_lm, g_idx, i, W_i) in enumerate(data_loader):
 
-        f_lm = f_lm.to(device)
-        x = x.to(device)
-        g_y = g_y.to(device)
+        f_lm = to_device(f_lm)
+        x, g_y = select_target(f_lm, g_idx)
         # W_i = W_i.squeeze(-1).transpose(0, 1).to(device).requires_grad_()
 
         # D.module.load_W_i(W_i)
 
-        with torch.autograd.enable_grad():
-            # zero the parameter gradients
-            optimizerG.zero_grad()
-            optimizerD.zero_grad()
-
-            # forward
-            # Calculate average encoding vector for video
-            f_lm_compact = f_lm.view(-1, f_lm.shape[-4], f_lm.shape[-3], f_lm.shape[-2],
-                                     f_lm.shape[-1])  # BxK,2,3,224,224
-
-            e_vectors = E(f_lm_compact[:, 0, :, :, :], f_lm_compact[:, 1, :, :, :])  # BxK,512,1
-            e_vectors = e_vectors.view(-1, f_lm.shape[1], E_LEN, 1)  # B,K,512,1
-            e_hat = e_vectors.mean(dim=1)
-
-            # train G and D
-            x_hat = G(g_y, e_hat)
-            r_hat, D_hat_res_list = D(x_hat, g_y, i)
-            with torch.no_grad():
-                r, D_res_list = D(x, g_y, i)
-            """####################################################################################################################################################
-            r, D_res_list = D(x, g_y, i)"""
-
-            lossG = criterionG(
-                x, x_hat, r_hat, D_res_list, D_hat_res_list, e_vectors, D.module.W_i[:, i], i
-            )
-
-            """####################################################################################################################################################
-            lossD = criterionDfake(r_hat) + criterionDreal(r)
-            loss = lossG + lossD
-            loss.backward(retain_graph=False)
-            optimizerG.step()
-            optimizerD.step()"""
-
-            lossG.backward(retain_graph=False)
-            optimizerG.step()
-            # optimizerD.step()
-
-        with torch.autograd.enable_grad():
-            optimizerG.zero_grad()
-            optimizerD.zero_grad()
-            x_hat.detach_().requires_grad_()
-            r_hat, D_hat_res_list = D(x_hat, g_y, i)
-            lossDfake = criterionDfake(r_hat)
-
-            r, D_res_list = D(x, g_y, i)
-            lossDreal = criterionDreal(r)
-
-            lossD = lossDfake + lossDreal
-            lossD.backward(retain_graph=False)
-            optimizerD.step()
-
-            optimizerD.zero_grad()
-            r_hat, D_hat_res_list = D(x_hat, g_y, i)
-            lossDfake = criterionDfake(r_hat)
-
-            r, D_res_list = D(x, g_y, i)
-            lossDreal = criterionDreal(r)
-
-            lossD = lossDfake + lossDreal
-            lossD.backward(retain_graph=False)
-            optimizerD.step()
+        x_hat, lossG, lossD = gan_step(f_lm, x, g_y, i)
 
         # for enum, idx in enumerate(i):
         #     dataset.W_i[:, idx.item()] = D.module.W_i[:, enum]
@@ -258,69 +359,27 @@ for epoch in range(0, num_epochs):
             #            path_to_Wi + '/W_' + str(idx.item()) + '/W_' + str(idx.item()) + '.tar')
 
         step = epoch * num_batches + i_batch + prev_step
+        if step != 0 and step % save_checkpoint == 0:
+            save(epoch, step)
+        if not dist_ctx.is_main:
+            continue
+
+        metrics_logger.accumulate(
+            loss_d=lossD, loss_g=lossG, **{f'loss_g_{name}': t for name, t in criterionG.terms.items()},
+            loss_fm=criterionG.lossAdv.terms
+        )
         # Output training stats
         if step % log_step == 0:
-            out = (x_hat[0] * 255).permute([1, 2, 0])
-            out1 = out.type(torch.int32).to(cpu).numpy()
-
-            out = (x[0] * 255).permute([1, 2, 0])
-            out2 = out.type(torch.int32).to(cpu).numpy()
-
-            out = (g_y[0] * 255).permute([1, 2, 0])
-            out3 = out.type(torch.int32).to(cpu).numpy()
-            accuracy = np.sum(np.squeeze((np.abs(out1 - out2) <= 1))) / np.prod(out.shape)
-            ssim = metrics.structural_similarity(out1.astype(np.uint8).clip(0, 255), out2.astype(np.uint8).clip(0, 255), multichannel=True)
-            print_fun(
-                'Step %d [%d/%d][%d/%d]\tLoss_D: %.4f\tLoss_G: %.4f\tMatch: %.3f\tSSIM: %.3f'
-                % (step, epoch, num_epochs, i_batch, len(data_loader),
-                   lossD.item(), lossG.item(), accuracy, ssim)
+            metrics_logger.submit(
+                step, 'Step %d [%d/%d][%d/%d]' % (step, epoch, num_epochs, i_batch, len(data_loader)), x_hat, x, g_y
             )
 
-            image = np.hstack((out1, out2, out3)).astype(np.uint8).clip(0, 255)
-            writer.add_image(
-                'Result', image,
-                global_step=step,
-                dataformats='HWC'
-            )
-            writer.add_scalar('loss_g', lossG.item(), global_step=step)
-            writer.add_scalar('loss_d', lossD.item(), global_step=step)
-            writer.add_scalar('match', accuracy, global_step=step)
-            writer.add_scalar('ssim', ssim, global_step=step)
-            writer.flush()
-
-        if step != 0 and step % save_checkpoint == 0:
-            print_fun('Saving latest...')
-            torch.save({
-                'epoch': epoch,
-                'lossesG': lossesG,
-                'lossesD': lossesD,
-                'E_state_dict': E.module.state_dict(),
-                'G_state_dict': G.module.state_dict(),
-                'D_state_dict': D.module.state_dict(),
-                'num_vid': dataset.__len__(),
-                'i_batch': step,
-                'optimizerG': optimizerG.state_dict(),
-                'optimizerD': optimizerD.state_dict()
-            },
-                path_to_chkpt
-            )
-            dataset.save_w_i()
-
     if epoch % log_epoch == 0:
-        print_fun('Saving latest...')
-        torch.save({
-            'epoch': epoch,
-            'lossesG': lossesG,
-            'lossesD': lossesD,
-            'E_state_dict': E.module.state_dict(),
-            'G_state_dict': G.module.state_dict(),
-            'D_state_dict': D.module.state_dict(),
-            'num_vid': dataset.__len__(),
-            'i_batch': step,
-            'optimizerG': optimizerG.state_dict(),
-            'optimizerD': optimizerD.state_dict()
-        },
-            path_to_chkpt
-        )
-        dataset.save_w_i()
-        print_fun('...Done saving latest')
+        save(epoch, step)
+
+if wi_table is not None:
+    wi_table.wait()
+if dist_ctx.is_main:
+    metrics_logger.close()
+    checkpoints.wait()
+dist_ctx.close()
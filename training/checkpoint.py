@@ -0,0 +1,100 @@
+"""Checkpoints written in a background thread.
+
+save() only copies the state to CPU; torch.save runs in a thread. Each checkpoint goes to
+model_weights-<step>.tar through a temporary file and an atomic rename, then model_weights.tar
+is replaced by a hard link to it, so a crash mid-write never leaves a truncated checkpoint.
+The last keep versioned files are kept.
+"""
+import glob
+import os
+import re
+import shutil
+import threading
+import time
+
+import torch
+
+
+def to_cpu(obj):
+    """Copy of nested dicts/lists of tensors, with every tensor copied to CPU"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointManager(object):
+    def __init__(self, path_to_chkpt, keep=3, log=print):
+        if keep < 1:
+            raise ValueError(f'keep must be at least 1, got {keep}')
+        self.path_to_chkpt = path_to_chkpt
+        self.keep = keep
+        self.log = log
+        self.thread = None
+        self.error = None
+        root, ext = os.path.splitext(path_to_chkpt)
+        self.pattern = root + '-{}' + ext
+        self.regex = re.compile(re.escape(os.path.basename(root)) + r'-(\d+)' + re.escape(ext) + '$')
+
+    def save(self, state, step, blocking=False, before_write=None):
+        """Snapshot state to CPU and write it in the background, waiting for the previous write first.
+
+        before_write runs in the background thread before the checkpoint is written, an exception
+        from it leaves the checkpoint unwritten.
+        """
+        step = int(step)
+        start = time.time()
+        self.wait()
+        waited = time.time() - start
+        state = to_cpu(state)
+        stall = time.time() - start
+        self.log(f'Checkpoint {step}: training stalled {stall:.2f}s ({waited:.2f}s waiting for the previous write)')
+
+        self.thread = threading.Thread(target=self.write, args=(state, step, before_write), daemon=True)
+        self.thread.start()
+        if blocking:
+            self.wait()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, state, step, before_write=None):
+        try:
+            if before_write is not None:
+                before_write()
+            start = time.time()
+            path = self.pattern.format(step)
+            torch.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+            # model_weights.tar always names a complete checkpoint
+            link = self.path_to_chkpt + '.tmp'
+            if os.path.lexists(link):
+                os.remove(link)
+            try:
+                os.link(path, link)
+            except OSError:
+                shutil.copyfile(path, link)
+            os.replace(link, self.path_to_chkpt)
+
+            self.cleanup()
+            self.log(f'Checkpoint {step}: written to {path} in {time.time() - start:.2f}s')
+        except Exception as e:
+            self.error = e
+
+    def cleanup(self):
+        versions = []
+        for path in glob.glob(self.pattern.format('*')):
+            match = self.regex.search(os.path.basename(path))
+            if match:
+                versions.append((int(match.group(1)), path))
+        for _, path in sorted(versions)[:-self.keep]:
+            os.remove(path)
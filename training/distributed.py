@@ -0,0 +1,63 @@
+"""DistributedDataParallel setup, one process per GPU (or per CPU worker with gloo).
+
+Launch with torchrun, which sets RANK, WORLD_SIZE and LOCAL_RANK:
+    torchrun --nproc_per_node=4 train.py --distributed ...
+"""
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+
+class Context(object):
+    def __init__(self, rank=0, world_size=1, local_rank=0, device=None):
+        self.rank = rank
+        self.world_size = world_size
+        self.local_rank = local_rank
+        self.device = device
+
+    @property
+    def distributed(self):
+        return dist.is_available() and dist.is_initialized()
+
+    @property
+    def is_main(self):
+        return self.rank == 0
+
+    def barrier(self):
+        if self.distributed:
+            dist.barrier()
+
+    def wrap(self, module, find_unused_parameters=False):
+        """module on the device, in DDP when distributed and in DataParallel otherwise"""
+        module = module.to(self.device)
+        if not self.distributed:
+            return nn.DataParallel(module)
+        device_ids = [self.device.index] if self.device.type == 'cuda' else None
+        return nn.parallel.DistributedDataParallel(
+            module, device_ids=device_ids, find_unused_parameters=find_unused_parameters
+        )
+
+    def close(self):
+        if self.distributed:
+            dist.destroy_process_group()
+
+
+def setup(distributed, backend=None):
+    """Context of this process, joins the process group when distributed"""
+    if not distributed:
+        return Context(device=torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+
+    rank = int(os.environ['RANK'])
+    world_size = int(os.environ['WORLD_SIZE'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+    if backend is None:
+        backend = 'nccl' if device.type == 'cuda' else 'gloo'
+    dist.init_process_group(backend, init_method='env://', rank=rank, world_size=world_size)
+    return Context(rank, world_size, local_rank, device)
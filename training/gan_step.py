@@ -0,0 +1,119 @@
+"""One meta-learning step of E, G and D.
+
+Real and fake images go through D in a single batched forward. That forward gives the
+adversarial and feature matching terms of lossG and also the hinge loss of the first D update,
+since D does not change between the two. The remaining d_steps - 1 D updates run one more
+batched forward each, on the detached x_hat.
+
+With a wi_table (training/wi_table.py) the W_i columns of the batch are looked up before each
+D forward and their rows updated with the D step.
+"""
+import contextlib
+
+import torch
+
+from network.model import E_LEN
+
+
+class GANStep(object):
+    def __init__(self, E, G, D, optimizerG, optimizerD, criterionG, criterionDreal, criterionDfake,
+                 d_steps=2, autocast=contextlib.nullcontext, scalerG=None, scalerD=None, wi_table=None):
+        if d_steps < 1:
+            raise ValueError(f'd_steps must be at least 1, got {d_steps}')
+        self.E = E
+        self.G = G
+        self.D = D
+        self.optimizerG = optimizerG
+        self.optimizerD = optimizerD
+        self.criterionG = criterionG
+        self.criterionDreal = criterionDreal
+        self.criterionDfake = criterionDfake
+        self.d_steps = d_steps
+        self.autocast = autocast
+        self.scalerG = scalerG
+        self.scalerD = scalerD
+        self.wi_table = wi_table
+        self.paramsG = list(E.parameters()) + list(G.parameters())
+        self.paramsD = list(D.parameters())
+
+    def lookup(self, i):
+        return None if self.wi_table is None else self.wi_table.lookup(i)
+
+    def discriminate(self, x_hat, x, g_y, i, w_i=None):
+        """(r_hat, r, D_hat_res_list, D_res_list) of one D forward on x_hat and x"""
+        n = x.shape[0]
+        if w_i is not None:
+            w_i = torch.cat((w_i, w_i))
+        r, res_list = self.D(torch.cat((x_hat, x)), torch.cat((g_y, g_y)), torch.cat((i, i)), w_i=w_i)
+        return r[:n], r[n:], [res[:n] for res in res_list], [res[n:] for res in res_list]
+
+    def lossD(self, r_hat, r):
+        return self.criterionDfake(r_hat) + self.criterionDreal(r)
+
+    def backward(self, loss, params, scaler, retain_graph=False):
+        # only the grads of params, the other nets are not updated by this loss
+        if scaler is not None:
+            loss = scaler.scale(loss)
+        loss.backward(inputs=params, retain_graph=retain_graph)
+
+    def step(self, optimizer, scaler):
+        if scaler is None:
+            optimizer.step()
+            return
+        scaler.step(optimizer)
+        scaler.update()
+
+    def backwardD(self, lossD, w_i):
+        self.backward(lossD, self.paramsD if w_i is None else self.paramsD + [w_i], self.scalerD)
+
+    def stepD(self, i, w_i):
+        if w_i is not None:
+            # the scale of this step, before step() updates it, as a tensor: get_scale() waits for the device
+            scale = 1.0
+            if self.scalerD is not None:
+                scale = 1.0 / self.scalerD.scale(torch.ones((), device=w_i.device))
+            self.wi_table.step(i, w_i.grad, scale)
+        self.step(self.optimizerD, self.scalerD)
+
+    def __call__(self, f_lm, x, g_y, i):
+        """Train on a batch, returns x_hat, lossG and the last lossD"""
+        with torch.autograd.enable_grad():
+            self.optimizerG.zero_grad()
+            self.optimizerD.zero_grad()
+
+            with self.autocast():
+                # Calculate average encoding vector for video
+                f_lm_compact = f_lm.view(-1, f_lm.shape[-4], f_lm.shape[-3], f_lm.shape[-2],
+                                         f_lm.shape[-1])  # BxK,2,3,224,224
+                e_vectors = self.E(f_lm_compact[:, 0, :, :, :], f_lm_compact[:, 1, :, :, :])  # BxK,512,1
+                e_vectors = e_vectors.view(-1, f_lm.shape[1], E_LEN, 1)  # B,K,512,1
+                e_hat = e_vectors.mean(dim=1)
+
+                x_hat = self.G(g_y, e_hat)
+                w_i = self.lookup(i)
+                r_hat, r, D_hat_res_list, D_res_list = self.discriminate(x_hat, x, g_y, i, w_i)
+
+                # real features are a target for G, as with the former no_grad pass
+                lossG = self.criterionG(
+                    x, x_hat, r_hat, [res.detach() for res in D_res_list], D_hat_res_list,
+                    e_vectors, self.D.module.W_i[:, i] if w_i is None else w_i.t(), i
+                )
+                lossD = self.lossD(r_hat, r)
+
+            # both backwards before any step, the first D update sees the D that made x_hat
+            self.backward(lossG, self.paramsG, self.scalerG, retain_graph=True)
+            self.backwardD(lossD, w_i)
+            self.step(self.optimizerG, self.scalerG)
+            self.stepD(i, w_i)
+
+            x_hat = x_hat.detach()
+            for _ in range(self.d_steps - 1):
+                self.optimizerD.zero_grad()
+                w_i = self.lookup(i)
+                with self.autocast():
+                    r_hat, r, _, _ = self.discriminate(x_hat, x, g_y, i, w_i)
+                    lossD = self.lossD(r_hat, r)
+                self.backwardD(lossD, w_i)
+                self.stepD(i, w_i)
+
+        return x_hat, lossG, lossD
@@ -0,0 +1,108 @@
+"""Training metrics off the critical path.
+
+Losses are summed on their device every step and only copied at log steps. At a log step the
+loss means and the sample images are copied to pinned host memory with non_blocking copies;
+a worker thread waits for the copies, computes match accuracy and SSIM, prints and writes
+tensorboard, while the training loop goes on.
+"""
+import queue
+import threading
+
+import numpy as np
+import torch
+from skimage import metrics
+
+
+class LossAccumulator(object):
+    """Device side sums of named loss tensors, any shape, flattened into one vector"""
+    def __init__(self):
+        self.names = None
+        self.sum = None
+        self.count = 0
+
+    def add(self, losses):
+        values = torch.cat([v.detach().float().reshape(-1) for v in losses.values()])
+        if self.sum is None:
+            self.names = []
+            for name, v in losses.items():
+                self.names += [name] if v.dim() == 0 else [f'{name}_{n}' for n in range(v.numel())]
+            self.sum = torch.zeros_like(values)
+        self.sum.add_(values)
+        self.count += 1
+
+    def pop(self):
+        """(names, mean since the last pop) with the mean still on the device"""
+        mean = self.sum / max(self.count, 1)
+        self.sum.zero_()
+        self.count = 0
+        return self.names, mean
+
+
+def copy_to_host(tensor):
+    if tensor.device.type != 'cuda':
+        return tensor.detach().to('cpu', copy=True)
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    host.copy_(tensor.detach(), non_blocking=True)
+    return host
+
+
+class MetricsLogger(object):
+    def __init__(self, writer, log=print, queue_size=4):
+        self.writer = writer
+        self.log = log
+        self.losses = LossAccumulator()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def accumulate(self, **losses):
+        self.losses.add(losses)
+
+    def submit(self, step, header, x_hat, x, g_y):
+        """Log the loss means since the last submit and the first sample of x_hat, x and g_y"""
+        names, mean = self.losses.pop()
+        images = torch.stack((x_hat[0].float(), x[0].float(), g_y[0].float()))
+        mean, images = copy_to_host(mean), copy_to_host(images)
+        event = None
+        if images.is_pinned():
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((step, header, names, mean, images, event))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            step, header, names, mean, images, event = item
+            if event is not None:
+                event.synchronize()
+            try:
+                self.write(step, header, dict(zip(names, mean.tolist())), images)
+            except Exception as e:
+                self.log(f'Can not log step {step}: {e}')
+
+    def write(self, step, header, losses, images):
+        out1, out2, out3 = (images * 255).permute([0, 2, 3, 1]).type(torch.int32).numpy()
+        accuracy = np.sum(np.squeeze((np.abs(out1 - out2) <= 1))) / np.prod(out1.shape)
+        ssim = metrics.structural_similarity(out1.astype(np.uint8).clip(0, 255), out2.astype(np.uint8).clip(0, 255), channel_axis=-1)
+        self.log(
+            '%s\tLoss_D: %.4f\tLoss_G: %.4f\tMatch: %.3f\tSSIM: %.3f'
+            % (header, losses['loss_d'], losses['loss_g'], accuracy, ssim)
+        )
+
+        image = np.hstack((out1, out2, out3)).astype(np.uint8).clip(0, 255)
+        self.writer.add_image(
+            'Result', image,
+            global_step=step,
+            dataformats='HWC'
+        )
+        for name, value in losses.items():
+            self.writer.add_scalar(name, value, global_step=step)
+        self.writer.add_scalar('match', accuracy, global_step=step)
+        self.writer.add_scalar('ssim', ssim, global_step=step)
+        self.writer.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
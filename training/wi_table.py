@@ -0,0 +1,467 @@
+"""W_i of the Discriminator as a table of rows outside the model.
+
+The dense E_LEN x num_videos parameter, its two Adam moments and its copy in every checkpoint
+grow with the dataset, while a step only touches the B videos of the batch. Here each video is a
+row of a (num_videos, E_LEN) float32 array, kept in memory ('cpu') or memory mapped ('mmap'), with
+Adam moments and step counts per row. A step looks up the rows of the batch, D uses them through
+its w_i argument, and only those rows are updated (lazy Adam, bias correction by row step count).
+
+Rows in use are copied to a cache on the training device and updated there, so a step does not
+wait for the device. commit(step), called with each checkpoint, copies the rows changed since the
+last commit to the host and a background thread writes them to the .npy files in path_to_Wi and
+records the step in W_i_table_step.txt. Rows of a commit stay in the cache until the next one,
+so the writes never race with reads of the files. The cache holds at most cache_rows rows (more
+only when one step needs them): past that the least recently used rows are evicted, rows changed
+since the last commit are written to the files first.
+
+Before rows are written, their values in the files go to an undo record in W_i_undo/, and the
+checkpoint of a step is written once the commit of that step is done (CheckpointManager
+before_write). On start the rows are rolled back to the step of the checkpoint being loaded
+('W_i_step'): a commit whose checkpoint never made it to disk is undone, and so are the commits
+after an older checkpoint, for the last keep commits.
+
+With DDP every rank gathers the indices and gradients of all ranks and applies the same update,
+so the copies stay identical; with mmap, ranks other than 0 keep a private copy of the files.
+
+Rows follow the video keys of the dataset (W_i_table_videos.txt). When the dataset lists its
+videos in another order, or has new ones, the rows are moved to the new order on start. The
+files of the new order are written next to the old ones first, then W_i_reorder.txt, then they
+replace the old ones; a start after a crash finishes the replaces, or drops the new files when
+W_i_reorder.txt was not written yet.
+"""
+import os
+import shutil
+import threading
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+FILES = {'table': 'W_i_table.npy', 'm': 'W_i_adam_m.npy', 'v': 'W_i_adam_v.npy', 'step': 'W_i_adam_step.npy'}
+STEP_FILE = 'W_i_table_step.txt'
+# values of rows before a commit wrote them, to go back to the step of an earlier checkpoint
+UNDO_DIR = 'W_i_undo'
+VIDEOS_FILE = 'W_i_table_videos.txt'
+# written once the files of a new video order are all next to the old ones, with this suffix
+REORDER_FILE = 'W_i_reorder.txt'
+REORDER = '.reorder'
+
+
+def to_device(array, device):
+    tensor = torch.from_numpy(np.ascontiguousarray(array))
+    if torch.device(device).type != 'cuda':
+        return tensor.to(device)
+    return tensor.pin_memory().to(device, non_blocking=True)
+
+
+class WiTable(object):
+    def __init__(self, path_to_Wi, num_videos, dim, storage='cpu', init=None, step=0, lr=2e-4,
+                 betas=(0.9, 0.999), eps=1e-8, rank=0, device='cpu', keys=None, keep=3,
+                 cache_rows=32768, grow_rows=1024):
+        """step is the step of the checkpoint training starts from, the rows are rolled back to it.
+        keep is the number of commits that can be undone, the versioned checkpoints kept.
+        cache_rows is the row budget of the device cache, which grows by grow_rows at a time.
+        """
+        if storage not in ('cpu', 'mmap'):
+            raise ValueError(f'Unknown W_i storage {storage}')
+        self.path_to_Wi = path_to_Wi
+        self.storage = storage
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.device = torch.device(device)
+        self.keep = keep
+        self.cache_rows = cache_rows
+        self.grow_rows = grow_rows
+        # only rank 0 writes the files checkpoints go with, and their undo records
+        self.journal = rank == 0
+
+        distributed = dist.is_available() and dist.is_initialized()
+        if rank == 0:
+            if not os.path.exists(self.path(FILES['table'])):
+                self.create(num_videos, dim, init, step)
+            self.finish_reorder()
+            self.rollback(step)
+            if keys is not None:
+                self.reorder(keys)
+        if distributed:
+            dist.barrier()
+        if rank != 0 and storage == 'mmap':
+            # updates of each rank go to its own copy, rank 0 has the one checkpoints use
+            rank_dir = os.path.join(path_to_Wi, f'rank-{rank}')
+            os.makedirs(rank_dir, exist_ok=True)
+            for name in list(FILES.values()) + [STEP_FILE]:
+                shutil.copyfile(self.path(name), os.path.join(rank_dir, name))
+            self.path_to_Wi = rank_dir
+        self.committed_step = self.read_step()
+
+        # base: the rows as of the last commit, files: the .npy files this rank writes commits to
+        mmap_mode = 'r+' if storage == 'mmap' else None
+        self.base = {key: np.load(self.path(name), mmap_mode=mmap_mode) for key, name in FILES.items()}
+        if self.base['table'].shape != (num_videos, dim):
+            raise ValueError(f'{self.path(FILES["table"])} has shape {self.base["table"].shape}, '
+                             f'expected {(num_videos, dim)}')
+        self.files = None
+        if storage == 'mmap':
+            self.files = self.base
+        elif rank == 0:
+            self.files = {key: np.load(self.path(name), mmap_mode='r+') for key, name in FILES.items()}
+
+        # device cache of rows: slot of each row, and row, update count of the last change and
+        # load count of the last use of each slot
+        self.slots = {}
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.modified = np.zeros(0, dtype=np.int64)
+        self.used = np.zeros(0, dtype=np.int64)
+        self.loads = 0
+        self.cache = {
+            'table': torch.zeros((0, dim), device=self.device),
+            'm': torch.zeros((0, dim), device=self.device),
+            'v': torch.zeros((0, dim), device=self.device),
+            'step': torch.zeros(0, dtype=torch.int64, device=self.device),
+        }
+        self.updates = 0
+        self.committed_updates = 0
+        # steps with inf/nan gradients, counted on the device
+        self.skipped = torch.zeros((), dtype=torch.int64, device=self.device)
+
+        # indices are exchanged on the host, through gloo when the default group is nccl
+        self.group = None
+        if distributed and dist.get_backend() != 'gloo':
+            self.group = dist.new_group(backend='gloo')
+        self.thread = None
+        self.error = None
+
+    def path(self, name):
+        return os.path.join(self.path_to_Wi, name)
+
+    def create(self, num_videos, dim, init, step):
+        """init is an optional (dim, num_videos) tensor, the W_i of the checkpoint of step"""
+        table = torch.randn(num_videos, dim) if init is None else init.detach().t()
+        arrays = {
+            'table': table.float().numpy(),
+            'm': np.zeros((num_videos, dim), dtype=np.float32),
+            'v': np.zeros((num_videos, dim), dtype=np.float32),
+            'step': np.zeros(num_videos, dtype=np.int64),
+        }
+        for key, name in FILES.items():
+            np.save(self.path(name + '.tmp'), arrays[key])
+            os.replace(self.path(name + '.tmp.npy'), self.path(name))
+        self.write_step(step)
+
+    def reorder(self, keys):
+        """Move the rows to the order of keys, rows of new videos start like create()"""
+        if not os.path.exists(self.path(VIDEOS_FILE)):
+            # tables of before the key list are in the order of the dataset
+            self.write_keys(keys)
+            return
+        with open(self.path(VIDEOS_FILE)) as f:
+            old_keys = f.read().splitlines()
+        if old_keys == list(keys):
+            return
+        index = column_index(old_keys, keys)
+        found = index >= 0
+        for key, name in FILES.items():
+            array = np.load(self.path(name), mmap_mode='r')
+            rows = np.zeros((len(keys),) + array.shape[1:], dtype=array.dtype)
+            if key == 'table':
+                rows[~found] = np.random.randn(int((~found).sum()), array.shape[1])
+            rows[found] = array[index[found]]
+            with open(self.path(name + REORDER), 'wb') as f:
+                np.save(f, rows)
+                f.flush()
+                os.fsync(f.fileno())
+        self.write_keys(keys, VIDEOS_FILE + REORDER)
+        # from here on a start finishes the reorder, before it the new files are dropped
+        self.write_keys([], REORDER_FILE)
+        self.finish_reorder()
+        print(f'W_i rows moved to the new video list: {int(found.sum())} kept, {int((~found).sum())} new, '
+              f'{len(old_keys) - int(found.sum())} dropped')
+
+    def finish_reorder(self):
+        """Replace the files by the ones of the new video order, or drop those of a reorder cut short"""
+        names = list(FILES.values()) + [VIDEOS_FILE]
+        if not os.path.exists(self.path(REORDER_FILE)):
+            for name in names:
+                if os.path.exists(self.path(name + REORDER)):
+                    os.remove(self.path(name + REORDER))
+            return
+        # the key list goes last, files already replaced have no REORDER file left
+        for name in names:
+            if os.path.exists(self.path(name + REORDER)):
+                os.replace(self.path(name + REORDER), self.path(name))
+        # undo records name rows of the old order
+        shutil.rmtree(self.path(UNDO_DIR), ignore_errors=True)
+        os.remove(self.path(REORDER_FILE))
+
+    def write_keys(self, keys, name=VIDEOS_FILE):
+        with open(self.path(name + '.tmp'), 'w') as f:
+            f.writelines(key + '\n' for key in keys)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path(name + '.tmp'), self.path(name))
+
+    def read_step(self):
+        with open(self.path(STEP_FILE)) as f:
+            return int(f.read())
+
+    def write_step(self, step):
+        with open(self.path(STEP_FILE + '.tmp'), 'w') as f:
+            f.write(str(step))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path(STEP_FILE + '.tmp'), self.path(STEP_FILE))
+
+    def undo_records(self):
+        """(sequence number, path) of the undo records, oldest first"""
+        records = []
+        if os.path.isdir(self.path(UNDO_DIR)):
+            for name in os.listdir(self.path(UNDO_DIR)):
+                if name.startswith('undo-') and name.endswith('.npz'):
+                    records.append((int(name[5:-4]), os.path.join(self.path(UNDO_DIR), name)))
+        return sorted(records)
+
+    @staticmethod
+    def read_record(path):
+        with np.load(path) as record:
+            return {key: record[key] for key in record.files}
+
+    def rollback(self, step):
+        """Bring the files back to the rows of step, undoing the commits after it"""
+        current = self.read_step()
+        if step > current:
+            raise ValueError(f'W_i rows in {self.path_to_Wi} are from step {current}, '
+                             f'older than the checkpoint of step {step}')
+        records = [(path, self.read_record(path)) for _, path in self.undo_records()]
+        cut = len(records)
+        at = current
+        while at != step:
+            # each commit record goes from the step it made back to the step before
+            cut = self.last_commit(records, at, cut)
+            if cut < 0:
+                raise ValueError(f'W_i rows in {self.path_to_Wi} are from step {current} and can not be '
+                                 f'rolled back to the checkpoint of step {step}')
+            at = int(records[cut][1]['since'])
+
+        # records after the commit of step: later commits, an interrupted one and evicted rows
+        undo = records[self.last_commit(records, step, cut) + 1:]
+        if undo:
+            files = {key: np.load(self.path(name), mmap_mode='r+') for key, name in FILES.items()}
+            for _, record in reversed(undo):
+                for key in FILES:
+                    files[key][record['rows']] = record[key]
+            for key in FILES:
+                files[key].flush()
+        if current != step:
+            print(f'W_i rows rolled back from step {current} to step {step}')
+        self.write_step(step)
+        for path, _ in undo:
+            os.remove(path)
+
+    @staticmethod
+    def last_commit(records, step, end):
+        """Index of the last record before end that committed step, -1 for none"""
+        for n in reversed(range(end)):
+            if int(records[n][1]['commit']) == step:
+                return n
+        return -1
+
+    def write_undo(self, rows, since, commit=-1):
+        """Record the values of rows in the files before they are written over.
+
+        since is the step the files are at, commit the step the write brings them to (-1 for none).
+        """
+        os.makedirs(self.path(UNDO_DIR), exist_ok=True)
+        records = self.undo_records()
+        seq = records[-1][0] + 1 if records else 0
+        path = os.path.join(self.path(UNDO_DIR), f'undo-{seq:08d}.npz')
+        values = {key: np.asarray(self.files[key][rows]) for key in FILES}
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, rows=rows, since=since, commit=commit, **values)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def prune_undo(self):
+        """Drop the records not needed to go back over the last keep commits"""
+        records = [(path, self.read_record(path)) for _, path in self.undo_records()]
+        commits = [int(r['since']) for _, r in records if int(r['commit']) >= 0]
+        if len(commits) <= self.keep:
+            return
+        oldest = commits[-self.keep]
+        for path, record in records:
+            if int(record['since']) < oldest:
+                os.remove(path)
+
+    def __len__(self):
+        return len(self.base['table'])
+
+    def load(self, rows):
+        """Slots of rows, the rows not in the cache are copied from the base"""
+        self.loads += 1
+        new = np.unique(rows[np.array([r not in self.slots for r in rows.tolist()], dtype=bool)])
+        if len(new):
+            if len(self.rows) + len(new) > self.cache_rows:
+                self.evict(rows, len(self.rows) + len(new) - self.cache_rows)
+            start = len(self.rows)
+            self.slots.update((r, start + n) for n, r in enumerate(new.tolist()))
+            self.rows = np.concatenate((self.rows, new))
+            self.modified = np.concatenate((self.modified, np.zeros(len(new), dtype=np.int64)))
+            self.used = np.concatenate((self.used, np.zeros(len(new), dtype=np.int64)))
+            for key, cache in self.cache.items():
+                if len(cache) < len(self.rows):
+                    size = max(len(self.rows), min(len(cache) + self.grow_rows, self.cache_rows))
+                    grown = cache.new_zeros((size,) + cache.shape[1:])
+                    grown[:start] = cache[:start]
+                    self.cache[key] = cache = grown
+                cache[start:len(self.rows)] = to_device(self.base[key][new], self.device)
+        slots = np.array([self.slots[r] for r in rows.tolist()], dtype=np.int64)
+        self.used[slots] = self.loads
+        return slots
+
+    def evict(self, rows, count):
+        """Make room for count rows, evicting the least recently used ones but rows.
+
+        Rows changed since the last commit are written to the files, with an undo record, so the
+        next commit does not have them; a rollback to the last commit undoes them.
+        """
+        # evicted rows are read from the base again, after the last commit wrote it
+        self.wait()
+        # a few more than needed, so the cache is not compacted at every new row
+        count = min(count + self.grow_rows // 4, len(self.rows))
+        order = np.argsort(self.used, kind='stable')
+        order = order[~np.isin(self.rows[order], rows)][:count]
+        if not len(order):
+            return
+        dirty = order[self.modified[order] > self.committed_updates]
+        if len(dirty):
+            index = to_device(dirty, self.device)
+            values = {key: cache[index].cpu().numpy() for key, cache in self.cache.items()}
+            if self.journal:
+                self.write_undo(self.rows[dirty], self.committed_step)
+            self.apply(self.rows[dirty], values)
+        keep = np.ones(len(self.rows), dtype=bool)
+        keep[order] = False
+        self.compact(keep)
+
+    def compact(self, keep):
+        """Drop the slots not in keep from the cache"""
+        self.rows, self.modified, self.used = self.rows[keep], self.modified[keep], self.used[keep]
+        self.slots = {r: n for n, r in enumerate(self.rows.tolist())}
+        index = to_device(np.flatnonzero(keep), self.device)
+        for key, cache in self.cache.items():
+            self.cache[key] = cache[index]
+
+    def lookup(self, i):
+        """(B, dim) rows of the videos i, a leaf that collects their gradient"""
+        slots = to_device(self.load(i.numpy()), self.device)
+        return self.cache['table'][slots].requires_grad_()
+
+    def step(self, i, grad, scale=1.0):
+        """Adam update of the rows of i. grad is (B, dim), multiplied by scale (1 / the loss scale)"""
+        i = i.cpu()
+        grad = grad.float() * scale
+        if dist.is_available() and dist.is_initialized():
+            world_size = dist.get_world_size()
+            all_i = [torch.empty_like(i) for _ in range(world_size)]
+            all_grad = [torch.empty_like(grad) for _ in range(world_size)]
+            dist.all_gather(all_i, i, group=self.group)
+            dist.all_gather(all_grad, grad.contiguous())
+            # mean over ranks, like the gradients DDP averages
+            i, grad = torch.cat(all_i), torch.cat(all_grad) / world_size
+
+        slots, inverse = np.unique(self.load(i.numpy()), return_inverse=True)
+        self.updates += 1
+        self.modified[slots] = self.updates
+        slots, inverse = to_device(slots, self.device), to_device(inverse.reshape(-1), self.device)
+        g = torch.zeros((len(slots), grad.shape[1]), device=self.device).index_add_(0, inverse, grad)
+        # inf/nan from float16, GradScaler skips the optimizers of this step too
+        finite = torch.isfinite(g).all()
+        self.skipped += (~finite).long()
+
+        beta1, beta2 = self.betas
+        t = self.cache['step'][slots] + 1
+        m = beta1 * self.cache['m'][slots] + (1 - beta1) * g
+        v = beta2 * self.cache['v'][slots] + (1 - beta2) * g * g
+        m_hat = m / (1 - beta1 ** t.double()).float()[:, None]
+        v_hat = v / (1 - beta2 ** t.double()).float()[:, None]
+        table = self.cache['table'][slots] - self.lr * m_hat / (v_hat.sqrt() + self.eps)
+        new = {'table': table, 'm': m, 'v': v, 'step': t}
+        for key, cache in self.cache.items():
+            cache[slots] = torch.where(finite, new[key], cache[slots])
+
+    def commit(self, step):
+        """Write the rows changed since the last commit in the background, as the rows of step"""
+        self.wait()
+        # rows not changed since the last commit are in the base now
+        keep = self.modified > self.committed_updates
+        if not keep.all():
+            self.compact(keep)
+        self.committed_updates = self.updates
+        rows = self.rows.copy()
+        values = {key: cache[:len(rows)].cpu().numpy() for key, cache in self.cache.items()}
+        self.thread = threading.Thread(target=self.write, args=(rows, values, step))
+        self.thread.start()
+
+    def write(self, rows, values, step):
+        try:
+            if self.journal:
+                self.write_undo(rows, self.committed_step, step)
+            self.apply(rows, values)
+            if self.journal:
+                self.write_step(step)
+                self.prune_undo()
+            self.committed_step = step
+        except Exception as e:
+            self.error = e
+
+    def apply(self, rows, values):
+        for key in FILES:
+            self.base[key][rows] = values[key]
+            if self.files is not None and self.files is not self.base:
+                self.files[key][rows] = values[key]
+        if self.files is not None:
+            for key in FILES:
+                self.files[key].flush()
+
+    def wait(self):
+        """Wait for the last commit, raises its error if it failed. The checkpoint thread calls it too."""
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+        if self.error is not None:
+            # the files are behind the cache after a failed commit, later commits fail too
+            raise self.error
+
+
+def column_index(old_keys, keys):
+    """Index in old_keys of each of keys, -1 for keys that are not in old_keys"""
+    old = {key: n for n, key in enumerate(old_keys)}
+    return np.array([old.get(key, -1) for key in keys], dtype=np.int64)
+
+
+def remap_columns(W_i, index, new=torch.zeros):
+    """Columns of W_i at index, the columns of index -1 made by new(shape)"""
+    index = torch.from_numpy(index)
+    found = index >= 0
+    out = W_i.new_empty((W_i.shape[0], len(index)))
+    out[:, found] = W_i[:, index[found]]
+    out[:, ~found] = new((W_i.shape[0], int((~found).sum()))).to(W_i.dtype)
+    return out
+
+
+def drop_param(optimizer_state, names, name):
+    """state_dict of an optimizer of the params names, without the state of name.
+
+    names are in the order of the ids of the state_dict, like D.parameters() when it was made.
+    """
+    drop = names.index(name)
+
+    def remap(j):
+        return j if j < drop else j - 1
+
+    return {
+        'state': {remap(j): s for j, s in optimizer_state['state'].items() if j != drop},
+        'param_groups': [dict(group, params=[remap(j) for j in group['params'] if j != drop])
+                         for group in optimizer_state['param_groups']],
+    }
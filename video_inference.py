@@ -1,27 +1,89 @@
+import argparse
+import queue
+import threading
+
 import torch
 import cv2
-from matplotlib import pyplot as plt
+import numpy as np
 
-from loss.loss_discriminator import *
-from loss.loss_generator import *
 from network.blocks import *
 from network.model import *
-from webcam_demo.webcam_extraction_conversion import *
-
-from params.params import path_to_chkpt
-from tqdm import tqdm
+from webcam_demo.webcam_extraction_conversion import LandmarkExtractor
 
 """Init"""
 
-#Paths
-path_to_model_weights = 'finetuned_model.tar'
-path_to_embedding = 'e_hat_video.tar'
-path_to_mp4 = 'test_vid2.webm'
 
-device = torch.device("cuda:0")
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='finetuned_model.tar')
+    parser.add_argument('--embedding', default='e_hat_video.tar')
+    parser.add_argument('--video', default='test_vid2.webm')
+    parser.add_argument('--output', default='project.mp4')
+    parser.add_argument('--batch-size', type=int, default=8, help='frames per Generator forward')
+    parser.add_argument('--queue-size', type=int, default=32, help='max frames buffered between stages')
+    parser.add_argument('--pad', type=int, default=50)
+
+    return parser.parse_args()
+
+
+STOP = None
+
+
+def decode_frames(cap, frame_q):
+    frame_id = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frame_q.put((frame_id, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+        frame_id += 1
+    frame_q.put(STOP)
+
+
+def extract_landmarks(frame_q, lm_q, extractor):
+    # a single landmark worker keeps the frames in decode order
+    while True:
+        item = frame_q.get()
+        if item is STOP:
+            break
+        frame_id, rgb = item
+        try:
+            x, g_y = extractor(rgb)
+        except Exception:
+            print('Error: Video corrupted or no landmarks visible')
+            continue
+        lm_q.put((frame_id, x, g_y))
+    lm_q.put(STOP)
+
+
+def render_batch(G, e_hat, batch, device, video):
+    x = np.stack([item[1] for item in batch])  # N,256,256,3
+    g_y = np.stack([item[2] for item in batch])  # N,256,256,3
+
+    g_y_t = torch.from_numpy(g_y).to(device).transpose(1, 3).float() / 255  # N,3,256,256
+    x_hat = G(g_y_t, e_hat)
+    fake = (x_hat.transpose(1, 3) * 255).cpu().numpy()
+
+    for me, landmark, out in zip(x, g_y, fake):
+        img = np.concatenate((
+            cv2.cvtColor(me, cv2.COLOR_BGR2RGB),
+            cv2.cvtColor(landmark, cv2.COLOR_BGR2RGB),
+            cv2.cvtColor(out, cv2.COLOR_BGR2RGB),
+        ), axis=1)
+        video.write(img.astype('uint8'))
+
+
+# Paths
+args = parse_args()
+path_to_model_weights = args.model
+path_to_embedding = args.embedding
+path_to_mp4 = args.video
+
+use_cuda = torch.cuda.is_available()
+device = torch.device("cuda:0" if use_cuda else 'cpu')
 cpu = torch.device("cpu")
 
-checkpoint = torch.load(path_to_model_weights, map_location=cpu) 
+checkpoint = torch.load(path_to_model_weights, map_location=cpu)
 e_hat = torch.load(path_to_embedding, map_location=cpu)
 e_hat = e_hat['e_hat'].to(device)
 
@@ -29,69 +91,50 @@ G = Generator(256, finetuning=True, e_finetuning=e_hat)
 G.eval()
 
 """Training Init"""
+if checkpoint.get('spectral_norm_baked'):
+    remove_spectral_norms(G)
 G.load_state_dict(checkpoint['G_state_dict'])
 G.to(device)
+G.freeze_identity()
 
 
 """Main"""
-print('PRESS Q TO EXIT')
 cap = cv2.VideoCapture(path_to_mp4)
 n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 fps = int(cap.get(cv2.CAP_PROP_FPS))
-ret = True
-i = 0
 size = (256*3,256)
-#out = cv2.VideoWriter('project.mp4',cv2.VideoWriter_fourcc('M','P','4','2'), 30, size)
-video = cv2.VideoWriter('project.mp4',cv2.VideoWriter_fourcc(*'DIVX'), fps, size)
+video = cv2.VideoWriter(args.output, cv2.VideoWriter_fourcc(*'DIVX'), fps, size)
+extractor = LandmarkExtractor(device, pad=args.pad)
+
+# decode -> landmarks -> batched Generator, joined by bounded queues
+frame_q = queue.Queue(maxsize=args.queue_size)
+lm_q = queue.Queue(maxsize=args.queue_size)
+threads = [
+    threading.Thread(target=decode_frames, args=(cap, frame_q), daemon=True),
+    threading.Thread(target=extract_landmarks, args=(frame_q, lm_q, extractor), daemon=True),
+]
+for t in threads:
+    t.start()
 
+i = 0
+batch = []
+done = False
 with torch.no_grad():
-    while ret:
-        x, g_y, ret = generate_landmarks(cap=cap, device=device, pad=50)
-        if ret:
-            g_y = g_y.unsqueeze(0)/255
-            x = x.unsqueeze(0)/255
-
-
-            #forward
-            # Calculate average encoding vector for video
-            #f_lm_compact = f_lm.view(-1, f_lm.shape[-4], f_lm.shape[-3], f_lm.shape[-2], f_lm.shape[-1]) #BxK,2,3,224,224
-            #train G
-
-            x_hat = G(g_y, e_hat)
-
-            plt.clf()
-            out1 = x_hat.transpose(1,3)[0]
-            #for img_no in range(1,x_hat.shape[0]):
-            #    out1 = torch.cat((out1, x_hat.transpose(1,3)[img_no]), dim = 1)
-            out1 = out1.to(cpu).numpy()
-            #plt.imshow(out1)
-            #plt.show()
-
-            #plt.clf()
-            out2 = x.transpose(1,3)[0]
-            #for img_no in range(1,x.shape[0]):
-            #    out2 = torch.cat((out2, x.transpose(1,3)[img_no]), dim = 1)
-            out2 = out2.to(cpu).numpy()
-            #plt.imshow(out2)
-            #plt.show()
-
-            #plt.clf()
-            out3 = g_y.transpose(1,3)[0]
-            #for img_no in range(1,g_y.shape[0]):
-            #    out3 = torch.cat((out3, g_y.transpose(1,3)[img_no]), dim = 1)
-            out3 = out3.to(cpu).numpy()
-            #plt.imshow(out3)
-            #plt.show()
-
-            fake = cv2.cvtColor(out1*255, cv2.COLOR_BGR2RGB)
-            me = cv2.cvtColor(out2*255, cv2.COLOR_BGR2RGB)
-            landmark = cv2.cvtColor(out3*255, cv2.COLOR_BGR2RGB)
-            img = np.concatenate((me, landmark, fake), axis=1)
-            img = img.astype('uint8')
-            video.write(img)
-
-            i+=1
+    while not done:
+        item = lm_q.get()
+        if item is STOP:
+            done = True
+        else:
+            batch.append(item)
+
+        if batch and (done or len(batch) == args.batch_size):
+            render_batch(G, e_hat, batch, device, video)
+            i = batch[-1][0] + 1
+            batch = []
             print(i,'/',n_frames)
+
+for t in threads:
+    t.join()
 cap.release()
 video.release()
-"""cv2.destroyAllWindows()"""
\ No newline at end of file
+extractor.close()
@@ -1,9 +1,10 @@
 import cv2
 import face_alignment
-from matplotlib import pyplot as plt
 import numpy as np
 import torch
 
+from dataset.landmark_rasterizer import rasterize_landmarks, FIGURE_STYLE
+
 def get_borders(preds):
     minX = maxX = preds[0,0]
     minY = maxY = preds[0,1]
@@ -70,14 +71,81 @@ def crop_and_reshape_img(img, preds, pad, out_shape=256):
     return img
 
 
-def generate_landmarks(cap, device, pad):
-    """Input: cap a cv2.VideoCapture object, device the torch.device, 
+def frame_landmarks(frame, fa, pad):
+    """Input: frame an RGB image, fa a face_alignment.FaceAlignment, 
 pad the distance in pixel from border to face
 
+output: the cropped 256x256 frame and the corresponding landmark image, raises if no face is found"""
+    preds = fa.get_landmarks(frame)[0]
+
+    input = crop_and_reshape_img(frame, preds, pad=pad)
+    preds = crop_and_reshape_preds(preds, pad=pad)
+
+    data = rasterize_landmarks([preds], input.shape, FIGURE_STYLE)[0]
+
+    return input, data
+
+
+class LandmarkExtractor(object):
+    """Owns a single FaceAlignment model for a whole stream of frames.
+
+    Build it once, optionally warm it up, call it on every RGB frame and close it when done.
+    """
+    def __init__(self, device, pad=50, warmup=True):
+        self.device = torch.device(device)
+        self.pad = pad
+        self.fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=False,
+                                               device=self.device.type)
+        if warmup:
+            self.warmup()
+
+    def warmup(self):
+        # Dry run so that the first real frame does not pay for lazy initialisation
+        self.fa.get_landmarks(np.random.randint(0, 255, size=(256, 256, 3)).astype(np.uint8))
+        with torch.no_grad():
+            self.fa.face_alignment_net(
+                torch.from_numpy(np.random.randint(0, 255, size=(1, 3, 256, 256))).float().div(255.).to(self.device)
+            )
+
+    def __call__(self, frame):
+        """Returns the cropped frame and its landmark image, raises if no face is found"""
+        return frame_landmarks(frame, self.fa, self.pad)
+
+    def close(self):
+        self.fa = None
+        # a closed extractor is not handed out by get_landmark_extractor any more
+        for key in [key for key, extractor in _extractors.items() if extractor is self]:
+            del _extractors[key]
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_extractors = {}
+
+
+def get_landmark_extractor(device, pad):
+    """Shared LandmarkExtractor per device and pad, created on first use"""
+    key = (str(device), pad)
+    if key not in _extractors:
+        _extractors[key] = LandmarkExtractor(device, pad=pad)
+    return _extractors[key]
+
+
+def generate_landmarks(cap, device, pad, extractor=None):
+    """Input: cap a cv2.VideoCapture object, device the torch.device, 
+pad the distance in pixel from border to face, extractor an optional LandmarkExtractor
+(defaults to one shared extractor per device instead of a new model per call)
+
 output: x the camera output, g_y the corresponding landmark"""
    
-    #Get webcam image
-    fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=False, device=device.type)
+    if extractor is None:
+        extractor = get_landmark_extractor(device, pad)
     no_pic = True
     
     while(no_pic == True):
@@ -93,41 +161,7 @@ output: x the camera output, g_y the corresponding landmark"""
 
             for i in range(len(frames_list)):
                 try:
-                    input = frames_list[i]
-                    preds = fa.get_landmarks(input)[0]
-
-                    input = crop_and_reshape_img(input, preds, pad=pad)
-                    preds = crop_and_reshape_preds(preds, pad=pad)
-
-                    dpi = 100
-                    fig = plt.figure(figsize=(256/dpi, 256/dpi), dpi = dpi)
-                    ax = fig.add_subplot(1,1,1)
-                    ax.imshow(np.ones(input.shape))
-                    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-                    #chin
-                    ax.plot(preds[0:17,0],preds[0:17,1],marker='',markersize=5,linestyle='-',color='green',lw=2)
-                    #left and right eyebrow
-                    ax.plot(preds[17:22,0],preds[17:22,1],marker='',markersize=5,linestyle='-',color='orange',lw=2)
-                    ax.plot(preds[22:27,0],preds[22:27,1],marker='',markersize=5,linestyle='-',color='orange',lw=2)
-                    #nose
-                    ax.plot(preds[27:31,0],preds[27:31,1],marker='',markersize=5,linestyle='-',color='blue',lw=2)
-                    ax.plot(preds[31:36,0],preds[31:36,1],marker='',markersize=5,linestyle='-',color='blue',lw=2)
-                    #left and right eye
-                    ax.plot(preds[36:42,0],preds[36:42,1],marker='',markersize=5,linestyle='-',color='red',lw=2)
-                    ax.plot(preds[42:48,0],preds[42:48,1],marker='',markersize=5,linestyle='-',color='red',lw=2)
-                    #outer and inner lip
-                    ax.plot(preds[48:60,0],preds[48:60,1],marker='',markersize=5,linestyle='-',color='purple',lw=2)
-                    ax.plot(preds[60:68,0],preds[60:68,1],marker='',markersize=5,linestyle='-',color='pink',lw=2) 
-                    ax.axis('off')
-
-                    fig.canvas.draw()
-
-                    data = np.frombuffer(fig.canvas.tostring_rgb(), dtype=np.uint8)
-                    data = data.reshape(fig.canvas.get_width_height()[::-1] + (3,))
-
-                    frame_landmark_list.append((input, data))
-                    plt.close(fig)
+                    frame_landmark_list.append(extractor(frames_list[i]))
                     no_pic = False
                 except:
                     print('Error: Video corrupted or no landmarks visible')
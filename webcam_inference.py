@@ -11,6 +11,7 @@ from loss.loss_generator import *
 from network.blocks import *
 from network.model import *
 from dataset import video_extraction_conversion
+from dataset.face_landmarks import LandmarkTracker
 
 # from webcam_demo.webcam_extraction_conversion import *
 
@@ -24,6 +25,8 @@ def parse_args():
     parser.add_argument('--video')
     parser.add_argument('--output')
     parser.add_argument('--frame-size', type=int, default=224)
+    parser.add_argument('--detect-interval', type=int, default=1,
+                        help='run the face detector every N frames and track the face in between')
 
     return parser.parse_args()
 
@@ -46,14 +49,18 @@ G = Generator(frame_size, finetuning=True, e_finetuning=e_hat)
 G.eval()
 
 """Training Init"""
+if checkpoint.get('spectral_norm_baked'):
+    remove_spectral_norms(G)
 G.load_state_dict(checkpoint['G_state_dict'])
 G.to(device)
 G.finetuning_init()
+G.freeze_identity()
 
 """Main"""
 print('PRESS Q TO EXIT')
 cap = cv2.VideoCapture(args.video if args.video else 0)
 fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=False, device=device.type)
+fa = LandmarkTracker(fa, detect_interval=args.detect_interval)
 
 if args.output:
     fps = cap.get(cv2.CAP_PROP_FPS)